@@ -0,0 +1,143 @@
+import os
+import hashlib
+import json
+import numpy
+
+# The default limit on the total size of the cache directory, in bytes.
+defaultMaxSize = 1 << 30
+
+class AssetCache:
+    """
+    An on-disk cache of decoded arrays, such as pfm grids and alpha
+    and beta maps, so that a warm start needs only to memory-map them
+    instead of inflating and decoding the original files.
+
+    Each array is stored in its own .npy file, named by a hash of the
+    bundle's content hash and the member name.  The total size of the
+    directory is kept under maxSize by deleting the least recently
+    used files; a file's modification time records its last use.
+
+    The cache also remembers the digest of each member of a bundle
+    (see MpcdiFile.getSubfileDigest()), in a small .json file for
+    each bundle, so that the content hash can be computed on a warm
+    start without reading the bundle.
+    """
+
+    def __init__(self, directory, maxSize = defaultMaxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+
+    def getFilename(self, bundleHash, memberName):
+        """ Returns the filename that holds the indicated array. """
+        key = hashlib.sha1('%s %s' % (bundleHash, memberName)).hexdigest()
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, bundleHash, memberName):
+        """ Returns the cached array for the indicated member of the
+        indicated bundle as a read-only memory map, or None if it is
+        not in the cache. """
+
+        filename = self.getFilename(bundleHash, memberName)
+        try:
+            array = numpy.load(filename, mmap_mode = 'r')
+        except IOError:
+            return None
+        except ValueError, e:
+            print "Ignoring unreadable cache file %s: %s" % (filename, e)
+            return None
+
+        # Mark it as recently used.
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        return array
+
+    def store(self, bundleHash, memberName, array):
+        """ Saves the array in the cache for the indicated member of
+        the indicated bundle, evicting older entries as needed. """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Write it under a temporary name and rename it into place, so
+        # a concurrent reader never sees a partial file.
+        filename = self.getFilename(bundleHash, memberName)
+        tempFilename = '%s.%s.tmp' % (filename, os.getpid())
+        file = open(tempFilename, 'wb')
+        numpy.save(file, array)
+        file.close()
+        os.rename(tempFilename, filename)
+
+        self.evict(keep = filename)
+
+    def loadDigests(self, bundleKey):
+        """ Returns the dictionary of member digests saved with
+        storeDigests() for the indicated bundle, or None. """
+
+        filename = self.getDigestsFilename(bundleKey)
+        try:
+            file = open(filename, 'r')
+            digests = json.load(file)
+            file.close()
+        except IOError:
+            return None
+        except ValueError, e:
+            print "Ignoring unreadable cache file %s: %s" % (filename, e)
+            return None
+
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        return digests
+
+    def storeDigests(self, bundleKey, digests):
+        """ Saves the dictionary of member digests for the indicated
+        bundle, which is identified by the string bundleKey. """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        filename = self.getDigestsFilename(bundleKey)
+        tempFilename = '%s.%s.tmp' % (filename, os.getpid())
+        file = open(tempFilename, 'w')
+        json.dump(digests, file)
+        file.close()
+        os.rename(tempFilename, filename)
+
+    def getDigestsFilename(self, bundleKey):
+        key = hashlib.sha1('digests %s' % (bundleKey)).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def evict(self, keep = None):
+        """ Deletes the least recently used files until the cache is
+        no bigger than maxSize.  The file named by keep, if any, is
+        never deleted. """
+
+        entries = []
+        totalSize = 0
+        for name in os.listdir(self.directory):
+            if not (name.endswith('.npy') or name.endswith('.json')):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            totalSize += st.st_size
+
+        entries.sort()
+        for mtime, size, filename in entries:
+            if totalSize <= self.maxSize:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.unlink(filename)
+            except OSError:
+                continue
+            totalSize -= size
@@ -0,0 +1,198 @@
+from OpenGL.GL import *
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v as glGetQueryObjectui64vToBuffer
+import collections
+import atexit
+import ctypes
+import numpy
+import sys
+
+# Set true by enable().  While this is false, GpuTimer.begin() and
+# end() do nothing at all.
+enabled = False
+
+# The number of samples kept for each timer name; the percentiles are
+# computed over only the most recent ones.
+historySize = 1000
+
+# Report the statistics for each timer name after this many samples,
+# or never if this is 0.
+reportInterval = 300
+
+class FrameStatistics:
+    """ The rolling history of GPU times recorded under one name, in
+    nanoseconds.  The first sample of each GpuTimer is kept apart, as
+    a warm-up sample, since it includes one-time driver work. """
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = collections.deque(maxlen = historySize)
+        self.count = 0
+        self.warmupSamples = []
+
+    def addWarmupSample(self, ns):
+        self.warmupSamples.append(ns)
+
+    def addSample(self, ns):
+        self.samples.append(ns)
+        self.count += 1
+        if reportInterval and self.count % reportInterval == 0:
+            print self.getReport()
+
+    def getPercentiles(self):
+        """ Returns a dictionary of the p50, p95 and p99 times, and the
+        mean, of the recent samples, in milliseconds, or None if there
+        are no samples yet. """
+
+        if not self.samples:
+            return None
+        ms = numpy.array(self.samples, dtype = 'float64') / 1e6
+        p50, p95, p99 = numpy.percentile(ms, [50, 95, 99])
+        return {
+            'p50' : p50,
+            'p95' : p95,
+            'p99' : p99,
+            'mean' : ms.mean(),
+            'count' : len(ms),
+            }
+
+    def getWarmupReport(self):
+        """ Returns a description of the warm-up samples, or None if
+        there are none. """
+
+        if not self.warmupSamples:
+            return None
+        ms = numpy.array(self.warmupSamples, dtype = 'float64') / 1e6
+        if len(ms) == 1:
+            return "warm-up %.3f ms" % (ms[0])
+        return "warm-up %.3f ms (max %.3f ms) over %s timers" % (
+            ms.mean(), ms.max(), len(ms))
+
+    def getReport(self):
+        stats = self.getPercentiles()
+        warmup = self.getWarmupReport()
+        if stats is None:
+            if warmup:
+                return "GPU %s: %s, no later frames" % (self.name, warmup)
+            return "GPU %s: no samples" % (self.name)
+        report = "GPU %s: p50 %.3f ms, p95 %.3f ms, p99 %.3f ms over the last %s of %s frames" % (
+            self.name, stats['p50'], stats['p95'], stats['p99'],
+            stats['count'], self.count)
+        if warmup:
+            report += ", %s" % (warmup)
+        return report
+
+# The FrameStatistics for each timer name, shared by all of the
+# GpuTimers with that name.
+statistics = {}
+statisticsNames = []
+
+def getStatistics(name):
+    stats = statistics.get(name, None)
+    if stats is None:
+        stats = FrameStatistics(name)
+        statistics[name] = stats
+        statisticsNames.append(name)
+    return stats
+
+class GpuTimer:
+    """
+    Measures the time the GPU spends on the commands issued between
+    begin() and end(), with a GL_TIME_ELAPSED query, and records it
+    in the FrameStatistics of the indicated name.
+
+    The result of a query is not available until the GPU has finished
+    the commands, so it is never waited for: each call to begin()
+    collects whichever earlier queries have completed, and starts the
+    new one on a query object that is free.  Call finish() to wait for
+    and collect the rest.
+
+    Only one GL_TIME_ELAPSED query may be active at a time, so
+    GpuTimers may not be nested.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = getStatistics(name)
+        self.freeQueries = []
+        self.pendingQueries = []
+        self.activeQuery = None
+
+        # The first result of each timer includes one-time driver
+        # work (and some drivers report garbage for it), so it is
+        # reported separately, as a warm-up sample.
+        self.numWarmupSamples = 0
+
+    def begin(self):
+        if not enabled:
+            return
+
+        self.__collect(False)
+        if self.freeQueries:
+            query = self.freeQueries.pop()
+        else:
+            query = int(glGenQueries(1)[0])
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.activeQuery = query
+
+    def end(self):
+        if self.activeQuery is None:
+            return
+
+        glEndQuery(GL_TIME_ELAPSED)
+        self.pendingQueries.append(self.activeQuery)
+        self.activeQuery = None
+
+    def finish(self):
+        """ Waits for all of the outstanding queries, and records
+        their results. """
+        self.__collect(True)
+
+    def __collect(self, wait):
+        """ Records the results of the pending queries that have
+        completed, oldest first.  If wait is true, waits for all of
+        them. """
+
+        result = ctypes.c_uint64()
+        while self.pendingQueries:
+            query = self.pendingQueries[0]
+            if not wait and not glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE):
+                break
+
+            # PyOpenGL can't allocate the 64-bit result itself, so we
+            # call the raw function with our own.
+            glGetQueryObjectui64vToBuffer(query, GL_QUERY_RESULT, ctypes.byref(result))
+            self.pendingQueries.pop(0)
+            self.freeQueries.append(query)
+
+            if self.numWarmupSamples < 1:
+                self.numWarmupSamples += 1
+                self.stats.addWarmupSample(result.value)
+            else:
+                self.stats.addSample(result.value)
+
+    def releaseGL(self):
+        """ Deletes the query objects, abandoning any results still
+        outstanding. """
+
+        queries = self.freeQueries + self.pendingQueries
+        if queries:
+            glDeleteQueries(queries)
+        self.freeQueries = []
+        self.pendingQueries = []
+        self.activeQuery = None
+
+def enable():
+    """ Starts timing, and arranges for the statistics to be reported
+    when the program exits. """
+
+    global enabled
+    if not enabled:
+        atexit.register(reportAtExit)
+    enabled = True
+
+def report(file = sys.stdout):
+    for name in statisticsNames:
+        print >> file, statistics[name].getReport()
+
+def reportAtExit():
+    report()
@@ -0,0 +1,104 @@
+from PIL import Image
+import threading
+import atexit
+import Queue
+import os
+import sys
+import Profiler
+
+# The number of background threads encoding images, and the number of
+# images that may be waiting for them before write() blocks.
+numWriterThreads = 2
+maxPendingImages = 8
+
+# Set this false to stop the filename of each image from being printed
+# as it is written.
+reportWrites = True
+
+class ImageWriter:
+    """
+    Encodes and saves images in a pool of background threads, so that
+    the renderer doesn't wait on PNG compression and disk I/O.  The
+    queue of pending images is bounded, so a renderer that outpaces
+    the writers is eventually throttled rather than using unbounded
+    memory.
+
+    Each image is written under a temporary name and renamed into
+    place, so the same filename can safely be written repeatedly.
+    """
+
+    def __init__(self, numThreads = None, maxPending = None):
+        if numThreads is None:
+            numThreads = numWriterThreads
+        if maxPending is None:
+            maxPending = maxPendingImages
+
+        self.queue = Queue.Queue(maxPending)
+        self.errors = []
+        self.threads = []
+        for i in range(numThreads):
+            thread = threading.Thread(target = self.__writeImages)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, array, filename, mode = 'RGBA'):
+        """ Queues the indicated image array, of shape (height, width,
+        numChannels), to be saved to filename.  The array must not be
+        modified afterwards. """
+
+        self.queue.put((array, filename, mode))
+
+    def flush(self):
+        """ Waits until all of the queued images have been written.
+        Raises the first error encountered, if any. """
+
+        self.queue.join()
+        if self.errors:
+            errors = self.errors
+            self.errors = []
+            excInfo = errors[0]
+            raise excInfo[0], excInfo[1], excInfo[2]
+
+    def close(self):
+        """ Waits for the queued images to be written, and stops the
+        writer threads. """
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __writeImages(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            array, filename, mode = item
+            try:
+                with Profiler.span('ImageWriter.write', array.nbytes):
+                    img = Image.fromarray(array, mode)
+                    base, ext = os.path.splitext(filename)
+                    tempFilename = '%s.%s.tmp%s' % (base, threading.currentThread().ident, ext)
+                    img.save(tempFilename)
+                    os.rename(tempFilename, filename)
+                if reportWrites:
+                    print filename
+            except:
+                self.errors.append(sys.exc_info())
+            self.queue.task_done()
+
+# The writer shared by all of the warping objects, created on demand.
+defaultWriter = None
+
+def getDefaultWriter():
+    global defaultWriter
+    if defaultWriter is None:
+        defaultWriter = ImageWriter()
+
+        # Stop the threads before the interpreter begins tearing down
+        # the modules they use.
+        atexit.register(defaultWriter.close)
+    return defaultWriter
@@ -0,0 +1,61 @@
+from TextureImage import TextureImage
+import weakref
+import os
+
+# Set this false to give each warp a TextureImage of its own for each
+# media file, as is necessary if the warps draw in OpenGL contexts
+# that don't share their objects.
+shareMedia = True
+
+class MediaLibrary:
+    """
+    Shares media images between all of the warps that show them.  Each
+    media file is represented by one TextureImage, so it is decoded
+    only once, and uploaded as only one texture (see
+    TextureImage.initGL()), no matter how many regions sample it.  The
+    warps must all draw in the same OpenGL context, or in contexts
+    that share their objects.
+
+    The library holds only weak references, so an image is freed as
+    soon as no warp is showing it any more.  A file that has been
+    modified since it was loaded is loaded again.
+    """
+
+    def __init__(self):
+        # The TextureImage for each media file, by getKey().
+        self.media = weakref.WeakValueDictionary()
+
+    def getKey(self, filename):
+        """ Returns the key that identifies the current contents of
+        the indicated file. """
+
+        filename = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            # It will fail to load, but that isn't our concern here.
+            return (filename,)
+        return (filename, st.st_mtime, st.st_size)
+
+    def getMedia(self, filename):
+        """ Returns the TextureImage for the indicated media file,
+        creating it if no warp is showing it already. """
+
+        if not shareMedia:
+            return TextureImage(filename)
+
+        key = self.getKey(filename)
+        media = self.media.get(key, None)
+        if media is None:
+            media = TextureImage(filename)
+            self.media[key] = media
+        return media
+
+# The library shared by all of the warping objects, created on demand.
+defaultLibrary = None
+
+def getDefaultLibrary():
+    global defaultLibrary
+    if defaultLibrary is None:
+        defaultLibrary = MediaLibrary()
+    return defaultLibrary
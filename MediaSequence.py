@@ -0,0 +1,71 @@
+from TextureImage import TextureImage
+import threading
+import Queue
+import glob
+import time
+import os
+import sys
+
+# The file extensions recognized as images when a directory is named
+# as the input sequence.
+imageExtensions = ['.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.tga', '.ppm']
+
+def listMediaSequence(pattern):
+    """ Returns the sorted list of media filenames named by pattern,
+    which may be the name of a directory (in which case all of the
+    image files within it are listed) or a glob pattern. """
+
+    if os.path.isdir(pattern):
+        filenames = []
+        for filename in os.listdir(pattern):
+            if os.path.splitext(filename)[1].lower() in imageExtensions:
+                filenames.append(os.path.join(pattern, filename))
+    else:
+        filenames = glob.glob(pattern)
+
+    filenames.sort()
+    return filenames
+
+class MediaPrefetcher:
+    """
+    Decodes a sequence of media files in a background thread, so that
+    the next frames are ready by the time the renderer wants them.
+
+    Iterating over this object yields a decoded TextureImage for each
+    filename, in order.  At most prefetchCount decoded frames are
+    held ahead of the consumer, which bounds the memory in use.
+    """
+
+    def __init__(self, filenames, prefetchCount = 4):
+        self.filenames = filenames
+        self.queue = Queue.Queue(prefetchCount)
+
+        # The total time, in seconds, the consumer has spent waiting
+        # for a frame to be decoded.
+        self.waitTime = 0.0
+        self.lastWaitTime = 0.0
+
+        self.thread = threading.Thread(target = self.__decodeFrames)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __decodeFrames(self):
+        for filename in self.filenames:
+            try:
+                media = TextureImage(filename)
+                media.getArray()
+                self.queue.put((media, None))
+            except:
+                # Hand the exception on to the consumer, and stop.
+                self.queue.put((None, sys.exc_info()))
+                return
+
+    def __iter__(self):
+        for i in range(len(self.filenames)):
+            start = time.time()
+            media, excInfo = self.queue.get()
+            self.lastWaitTime = time.time() - start
+            self.waitTime += self.lastWaitTime
+            if excInfo:
+                raise excInfo[0], excInfo[1], excInfo[2]
+            yield media
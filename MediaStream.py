@@ -0,0 +1,256 @@
+from TextureImage import TextureImage, textureFormats, textureTypes, textureSrgbFormats
+from OpenGL.GL import *
+import threading
+import Queue
+import ctypes
+import numpy
+import sys
+
+# The number of frames that may be in flight between the producer and
+# the GPU at once.
+numStreamBuffers = 3
+
+# Set this false to stream through ordinary client memory, even if
+# persistently mapped buffers are available.
+usePersistentMapping = True
+
+class MediaStream:
+    """
+    A media texture whose contents are replaced frame by frame, for
+    video playback.  It may be used in place of a TextureImage with
+    MpacsWarp2D.setMediaStream().
+
+    The texture is allocated once, by initGL(), and each new frame is
+    copied into it with glTexSubImage2D.  Frames pass through a ring
+    of numStreamBuffers pixel buffer objects that are mapped
+    persistently (with glBufferStorage), so writeFrame() can copy a
+    frame straight into GPU-visible memory from any thread, with no
+    OpenGL context.  A fence after each upload tells update() when a
+    buffer may be reused.  Without glBufferStorage (before OpenGL
+    4.4), the ring is kept in ordinary numpy arrays instead.
+
+    writeFrame() blocks only while every buffer is in use; update(),
+    called from the drawing thread, never blocks.  If dropFrames is
+    true, update() skips to the newest frame written, as suits live
+    playback; otherwise every frame is shown in turn.
+    """
+
+    def __init__(self, size, numChannels = 3, dtype = 'uint8', dropFrames = True):
+        self.size = size
+        self.numChannels = numChannels
+        self.dtype = numpy.dtype(dtype)
+        self.dropFrames = dropFrames
+
+        self.shape = (size[1], size[0], numChannels)
+        self.frameSize = size[0] * size[1] * numChannels * self.dtype.itemsize
+
+        # The name of the frame most recently uploaded, for
+        # compatibility with TextureImage.
+        self.filename = None
+        self.texobj = None
+
+        # As in TextureImage, set this true before initGL() to use an
+        # sRGB internal format where possible.
+        self.srgb = False
+
+        # The ring of buffers.  Each is either free, holding a frame
+        # that has been written but not uploaded, or being read by the
+        # GPU (with a fence in pendingFences).
+        self.buffers = None
+        self.pointers = None
+        self.freeBuffers = Queue.Queue()
+        self.readyBuffers = Queue.Queue()
+        self.pendingFences = []
+
+        # The number of frames uploaded, and the number skipped
+        # because a newer one was already available.
+        self.numFramesUploaded = 0
+        self.numFramesDropped = 0
+
+        self.producer = None
+        self.producerError = None
+
+    def initGL(self):
+        """ Creates the texture and the ring of buffers.  The
+        producer's writeFrame() calls wait until this has been
+        done. """
+
+        if self.texobj is not None:
+            return
+
+        format = textureFormats[self.numChannels]
+        type, internalFormat = textureTypes[self.dtype.name]
+        internalFormat = internalFormat[self.numChannels]
+        if self.srgb:
+            if self.dtype == numpy.uint8 and self.numChannels in textureSrgbFormats:
+                internalFormat = textureSrgbFormats[self.numChannels]
+            else:
+                self.srgb = False
+        self.format = format
+        self.type = type
+
+        self.texobj = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texobj)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, self.size[0], self.size[1], 0,
+                     format, type, None)
+
+        self.buffers = []
+        self.pointers = []
+        if usePersistentMapping and bool(glBufferStorage):
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            for i in range(numStreamBuffers):
+                pbo = glGenBuffers(1)
+                glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+                glBufferStorage(GL_PIXEL_UNPACK_BUFFER, self.frameSize, None, flags)
+                pointer = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, self.frameSize, flags)
+                self.buffers.append(pbo)
+                self.pointers.append(pointer)
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        else:
+            for i in range(numStreamBuffers):
+                array = numpy.empty(self.shape, dtype = self.dtype)
+                self.buffers.append(array)
+                self.pointers.append(array.ctypes.data)
+
+        for i in range(numStreamBuffers):
+            self.freeBuffers.put(i)
+
+    def releaseGL(self):
+        """ Frees the texture and the buffers.  The producer must have
+        stopped. """
+
+        if self.texobj is None:
+            return
+
+        for fence, i in self.pendingFences:
+            glDeleteSync(fence)
+        self.pendingFences = []
+        for buffer in self.buffers:
+            if not isinstance(buffer, numpy.ndarray):
+                glBindBuffer(GL_PIXEL_UNPACK_BUFFER, buffer)
+                glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+                glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+                glDeleteBuffers(1, [buffer])
+        self.buffers = None
+        self.pointers = None
+        self.freeBuffers = Queue.Queue()
+        self.readyBuffers = Queue.Queue()
+
+        glDeleteTextures([self.texobj])
+        self.texobj = None
+
+    def writeFrame(self, frame, name = None):
+        """ Copies the next frame into a free buffer, waiting for one
+        if necessary.  frame may be a numpy array of shape (ySize,
+        xSize, numChannels), or any object with the buffer interface
+        holding the same data; row 0 is the top of the image.  This
+        may be called from any thread. """
+
+        if isinstance(frame, numpy.ndarray):
+            array = frame
+        else:
+            array = numpy.frombuffer(frame, dtype = self.dtype)
+        array = numpy.ascontiguousarray(array, dtype = self.dtype.newbyteorder('='))
+        if array.size != self.frameSize / self.dtype.itemsize:
+            raise ValueError, 'Frame is the wrong size for the media stream'
+
+        i = self.freeBuffers.get()
+        ctypes.memmove(self.pointers[i], array.ctypes.data, self.frameSize)
+        self.readyBuffers.put((i, name))
+
+    def startProducer(self, frames):
+        """ Starts a background thread that writes each of frames in
+        turn: numpy arrays, buffer objects, or TextureImages (which
+        are decoded in the thread).  Errors are raised by the next
+        call to update(). """
+
+        self.producer = threading.Thread(target = self.__produceFrames, args = (frames,))
+        self.producer.setDaemon(True)
+        self.producer.start()
+
+    def __produceFrames(self, frames):
+        try:
+            for frame in frames:
+                name = None
+                if isinstance(frame, TextureImage):
+                    name = frame.filename
+                    frame = frame.getArray()
+                self.writeFrame(frame, name)
+        except:
+            self.producerError = sys.exc_info()
+
+    def update(self):
+        """ Uploads the next frame written by the producer into the
+        texture, if there is one, and recycles the buffers that the
+        GPU has finished with.  Returns true if the texture changed.
+        This never waits for the producer. """
+
+        if self.producerError:
+            excInfo = self.producerError
+            self.producerError = None
+            raise excInfo[0], excInfo[1], excInfo[2]
+
+        self.__recycleBuffers()
+
+        try:
+            i, name = self.readyBuffers.get_nowait()
+        except Queue.Empty:
+            return False
+
+        if self.dropFrames:
+            # Skip ahead to the newest frame; the older ones were never
+            # seen by the GPU, so their buffers are free right away.
+            while True:
+                try:
+                    newer = self.readyBuffers.get_nowait()
+                except Queue.Empty:
+                    break
+                self.freeBuffers.put(i)
+                self.numFramesDropped += 1
+                i, name = newer
+
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glBindTexture(GL_TEXTURE_2D, self.texobj)
+        buffer = self.buffers[i]
+        if isinstance(buffer, numpy.ndarray):
+            # Client memory is copied before glTexSubImage2D returns.
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.size[0], self.size[1],
+                            self.format, self.type, buffer)
+            self.freeBuffers.put(i)
+        else:
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, buffer)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.size[0], self.size[1],
+                            self.format, self.type, ctypes.c_void_p(0))
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+            fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            self.pendingFences.append((fence, i))
+
+        self.filename = name
+        self.numFramesUploaded += 1
+        return True
+
+    def __recycleBuffers(self):
+        """ Returns to the free list each buffer whose upload the GPU
+        has completed. """
+
+        while self.pendingFences:
+            fence, i = self.pendingFences[0]
+            result = glClientWaitSync(fence, 0, 0)
+            if result not in [GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED]:
+                break
+            glDeleteSync(fence)
+            self.pendingFences.pop(0)
+            self.freeBuffers.put(i)
+
+    def apply(self):
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, self.texobj)
+        glEnable(GL_TEXTURE_2D)
+
+    def getCropMat(self):
+        # The stream always holds the whole of each frame.
+        return numpy.identity(4)
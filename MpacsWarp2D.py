@@ -1,8 +1,44 @@
-from TextureImage import TextureImage
+import TextureImage
+import MediaLibrary
+import ImageWriter
+import Profiler
 from OpenGL.GL import *
-from PIL import Image
+from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as glReadPixelsToBuffer
+import numpy
+import ctypes
+import math
 import sys
 
+# The number of pixel buffer objects cycled through by
+# saveOutputImage().  Each frame's pixels are read into the next
+# buffer asynchronously, and only copied out once numReadbackBuffers -
+# 1 more frames have been rendered.
+numReadbackBuffers = 2
+
+# Set this false to upload the whole of the media for every region,
+# instead of only the rectangle that the region samples.
+cropMedia = True
+
+# The media is cropped to a region only if the crop is no bigger than
+# this fraction of the whole image, since a crop can't be shared with
+# the other regions showing the same media (or if the whole image
+# wouldn't fit in a texture, but the crop would).
+maxCropFraction = 0.5
+
+# The number of extra texels kept around the sampled rectangle of the
+# media, for the bilinear filter.
+cropPadding = 2
+
+# The margin, in UV units, also kept around the sampled rectangle,
+# since the warp may be drawn from a map of half floats (see
+# MpacsWarp2DShader.renderMapFormats), which round UV's near 1.0 by up
+# to this much.
+cropUVMargin = 1.0 / 2048
+
+# The UV bound given to the outer edges of the outermost tiles of the
+# media, which have no neighbor to leave the rest to.
+tileUVLimit = 1.0e6
+
 class MpacsWarp2D:
     """ The base class for performing warping in the "2d" profile
     specified in the mpcdi file.  This warps media according to a 2-d
@@ -16,12 +52,7 @@ class MpacsWarp2D:
         assert self.mpcdi.profile == '2d'
 
         self.windowSize = self.region.Xresolution, self.region.Yresolution
-
-        self.mediaFilename = None
-        self.media = None
-
-        self.outputFilename = None
-        self.includeBlend = True
+        self.initWarpState()
 
         self.pfm = self.mpcdi.extractPfmFile(self.region.geometryWarpFile.path)
 
@@ -32,7 +63,7 @@ class MpacsWarp2D:
             # This is the gamma value of the embedded alpha map.
             self.alphaGamma = self.region.alphaMap.gammaEmbedded
         else:
-            self.alpha = TextureImage(flat = ('L', (self.pfm.xSize, self.pfm.ySize), 255))
+            self.alpha = TextureImage.TextureImage(flat = ('L', (self.pfm.xSize, self.pfm.ySize), 255))
             self.alphaGamma = 1.0
 
         # If a beta map is included, it is a "black level uplift" map,
@@ -42,7 +73,7 @@ class MpacsWarp2D:
             # This is the gamma value of the embedded beta map.
             self.betaGamma = self.region.betaMap.gammaEmbedded
         else:
-            self.beta = TextureImage(flat = ('L', (self.pfm.xSize, self.pfm.ySize), 0))
+            self.beta = TextureImage.TextureImage(flat = ('L', (self.pfm.xSize, self.pfm.ySize), 0))
             self.betaGamma = 1.0
 
 
@@ -52,29 +83,459 @@ class MpacsWarp2D:
         # This is the gamma value of the source media image.
         self.mediaGamma = self.alphaGamma
 
+    def initWarpState(self):
+        """ Sets up the media, output and OpenGL state that every warp
+        keeps, apart from its region.  This is called by the
+        constructor, and by that of any subclass (such as
+        MpacsWarp2DAtlas) that doesn't call it. """
+
+        self.mediaFilename = None
+        self.media = None
+
+        # If the rectangle of the media that the region samples is too
+        # large for one texture, it is uploaded in several tiles
+        # instead: this is a list of (tile, bounds), where each tile
+        # is a crop of the media and bounds is the rectangle (u0, v0,
+        # u1, v1) of media UV's that it draws.  See canTileMedia().
+        self.mediaTiles = None
+
+        # If this is set, the media is a MediaStream, and is updated
+        # with the latest frame each time the warp is drawn.
+        self.mediaStream = None
+
+        self.outputFilename = None
+        self.includeBlend = True
+
+        # The ring of pixel buffer objects used by saveOutputImage(),
+        # and the output filename pending in each one.
+        self.readbackBuffers = None
+        self.readbackFilenames = None
+        self.readbackIndex = 0
+        self.readbackSize = None
+
+        # Set true once initGL() has been called.
+        self.glInitialized = False
+
+        # The GpuTimer that measures each draw(), if the subclass
+        # supports one.
+        self.gpuTimer = None
+
+        # The range of media texture coordinates the pfm grid covers;
+        # see getMediaUVBounds().
+        self.mediaUVBounds = None
+
+    def getWarpMat(self):
+        """ Returns the 4x4 matrix that transforms the UV's stored in
+        the pfm file into texture coordinates within the media. """
+
+        # A matrix to scale the warping UV's into the correct range
+        # specified by the Region (as defined in the mpcdi.xml file).
+        rangeMat = numpy.array(
+            [[self.region.xsize, 0, 0, 0],
+             [0, self.region.ysize, 0, 0],
+             [0, 0, 1, 0],
+             [self.region.x, self.region.y, 0, 1]])
+
+        # We also need to flip the V axis to match OpenGL's texturing
+        # convention.  (Or we could have loaded the media file in
+        # upside-down.)
+        flipMat = numpy.array(
+            [[1, 0, 0, 0],
+             [0, -1, 0, 0],
+             [0, 0, 1, 0],
+             [0, 1, 0, 1]])
+
+        # Accumulate them both into the single warping matrix.
+        return rangeMat.dot(flipMat)
+
+    def computeMediaUVs(self):
+        """ Computes, on the CPU, the media texture coordinate seen by
+        the center of each pixel of the output window.  This is the
+        first step of the two-step lookup performed by the shader.
+        Returns (u, v, pfmX, pfmY), each an array of shape (height,
+        width): u and v are the transformed media coordinates, and
+        pfmX and pfmY are the corresponding pixel coordinates within
+        the pfm grid (which also index the alpha and beta maps). """
+
+        width, height = self.windowSize
+        xSize = self.pfm.xSize
+        ySize = self.pfm.ySize
+
+        # The unit quad is drawn with texture coordinates that match
+        # its vertices, so each window pixel samples the pfm texture
+        # at its own normalized center.
+        s = (numpy.arange(width, dtype = 'float32') + 0.5) / width
+        t = (numpy.arange(height, dtype = 'float32') + 0.5) / height
+        pfmX, pfmY = numpy.meshgrid(s * xSize - 0.5, t * ySize - 0.5)
+
+        uvs = self.pfm.getArray()[:,:,0:2]
+        uv = sampleBilinear(uvs, pfmX, pfmY)
+
+        # Apply the warping matrix.  The matrix is handed to OpenGL
+        # untransposed, so it acts on row vectors (u, v, 0, 1).
+        warpMat = self.getWarpMat()
+        u = uv[:,:,0] * warpMat[0, 0] + uv[:,:,1] * warpMat[1, 0] + warpMat[3, 0]
+        v = uv[:,:,0] * warpMat[0, 1] + uv[:,:,1] * warpMat[1, 1] + warpMat[3, 1]
+
+        return u, v, pfmX, pfmY
+
+    def getMediaUVBounds(self):
+        """ Returns (u0, v0, u1, v1), the range of media texture
+        coordinates that the region samples, or None if the pfm grid
+        has no valid UV's at all.  The UV's between the grid points
+        are interpolated, so they can't fall outside the range of the
+        grid points themselves.  This is computed only once. """
+
+        if self.mediaUVBounds is None:
+            uvs = self.pfm.getArray()
+            warpMat = self.getWarpMat()
+            u = uvs[:,:,0] * warpMat[0, 0] + uvs[:,:,1] * warpMat[1, 0] + warpMat[3, 0]
+            v = uvs[:,:,0] * warpMat[0, 1] + uvs[:,:,1] * warpMat[1, 1] + warpMat[3, 1]
+            valid = ~(numpy.isnan(u) | numpy.isnan(v))
+            if not valid.any():
+                self.mediaUVBounds = ()
+            else:
+                self.mediaUVBounds = (float(u[valid].min()), float(v[valid].min()),
+                                      float(u[valid].max()), float(v[valid].max()))
+
+        return self.mediaUVBounds or None
+
+    def getMediaCrop(self, mediaSize):
+        """ Returns the rectangle (x, y, width, height) of a media
+        image of the indicated size (xSize, ySize) that the region
+        samples, in pixels with y measured from the top row, with a
+        margin of cropUVMargin plus cropPadding texels; or None if it
+        samples none of it.  (V runs from the top row down, in the
+        media texture.) """
+
+        bounds = self.getMediaUVBounds()
+        if bounds is None:
+            return None
+
+        u0, v0, u1, v1 = bounds
+        u0 -= cropUVMargin
+        v0 -= cropUVMargin
+        u1 += cropUVMargin
+        v1 += cropUVMargin
+        xSize, ySize = mediaSize
+        x0 = max(int(math.floor(u0 * xSize)) - cropPadding, 0)
+        y0 = max(int(math.floor(v0 * ySize)) - cropPadding, 0)
+        x1 = min(int(math.ceil(u1 * xSize)) + cropPadding, xSize)
+        y1 = min(int(math.ceil(v1 * ySize)) + cropPadding, ySize)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (x0, y0, x1 - x0, y1 - y0)
+
     def setWindowSize(self, windowSize):
         self.windowSize = windowSize
 
     def setMediaFilename(self, mediaFilename):
+        """ Shows the indicated media file.  The TextureImage (and
+        its texture) is shared with any other warp showing the same
+        file; see MediaLibrary. """
         self.mediaFilename = mediaFilename
-        self.media = TextureImage(self.mediaFilename)
+        self.media = MediaLibrary.getDefaultLibrary().getMedia(self.mediaFilename)
+
+    def setMedia(self, media):
+        """ Replaces the media with the indicated TextureImage, which
+        may be shared with other warps.  If initGL() has already been
+        called, the new media is uploaded right away (unless it
+        already has been), and the texture of the previous media is
+        released; the rest of the OpenGL state is kept. """
+
+        previous = self.media
+        previousTiles = self.mediaTiles
+        self.mediaFilename = media.filename
+        self.media = media
+
+        if self.glInitialized:
+            # Take up the new media before releasing the old, in case
+            # they are the same.
+            self.__initMediaGL()
+            self.__releaseMediaGL(previous, previousTiles)
+
+    def setMediaStream(self, stream):
+        """ Replaces the media with the indicated MediaStream, whose
+        texture is updated in place with the newest frame available
+        each time the warp is drawn.  See updateMedia().  This is
+        supported by the OpenGL implementations only. """
+
+        previous = self.media
+        previousTiles = self.mediaTiles
+        self.mediaFilename = None
+        self.media = stream
+        self.mediaStream = stream
+        self.mediaTiles = None
+
+        if self.glInitialized:
+            if previous is not stream:
+                self.__releaseMediaGL(previous, previousTiles)
+            stream.srgb = self.wantsSrgbMedia()
+            stream.initGL()
+
+    def updateMedia(self):
+        """ Uploads the next frame of the media stream, if any.  This
+        is called at the start of draw(). """
+
+        if self.mediaStream and self.mediaStream.update():
+            self.mediaFilename = self.mediaStream.filename
 
     def setOutputFilename(self, outputFilename):
         self.outputFilename = outputFilename
 
+    @Profiler.profiled('MpacsWarp2D.readback')
     def saveOutputImage(self):
-        """ Saves a screenshot to the indicated filename for reference. """
+        """ Saves a screenshot to the indicated filename for
+        reference.  The pixels are read back through a ring of pixel
+        buffer objects, so this doesn't wait for the frame to finish
+        rendering; the previous frame's pixels are collected instead,
+        and handed to a background thread to be encoded and saved.
+        Call finishOutput() to collect and save all outstanding
+        frames. """
+
         if not self.outputFilename:
             return
 
-        external_format = GL_RGBA
-        component_type = GL_UNSIGNED_BYTE
         width, height = self.windowSize
-        buffer = glReadPixels(0, 0, width, height, external_format, component_type)
-        img = Image.frombytes(mode="RGBA", size=(width, height), data = buffer)
-        img = img.transpose(Image.FLIP_TOP_BOTTOM)
-        img.save(self.outputFilename)
-        print self.outputFilename
+        if self.readbackBuffers is None:
+            self.readbackBuffers = [glGenBuffers(1) for i in range(numReadbackBuffers)]
+            self.readbackFilenames = [None] * numReadbackBuffers
+
+        if self.readbackSize != (width, height):
+            # (Re)allocate the buffers for the current window size,
+            # after collecting anything still in them.
+            self.__collectAllReadbacks()
+            for pbo in self.readbackBuffers:
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+                glBufferData(GL_PIXEL_PACK_BUFFER, width * height * 4, None, GL_STREAM_READ)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            self.readbackSize = (width, height)
+
+        # Start reading this frame into the next buffer, collecting
+        # the frame already in it first if necessary.
+        i = self.readbackIndex
+        if self.readbackFilenames[i]:
+            self.__collectReadback(i)
+
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.readbackBuffers[i])
+        glReadPixelsToBuffer(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.readbackFilenames[i] = self.outputFilename
+
+        # Now collect the oldest frame still in flight, which has had
+        # a whole frame's time to arrive.
+        self.readbackIndex = (i + 1) % numReadbackBuffers
+        if self.readbackFilenames[self.readbackIndex] and numReadbackBuffers > 1:
+            self.__collectReadback(self.readbackIndex)
+
+    @Profiler.profiled('MpacsWarp2D.collectReadback')
+    def __collectReadback(self, i):
+        """ Copies the pixels out of the indicated pixel buffer
+        object, and queues them to be saved. """
+
+        width, height = self.readbackSize
+        array = numpy.empty((height, width, 4), dtype = 'uint8')
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.readbackBuffers[i])
+        pointer = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        ctypes.memmove(array.ctypes.data, pointer, array.nbytes)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        # OpenGL returns the bottom row first.
+        array = array[::-1]
+
+        ImageWriter.getDefaultWriter().write(array, self.readbackFilenames[i])
+        self.readbackFilenames[i] = None
+
+    def __collectAllReadbacks(self):
+        """ Collects all of the frames still in the pixel buffer
+        objects, oldest first. """
+
+        for j in range(numReadbackBuffers):
+            i = (self.readbackIndex + j) % numReadbackBuffers
+            if self.readbackFilenames[i]:
+                self.__collectReadback(i)
+
+    def finishOutput(self):
+        """ Saves any frames still pending from saveOutputImage(), and
+        waits for them to be written to disk. """
+
+        if self.readbackFilenames:
+            self.__collectAllReadbacks()
+        if self.gpuTimer:
+            self.gpuTimer.finish()
+
+        ImageWriter.getDefaultWriter().flush()
+
+    def wantsSrgbMedia(self):
+        """ Returns true if the media should be uploaded with an sRGB
+        texture format, so that it is linearized as it is sampled.
+        Only the subclasses that can take advantage of this return
+        true. """
+        return False
+
+    def canDrawSrgbMedia(self):
+        """ Returns true if this warp draws correctly with media that
+        has been uploaded with an sRGB texture format, whether or not
+        it asked for one; see __initMediaGL(). """
+        return False
+
+    def canCropMedia(self):
+        """ Returns true if this warp draws correctly with media that
+        has been cropped with TextureImage.crop(), by applying the
+        media's getCropMat().  Only the subclasses that do return
+        true. """
+        return False
+
+    def canTileMedia(self):
+        """ Returns true if this warp can draw the media from the
+        several tiles of mediaTiles, when the rectangle it samples is
+        too large for one texture.  Otherwise, such media is
+        downsampled to fit, losing detail.  Only the subclasses that
+        can return true. """
+        return False
+
+    def __chooseMediaCrop(self):
+        """ Returns the rectangle to crop the media to before it is
+        uploaded, or None to upload all of it. """
+
+        if not cropMedia or not self.canCropMedia() or \
+           not isinstance(self.media, TextureImage.TextureImage) or \
+           self.media.cropRect is not None or \
+           TextureImage.useMipmapping:
+            # The mipmaps of a crop wouldn't be quite the same as
+            # those of the whole image.
+            return None
+
+        array = self.media.getArray()
+        ySize, xSize = array.shape[:2]
+        rect = self.getMediaCrop((xSize, ySize))
+        if rect is None:
+            return None
+
+        x, y, width, height = rect
+        if width * height <= maxCropFraction * xSize * ySize:
+            return rect
+
+        maxTextureSize = glGetIntegerv(GL_MAX_TEXTURE_SIZE)
+        if max(xSize, ySize) > maxTextureSize:
+            # It would have to be tiled or resized anyway; the less
+            # the better.
+            return rect
+
+        return None
+
+    def __chooseMediaTiles(self, rect):
+        """ Returns the tiles to split the indicated rectangle of the
+        media into, as a list of (tileRect, bounds) as in mediaTiles,
+        or None if it fits in one texture (or can't be tiled).  Each
+        tile draws an equal share of the rectangle, and holds
+        cropPadding more texels around it for the bilinear filter. """
+
+        x, y, width, height = rect
+        maxTextureSize = glGetIntegerv(GL_MAX_TEXTURE_SIZE)
+        if not self.canTileMedia() or max(width, height) <= maxTextureSize:
+            return None
+
+        ySize, xSize = self.media.getArray().shape[:2]
+        tileSize = maxTextureSize - 2 * cropPadding
+        xEdges = splitRange(x, width, tileSize)
+        yEdges = splitRange(y, height, tileSize)
+
+        tiles = []
+        for j in range(len(yEdges) - 1):
+            y0 = max(yEdges[j] - cropPadding, 0)
+            y1 = min(yEdges[j + 1] + cropPadding, ySize)
+            v0 = float(yEdges[j]) / ySize if j > 0 else -tileUVLimit
+            v1 = float(yEdges[j + 1]) / ySize if j < len(yEdges) - 2 else tileUVLimit
+            for i in range(len(xEdges) - 1):
+                x0 = max(xEdges[i] - cropPadding, 0)
+                x1 = min(xEdges[i + 1] + cropPadding, xSize)
+                u0 = float(xEdges[i]) / xSize if i > 0 else -tileUVLimit
+                u1 = float(xEdges[i + 1]) / xSize if i < len(xEdges) - 2 else tileUVLimit
+                tiles.append(((x0, y0, x1 - x0, y1 - y0), (u0, v0, u1, v1)))
+
+        return tiles
+
+    def __initMediaImage(self, image):
+        """ Uploads the indicated image of the media, if it hasn't
+        already been, and returns the image to draw with. """
+
+        if image.texobj is None:
+            image.srgb = self.wantsSrgbMedia()
+        elif image.srgb and not self.canDrawSrgbMedia():
+            image = image.copy()
+        image.initGL()
+        return image
+
+    def __releaseMediaGL(self, media, tiles):
+        """ Releases the textures of media (and its tiles, if any)
+        that has been replaced. """
+
+        if tiles:
+            for tile, bounds in tiles:
+                tile.releaseGL()
+        elif media:
+            media.releaseGL()
+
+    def __initMediaGL(self):
+        """ Uploads the media, or shares the texture already uploaded
+        for another warp showing it.  The first warp to upload it
+        decides whether it is sRGB-encoded; a warp that can't draw
+        with an sRGB texture uploaded by another takes a copy of its
+        own instead.  If the region samples only a small part of the
+        media, only that part is uploaded, for this warp alone; if
+        that part is still too large for one texture, it is uploaded
+        in tiles, where the warp supports it. """
+
+        self.mediaTiles = None
+        rect = self.__chooseMediaCrop()
+        if rect is not None:
+            tiles = self.__chooseMediaTiles(rect)
+            if tiles:
+                self.mediaTiles = [(self.__initMediaImage(self.media.crop(tileRect)), bounds)
+                                   for tileRect, bounds in tiles]
+                return
+            self.media = self.media.crop(rect)
+
+        self.media = self.__initMediaImage(self.media)
 
     def initGL(self):
-        self.media.initGL()
+        self.glInitialized = True
+        if self.media:
+            self.__initMediaGL()
+
+def splitRange(start, length, maxLength):
+    """ Splits the range of integers [start, start + length) into the
+    fewest equal parts no longer than maxLength, and returns the
+    boundaries between them, including start and start + length. """
+
+    count = (length + maxLength - 1) // maxLength
+    return [start + (length * i) // count for i in range(count + 1)]
+
+def sampleBilinear(image, x, y):
+    """ Samples image, an array of shape (ySize, xSize, numComponents),
+    at the pixel coordinates (x, y) with bilinear filtering, clamping
+    to the edge texels as GL_CLAMP_TO_EDGE does.  Pixel centers are
+    at integer coordinates.  Returns an array of shape x.shape +
+    (numComponents,); NaN coordinates produce NaN results. """
+
+    ySize, xSize = image.shape[:2]
+    valid = ~(numpy.isnan(x) | numpy.isnan(y))
+    x = numpy.clip(numpy.where(valid, x, 0), 0, xSize - 1)
+    y = numpy.clip(numpy.where(valid, y, 0), 0, ySize - 1)
+
+    x0 = numpy.minimum(x.astype('int32'), xSize - 2 if xSize > 1 else 0)
+    y0 = numpy.minimum(y.astype('int32'), ySize - 2 if ySize > 1 else 0)
+    x1 = numpy.minimum(x0 + 1, xSize - 1)
+    y1 = numpy.minimum(y0 + 1, ySize - 1)
+    fx = (x - x0)[..., numpy.newaxis]
+    fy = (y - y0)[..., numpy.newaxis]
+
+    top = image[y0, x0] * (1 - fx) + image[y0, x1] * fx
+    bottom = image[y1, x0] * (1 - fx) + image[y1, x1] * fx
+    result = top * (1 - fy) + bottom * fy
+    result[~valid] = numpy.nan
+    return result
@@ -0,0 +1,169 @@
+from MpacsWarp2D import MpacsWarp2D
+from OpenGL.GL import *
+
+class MpacsWarp2DAtlas(MpacsWarp2D):
+    """
+    Renders all of the regions of one buffer into a single window (or
+    framebuffer object), each region within its own viewport, so that
+    a frame costs one pass and one readback rather than one of each
+    per region.  All of the regions sample the same media texture.
+
+    Each region is still warped by its own MpacsWarp2DShader or
+    MpacsWarp2DFixedFunction object (of the class given by
+    warpClass); these are available in self.warps, in file order, for
+    setting per-region parameters before initGL() is called.
+
+    The regions are arranged according to layout:
+
+    'packed' - Each region is drawn at its own resolution, without
+    overlapping: the regions at the same y position within the
+    buffer form one row of the atlas, ordered by their x position.
+    Each viewport holds exactly the image that the region would
+    render on its own.
+
+    'buffer' - Each region is drawn into its own rectangle of the
+    buffer (x, y, xsize and ysize scaled by the buffer resolution), so
+    the atlas is the same size as the buffer.  Where regions overlap,
+    the later region in the file is drawn on top.
+    """
+
+    def __init__(self, mpcdi, bufferId, warpClass, layout = 'packed'):
+        self.mpcdi = mpcdi
+        self.buffer = mpcdi.buffers[bufferId]
+        self.layout = layout
+
+        self.warps = []
+        for regionId in mpcdi.regionIdList:
+            if mpcdi.regionIndex[regionId].buffer.id == bufferId:
+                self.warps.append(warpClass(mpcdi, mpcdi.getRegion(regionId)))
+        if not self.warps:
+            raise StandardError, 'No regions in buffer %s' % (bufferId)
+
+        # The rectangle of each warp within the atlas, as (x, y,
+        # width, height) in pixels, with y measured from the top.
+        if layout == 'packed':
+            self.viewports, self.atlasSize = self.__makePackedLayout()
+        elif layout == 'buffer':
+            self.viewports, self.atlasSize = self.__makeBufferLayout()
+        else:
+            raise StandardError, 'Unknown atlas layout %s' % (layout)
+
+        self.windowSize = self.atlasSize
+        self.initWarpState()
+
+    def __makePackedLayout(self):
+        rows = {}
+        for warp in self.warps:
+            rows.setdefault(warp.region.y, []).append(warp)
+
+        positions = {}
+        width = 0
+        top = 0
+        for y in sorted(rows.keys()):
+            row = sorted(rows[y], key = lambda warp: warp.region.x)
+            left = 0
+            rowHeight = 0
+            for warp in row:
+                positions[warp] = (left, top) + tuple(warp.windowSize)
+                left += warp.windowSize[0]
+                rowHeight = max(rowHeight, warp.windowSize[1])
+            width = max(width, left)
+            top += rowHeight
+
+        viewports = [positions[warp] for warp in self.warps]
+        return viewports, (width, top)
+
+    def __makeBufferLayout(self):
+        bufferX = self.buffer.Xresolution
+        bufferY = self.buffer.Yresolution
+
+        viewports = []
+        for warp in self.warps:
+            region = warp.region
+            left = int(round(region.x * bufferX))
+            top = int(round(region.y * bufferY))
+            right = int(round((region.x + region.xsize) * bufferX))
+            bottom = int(round((region.y + region.ysize) * bufferY))
+            viewports.append((left, top, right - left, bottom - top))
+
+        return viewports, (bufferX, bufferY)
+
+    def getViewport(self, regionId):
+        """ Returns the rectangle (x, y, width, height) of the
+        indicated region within the atlas, in pixels, with y measured
+        from the top. """
+
+        for warp, viewport in zip(self.warps, self.viewports):
+            if warp.region.id == regionId:
+                return viewport
+        raise KeyError, regionId
+
+    def initGL(self):
+        # The shared media texture is created only once, here; each
+        # warp simply draws with it.
+        MpacsWarp2D.initGL(self)
+        for warp in self.warps:
+            warp.media = None
+            warp.initGL()
+            warp.media = self.media
+
+    def wantsSrgbMedia(self):
+        # The media is shared, so it can be sRGB only if every region
+        # can use it that way.
+        for warp in self.warps:
+            if not warp.wantsSrgbMedia():
+                return False
+        return True
+
+    def canDrawSrgbMedia(self):
+        for warp in self.warps:
+            if not warp.canDrawSrgbMedia():
+                return False
+        return True
+
+    def setMedia(self, media):
+        MpacsWarp2D.setMedia(self, media)
+        for warp in self.warps:
+            warp.media = self.media
+
+    def setMediaFilename(self, mediaFilename):
+        MpacsWarp2D.setMediaFilename(self, mediaFilename)
+        for warp in self.warps:
+            warp.media = self.media
+
+    def setMediaStream(self, stream):
+        # The atlas updates the stream once per frame, so all of the
+        # regions see the same frame; the warps only draw with it.
+        MpacsWarp2D.setMediaStream(self, stream)
+        for warp in self.warps:
+            warp.media = self.media
+
+    def finishOutput(self):
+        MpacsWarp2D.finishOutput(self)
+        for warp in self.warps:
+            if warp.gpuTimer:
+                warp.gpuTimer.finish()
+
+    def draw(self):
+        self.updateMedia()
+
+        width, height = self.windowSize
+        xScale = float(width) / float(self.atlasSize[0])
+        yScale = float(height) / float(self.atlasSize[1])
+
+        glPushAttrib(GL_VIEWPORT_BIT | GL_SCISSOR_BIT)
+        glEnable(GL_SCISSOR_TEST)
+        for warp, (x, y, w, h) in zip(self.warps, self.viewports):
+            x0 = int(round(x * xScale))
+            x1 = int(round((x + w) * xScale))
+            y0 = int(round(y * yScale))
+            y1 = int(round((y + h) * yScale))
+            # OpenGL measures y from the bottom of the window.
+            y0, y1 = height - y1, height - y0
+
+            glViewport(x0, y0, x1 - x0, y1 - y0)
+            glScissor(x0, y0, x1 - x0, y1 - y0)
+            warp.draw()
+        glPopAttrib()
+
+        self.saveOutputImage()
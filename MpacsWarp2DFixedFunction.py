@@ -1,7 +1,9 @@
 from MpacsWarp2D import MpacsWarp2D
 from BlendQuad import BlendQuad
+from WarpMesh import WarpMesh
+from GpuTimer import GpuTimer
 from OpenGL.GL import *
-import numpy
+import Profiler
 
 class MpacsWarp2DFixedFunction(MpacsWarp2D):
     """
@@ -16,73 +18,71 @@ class MpacsWarp2DFixedFunction(MpacsWarp2D):
         MpacsWarp2D.__init__(self, mpcdi, region)
 
         self.blendCard = BlendQuad(self.alpha)
+        self.gpuTimer = GpuTimer('MpacsWarp2DFixedFunction.draw')
+
+        # If this is set, the mesh is decimated to within this
+        # tolerance, in media UV units; see WarpMesh.
+        self.meshTolerance = None
+
+        # If this is true, cells with NaN UV's are culled from the
+        # mesh, and the rest is drawn as triangle strips.
+        self.useStrips = False
 
         # We don't attempt to do beta-map processing in the
         # fixed-function renderer, only alpha-map processing.
 
+    def canCropMedia(self):
+        return True
+
+    @Profiler.profiled('MpacsWarp2DFixedFunction.initGL')
     def initGL(self):
         MpacsWarp2D.initGL(self)
         self.blendCard.initGL()
 
-        xSize = self.pfm.xSize
-        ySize = self.pfm.ySize
-
-        # Discard every third element of the UV data, which is mostly
-        # NaN's and isn't really useful, and can confuse OpenGL into
-        # ignoring the first two.
-        uv_list = numpy.fromstring(self.pfm.data, dtype = 'float32')
-        uvs3 = numpy.reshape(uv_list, (-1, 3), 'C')
-        uvs = uvs3[:,0:2]
+        # Build the mesh from the pfm grid.
+        with Profiler.span('WarpMesh.build'):
+            self.mesh = WarpMesh(self.pfm, tolerance = self.meshTolerance,
+                                 useStrips = self.useStrips)
+        if self.meshTolerance or self.useStrips:
+            print "%s mesh: %s" % (self.region.id, self.mesh.getReport())
 
         self.uvdata = glGenBuffers(1)
         glBindBuffer(GL_ARRAY_BUFFER, self.uvdata)
-        glBufferData(GL_ARRAY_BUFFER, uvs, GL_STATIC_DRAW)
-
-        verts = []
-        xScale = 1.0 / float(xSize)
-        yScale = 1.0 / float(ySize)
-        for yi in range(ySize):
-            for xi in range(xSize):
-                verts.append((float(xi) + 0.5) * xScale)
-                verts.append((float(yi) + 0.5) * yScale)
-
-        self.numVertices = len(verts) / 2
-        verts = numpy.array(verts, dtype = 'float32')
+        glBufferData(GL_ARRAY_BUFFER, self.mesh.uvs, GL_STATIC_DRAW)
 
+        self.numVertices = self.mesh.numVertices
         self.vertdata = glGenBuffers(1)
         glBindBuffer(GL_ARRAY_BUFFER, self.vertdata)
-        glBufferData(GL_ARRAY_BUFFER, verts, GL_STATIC_DRAW)
+        glBufferData(GL_ARRAY_BUFFER, self.mesh.verts, GL_STATIC_DRAW)
 
-        ## def has_point(xi, yi):
-        ##     if xi < xSize and y < ySize and
-
-        tris = []
-        for yi in range(ySize - 1):
-            for xi in range(xSize - 1):
-                vi0 = ((xi) + (yi) * xSize);
-                vi1 = ((xi) + (yi + 1) * xSize);
-                vi2 = ((xi + 1) + (yi + 1) * xSize);
-                vi3 = ((xi + 1) + (yi) * xSize);
-
-                tris += [vi2, vi0, vi1]
-                tris += [vi3, vi0, vi2]
-
-        self.numIndices = len(tris)
-        tris = numpy.array(tris, dtype = 'int32')
+        self.numIndices = self.mesh.numIndices
         self.idata = glGenBuffers(1)
         glBindBuffer(GL_ARRAY_BUFFER, self.idata)
-        glBufferData(GL_ARRAY_BUFFER, tris, GL_STATIC_DRAW)
+        glBufferData(GL_ARRAY_BUFFER, self.mesh.indices, GL_STATIC_DRAW)
 
+    @Profiler.profiled('MpacsWarp2DFixedFunction.draw')
     def draw(self):
+        self.updateMedia()
+
+        # The timer covers both the mesh and the blend card.
+        self.gpuTimer.begin()
         glPushAttrib(GL_ENABLE_BIT)
         glPushClientAttrib(GL_CLIENT_ALL_ATTRIB_BITS)
 
-        # First, draw the mesh with the media texture applied.
-
+        # First, draw the mesh with the media texture applied.  The
+        # texture matrix belongs to the active texture unit, so make
+        # sure that is the unit the media is applied to.
+        glActiveTexture(GL_TEXTURE0)
         glMatrixMode(GL_TEXTURE)
         glPushMatrix()
         glLoadIdentity()
 
+        # The media texture may hold only the part of the media that
+        # this region samples, so the final step maps into that.
+        # (OpenGL reads the matrix column-major, which turns our
+        # row-vector matrix into the column-vector one it needs.)
+        glMultMatrixd(self.media.getCropMat())
+
         # Flip the V axis to match OpenGL's texturing convention.  (Or
         # we could have loaded the media file in upside-down.)
         glTranslatef(0.0, 1.0, 0.0)
@@ -107,7 +107,16 @@ class MpacsWarp2DFixedFunction(MpacsWarp2D):
         glColor3f(1.0, 1.0, 1.0)
 
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.idata)
-        glDrawElements(GL_TRIANGLES, self.numIndices, GL_UNSIGNED_INT, None)
+        if self.mesh.useStrips:
+            if self.mesh.indices.dtype == 'uint16':
+                indexType = GL_UNSIGNED_SHORT
+            else:
+                indexType = GL_UNSIGNED_INT
+            glEnable(GL_PRIMITIVE_RESTART)
+            glPrimitiveRestartIndex(self.mesh.restartIndex)
+            glDrawElements(GL_TRIANGLE_STRIP, self.numIndices, indexType, None)
+        else:
+            glDrawElements(GL_TRIANGLES, self.numIndices, GL_UNSIGNED_INT, None)
 
         glMatrixMode(GL_TEXTURE)
         glPopMatrix()
@@ -126,5 +135,6 @@ class MpacsWarp2DFixedFunction(MpacsWarp2D):
             # target gamma).  This actually isn't a terrible approach, and
             # looks fine as long as the media is sufficiently bright.
             self.blendCard.draw()
+        self.gpuTimer.end()
 
         self.saveOutputImage()
@@ -0,0 +1,154 @@
+from MpacsWarp2D import MpacsWarp2D, sampleBilinear
+import RemapTable
+import ImageWriter
+import Profiler
+import numpy
+
+class MpacsWarp2DNumPy(MpacsWarp2D):
+    """
+    Implements 2D warping on the CPU, via NumPy.
+
+    This class performs the same two-step lookup as the shader
+    implementation (pfm UV, then warpMat, then a bilinear media
+    sample, then the alpha and beta maps), but computes it for the
+    whole output raster at once with vectorized array operations.  It
+    needs no OpenGL context and no display, so it can only write its
+    result to the output file.
+
+    Where both samples fall between texel centers, the result matches
+    the shader's within a couple of levels, for the differences in
+    bilinear filtering between drivers.  Nearer the edges of the pfm
+    grid or of the media, the shader's GL_CLAMP textures blend in their
+    border color, where this class clamps to the edge texels instead,
+    so those pixels may differ considerably.
+
+    The warp is compiled into a RemapTable the first time it is drawn,
+    and the linearized blend maps are computed at the same time, so
+    each subsequent frame costs only a gather and a multiply-add.
+    """
+
+    def __init__(self, mpcdi, region):
+        MpacsWarp2D.__init__(self, mpcdi, region)
+
+        self.remapTable = None
+
+        # The linearized blend maps, resampled to the output window:
+        # each frame is computed as col * blendScale + blendOffset.
+        self.blendScale = None
+        self.blendOffset = None
+
+        # The most recently rendered frame, as an RGBA uint8 array of
+        # shape (height, width, 4).
+        self.outputImage = None
+
+    def initGL(self):
+        # There is no OpenGL state to create; we only need to make
+        # sure the blend maps are decoded.  The media is decoded when
+        # it is drawn.
+        self.alpha.getArray()
+        self.beta.getArray()
+
+    @Profiler.profiled('MpacsWarp2DNumPy.draw')
+    def draw(self):
+        media = self.media.getArray()
+        mediaSize = (media.shape[1], media.shape[0])
+        windowSize = tuple(self.windowSize)
+
+        table = self.remapTable
+        if table is None or table.mediaSize != mediaSize or table.windowSize != windowSize:
+            with Profiler.span('RemapTable.compile'):
+                table = RemapTable.compileRemapTable(self, mediaSize)
+            self.remapTable = table
+            self.__computeBlend()
+
+        # Look up the media color with the precompiled table.
+        col = expandChannels(table.apply(media))
+        col *= 1.0 / getMaxValue(media)
+
+        # Linearize the media color, apply the alpha and beta colors,
+        # and finally re-apply the gamma curve.
+        col = col ** self.mediaGamma
+        if self.blendScale is not None:
+            col = (col * self.blendScale) + self.blendOffset
+        col = col ** (1.0 / self.targetGamma)
+
+        output = numpy.empty(col.shape[:2] + (4,), dtype = 'uint8')
+        output[:,:,0:3] = numpy.round(numpy.clip(col, 0.0, 1.0) * 255)
+        output[:,:,3] = numpy.where(table.getValidMask(), 255, 0)
+        self.outputImage = output
+
+        self.saveOutputImage()
+
+    def saveOutputImage(self):
+        """ Saves the rendered frame to the indicated filename, in a
+        background thread.  Call finishOutput() to wait for it. """
+        if not self.outputFilename:
+            return
+
+        ImageWriter.getDefaultWriter().write(self.outputImage, self.outputFilename)
+
+    def finishOutput(self):
+        ImageWriter.getDefaultWriter().flush()
+
+    def __computeBlend(self):
+        """ Resamples and linearizes the alpha and beta maps for the
+        current window size. """
+
+        if not self.includeBlend:
+            self.blendScale = None
+            self.blendOffset = None
+            return
+
+        self.blendScale, self.blendOffset = linearizeBlendMaps(
+            self.alpha.getArray(), self.alphaGamma,
+            self.beta.getArray(), self.betaGamma, self.windowSize)
+
+def linearizeBlendMaps(alpha, alphaGamma, beta, betaGamma, size):
+    """ Samples the alpha and beta map arrays at the center of each
+    pixel of an output raster of the indicated size (width, height),
+    linearizes them, and returns them combined into a scale, alpha *
+    (1 - beta), and an offset, beta, to apply to each linear media
+    color.  Each is a float32 array of shape (height, width, 3). """
+
+    width, height = size
+    s = (numpy.arange(width, dtype = 'float32') + 0.5) / width
+    t = (numpy.arange(height, dtype = 'float32') + 0.5) / height
+
+    alpha = sampleBlendMap(alpha, s, t) ** alphaGamma
+    beta = sampleBlendMap(beta, s, t) ** betaGamma
+    return alpha * (1.0 - beta), beta
+
+def sampleBlendMap(array, s, t):
+    """ Samples an alpha or beta map at the normalized texture
+    coordinates s (columns) and t (rows), and returns a float32 array
+    of shape (len(t), len(s), 3).  The blend maps need not be the
+    same size as the pfm grid. """
+
+    x, y = numpy.meshgrid(s * array.shape[1] - 0.5, t * array.shape[0] - 0.5)
+    col = sampleBilinear(normalizeImage(array), x, y)
+    return expandChannels(col)
+
+def getMaxValue(array):
+    """ Returns the value that represents full intensity in a uint8,
+    uint16 or float32 image array. """
+
+    if array.dtype == numpy.uint16:
+        return 65535.0
+    elif array.dtype == numpy.float32:
+        return 1.0
+    return 255.0
+
+def normalizeImage(array):
+    """ Converts a uint8, uint16 or float32 image array to float32 in
+    the range [0, 1], as OpenGL does for normalized texture
+    formats. """
+
+    return array.astype('float32') / getMaxValue(array)
+
+def expandChannels(col):
+    """ Expands a one-channel (luminance) color array to three
+    channels, as OpenGL does with GL_LUMINANCE textures. """
+
+    if col.shape[-1] == 1:
+        return numpy.repeat(col, 3, axis = -1)
+    return col[..., 0:3]
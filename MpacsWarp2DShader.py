@@ -1,7 +1,14 @@
 from MpacsWarp2D import MpacsWarp2D
+from MpacsWarp2DNumPy import linearizeBlendMaps
+from GpuTimer import GpuTimer
 from OpenGL.GL import *
-from OpenGL.GL import shaders
+from OpenGL.raw.GL.VERSION.GL_1_0 import glTexImage2D as glTexImage2DFromBuffer
+import TextureImage
+import RenderMap
+import ShaderCache
+import ctypes
 import numpy
+import Profiler
 
 vertexShader = """
 void main() {
@@ -14,6 +21,7 @@ fragmentShaderWithBlend = """
 uniform sampler2D texture0, texture1, texture2, texture3;
 uniform float alphaGamma, betaGamma, targetGamma, mediaGamma;
 uniform mat4 warpMat;
+uniform vec4 tileBounds;
 
 void main() {
   // Look up the warped UV coordinate in the pfm texture . . .
@@ -22,6 +30,14 @@ void main() {
   // . . . apply the specified transform . . .
   uv = warpMat * uv;
 
+#ifdef TILED_MEDIA
+  // . . . keep only the fragments that fall within this tile of the
+  // media (see MpacsWarp2D.mediaTiles) . . .
+  if (any(lessThan(uv.xy, tileBounds.xy)) || any(greaterThanEqual(uv.xy, tileBounds.zw))) {
+    discard;
+  }
+#endif
+
   // . . . and use that UV coordinate to look up the media color.
   vec4 col = texture2D(texture1, uv.xy);
 
@@ -61,6 +77,7 @@ fragmentShaderNoBlend = """
 uniform sampler2D texture0, texture1, texture2;
 uniform float alphaGamma, betaGamma, targetGamma, mediaGamma;
 uniform mat4 warpMat;
+uniform vec4 tileBounds;
 
 void main() {
   // Look up the warped UV coordinate in the pfm texture . . .
@@ -69,6 +86,14 @@ void main() {
   // . . . apply the specified transform . . .
   uv = warpMat * uv;
 
+#ifdef TILED_MEDIA
+  // . . . keep only the fragments that fall within this tile of the
+  // media (see MpacsWarp2D.mediaTiles) . . .
+  if (any(lessThan(uv.xy, tileBounds.xy)) || any(greaterThanEqual(uv.xy, tileBounds.zw))) {
+    discard;
+  }
+#endif
+
   // . . . and use that UV coordinate to look up the media color.
   vec4 col = texture2D(texture1, uv.xy);
 
@@ -82,6 +107,91 @@ void main() {
 }
 """
 
+fragmentShaderBakedBlend = """
+uniform sampler2D texture0, texture1, texture2;
+uniform float targetGamma, mediaGamma;
+uniform mat4 warpMat;
+uniform vec4 tileBounds;
+
+void main() {
+#ifdef RENDER_MAP
+  // Look up the media UV coordinate in the render map, which has
+  // already been transformed (so warpMat only maps it into the
+  // cropped media, if it has been) . . .
+  vec4 warp = texture2D(texture0, gl_TexCoord[0].xy);
+  vec4 uv = warpMat * vec4(warp.xy, 0.0, 1.0);
+#else
+  // Look up the warped UV coordinate in the pfm texture . . .
+  vec4 warp = texture2D(texture0, gl_TexCoord[0].xy);
+
+  // . . . apply the specified transform . . .
+  vec4 uv = warpMat * vec4(warp.xy, 0.0, 1.0);
+#endif
+
+#ifdef TILED_MEDIA
+  // . . . keep only the fragments that fall within this tile of the
+  // media (see MpacsWarp2D.mediaTiles) . . .
+  if (any(lessThan(uv.xy, tileBounds.xy)) || any(greaterThanEqual(uv.xy, tileBounds.zw))) {
+    discard;
+  }
+#endif
+
+  // . . . and use that UV coordinate to look up the media color.
+  vec4 col = texture2D(texture1, uv.xy);
+
+#ifndef SRGB_MEDIA
+  // Linearize the media color.  (With an sRGB media texture, the
+  // texture unit has already done this.)
+  col.rgb = pow(col.rgb, vec3(mediaGamma));
+#endif
+
+  // Get the blend at this pixel.  The alpha and beta maps were
+  // resampled to the window and linearized ahead of time, and
+  // combined into a scale, alpha * (1 - beta), and an offset, beta;
+  // they are stored either alongside the UV's or in a texture of their
+  // own.
+#if defined(PACKED_BLEND) || defined(RENDER_MAP)
+  vec2 blend = warp.zw;
+#else
+  vec2 blend = texture2D(texture2, gl_TexCoord[0].xy).xy;
+#endif
+
+  // Apply the alpha and beta colors.
+  col.rgb = col.rgb * blend.x + blend.y;
+
+#ifndef SRGB_TARGET
+  // And finally, re-apply the gamma curve.  (With an sRGB
+  // framebuffer, this is done as the color is written.)
+  col.rgb = pow(col.rgb, vec3(1.0 / targetGamma));
+#endif
+
+  gl_FragColor = col;
+}
+"""
+
+# Set this false to linearize the alpha and beta maps in the fragment
+# shader, as the 2d profile describes, instead of ahead of time.
+bakeBlendMaps = True
+
+# The internal format and pixel type of the texture for each
+# RenderMap format.
+renderMapFormats = {
+    'unorm16' : (GL_RGBA16, GL_UNSIGNED_SHORT),
+    'float16' : (GL_RGBA16F, GL_HALF_FLOAT),
+    }
+
+# A gamma within this distance of 2.2 is close enough to be
+# approximated by the sRGB curve, when TextureImage.useSrgb is set.
+srgbGammaTolerance = 0.1
+
+# The uniforms set by draw().  A variant of the fragment shader that
+# doesn't use one gets a location of -1, which glUniform ignores.
+uniformNames = [
+    'texture0', 'texture1', 'texture2', 'texture3',
+    'alphaGamma', 'betaGamma', 'targetGamma', 'mediaGamma',
+    'warpMat', 'tileBounds',
+    ]
+
 class MpacsWarp2DShader(MpacsWarp2D):
     """
     Implements 2D warping via a shader pipeline.
@@ -89,36 +199,113 @@ class MpacsWarp2DShader(MpacsWarp2D):
     This class creates a floating-point texture out of the data in
     a pfm file, and performs all of the warping and blending in the
     fragment shader via a two-step texture lookup.
+
+    The alpha and beta maps are constant, so where possible (when
+    they are single-channel maps) they are resampled to the window
+    and linearized once, ahead of time, rather than for every
+    fragment; if the window is the size of the pfm grid, they are
+    stored in the same texture as the UV's.  If TextureImage.useSrgb
+    is set, the media and target gammas are also left to sRGB
+    textures and framebuffers, when they are close enough to 2.2.
+
+    If RenderMap.useRenderMap is set, a RenderMap takes the place of
+    the pfm texture and the blend maps, so each fragment needs only
+    two texture fetches.
+
+    If the part of the media that the region samples is too large for
+    one texture, it is drawn from several tiles, a pass each; see
+    MpacsWarp2D.mediaTiles.
     """
 
     def __init__(self, mpcdi, region):
         MpacsWarp2D.__init__(self, mpcdi, region)
 
         self.pfmtexobj = None
-
+        self.blendtexobj = None
+        self.gpuTimer = GpuTimer('MpacsWarp2DShader.draw')
+
+        # How the blend maps are applied; see getBlendMode().  Unless
+        # they are linearized by the shader, the textures hold them
+        # resampled to blendSize.
+        self.blendMode = None
+        self.blendSize = None
+
+        # The RenderMap drawn with, if the blend mode is 'rendermap'.
+        self.renderMap = None
+
+        # Set true by initGL() if the colors are gamma-encoded by the
+        # framebuffer as they are written.
+        self.srgbTarget = False
+
+        # The defines of the fragment shader variant in use, and its
+        # ShaderProgram.
+        self.shaderDefines = None
+        self.shaderProgram = None
+
+    def getBlendMode(self):
+        """ Returns 'none' if the blend maps are not applied at all;
+        'rendermap' if they are stored with the transformed UV's in a
+        RenderMap; 'packed' if they are linearized ahead of time and
+        stored with the UV's in the pfm texture; 'baked' if they are
+        linearized ahead of time and stored in a texture of their
+        own; or 'pow' if they are linearized by the fragment
+        shader. """
+
+        if not self.includeBlend:
+            return 'none'
+        if self.alpha.getArray().shape[2] != 1 or \
+           self.beta.getArray().shape[2] != 1:
+            return 'pow'
+        if RenderMap.useRenderMap:
+            return 'rendermap'
+        if not bakeBlendMaps:
+            return 'pow'
+        if tuple(self.windowSize) == (self.pfm.xSize, self.pfm.ySize):
+            return 'packed'
+        return 'baked'
+
+    def wantsSrgbMedia(self):
+        return TextureImage.useSrgb and \
+               self.canDrawSrgbMedia() and \
+               isSrgbGamma(self.mediaGamma)
+
+    def canDrawSrgbMedia(self):
+        # The fragment shader is compiled to match the media's
+        # encoding, except in the blend modes that use pow() for
+        # everything.
+        return self.getBlendMode() in ['rendermap', 'packed', 'baked']
+
+    def canCropMedia(self):
+        return True
+
+    def canTileMedia(self):
+        return True
+
+    @Profiler.profiled('MpacsWarp2DShader.bakeBlendMaps')
+    def bakeBlendMaps(self):
+        """ Returns the alpha and beta maps, resampled to the window
+        and linearized, as a float32 array of shape (height, width,
+        2): the scale, alpha * (1 - beta), and the offset, beta, to
+        apply to each linear media color.  Since they are sampled at
+        the pixel centers just as the shader would sample them, the
+        result is the same. """
+
+        scale, offset = linearizeBlendMaps(
+            self.alpha.getArray(), self.alphaGamma,
+            self.beta.getArray(), self.betaGamma, self.windowSize)
+
+        # The maps are single-channel, so the three colors are alike.
+        return numpy.dstack((scale[:,:,0], offset[:,:,0]))
+
+    @Profiler.profiled('MpacsWarp2DShader.initGL')
     def initGL(self):
         MpacsWarp2D.initGL(self)
-        self.alpha.initGL()
-        self.beta.initGL()
+        if self.getBlendMode() == 'pow':
+            self.alpha.initGL()
+            self.beta.initGL()
 
-        # Load the pfm data as a floating-point texture.
         self.pfmtexobj = glGenTextures(1)
-        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
-        glBindTexture(GL_TEXTURE_2D, self.pfmtexobj)
-
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-
-        # Fill every third element of the UV data with zeroes, instead
-        # of the default NaN's which aren't really useful, and can
-        # confuse OpenGL into ignoring the first two.
-        uv_list = numpy.fromstring(self.pfm.data, dtype = 'float32')
-        uvs3 = numpy.reshape(uv_list, (-1, 3), 'C')
-        uvs3[:,2].fill(0)
-
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB32F, self.pfm.xSize, self.pfm.ySize, 0, GL_RGB, GL_FLOAT, uvs3)
+        self.__uploadWarp()
 
         # Create a VBO with two triangles to make a unit quad.
         verts = [
@@ -130,57 +317,157 @@ class MpacsWarp2DShader(MpacsWarp2D):
         glBindBuffer(GL_ARRAY_BUFFER, self.vertdata)
         glBufferData(GL_ARRAY_BUFFER, verts, GL_STATIC_DRAW)
 
-        # A matrix to scale the warping UV's into the correct range
-        # specified by the Region (as defined in the mpcdi.xml file).
-        rangeMat = numpy.array(
-            [[self.region.xsize, 0, 0, 0],
-             [0, self.region.ysize, 0, 0],
-             [0, 0, 1, 0],
-             [self.region.x, self.region.y, 0, 1]])
-
-        # We also need to flip the V axis to match OpenGL's texturing
-        # convention.  (Or we could have loaded the media file in
-        # upside-down.)
-        flipMat = numpy.array(
-            [[1, 0, 0, 0],
-             [0, -1, 0, 0],
-             [0, 0, 1, 0],
-             [0, 1, 0, 1]])
-
-        # Accumulate them both into the single warping matrix.
-        self.warpMat = rangeMat.dot(flipMat)
-
-        # Compile the shaders.
-        vs = shaders.compileShader(vertexShader, GL_VERTEX_SHADER)
-        if self.includeBlend:
-            fs = shaders.compileShader(fragmentShaderWithBlend, GL_FRAGMENT_SHADER)
-        else:
-            fs = shaders.compileShader(fragmentShaderNoBlend, GL_FRAGMENT_SHADER)
-        self.shader = shaders.compileProgram(vs, fs)
-
-        self.texture0Loc = glGetUniformLocation(self.shader, 'texture0')
-        self.texture1Loc = glGetUniformLocation(self.shader, 'texture1')
-        self.texture2Loc = glGetUniformLocation(self.shader, 'texture2')
-        self.texture3Loc = glGetUniformLocation(self.shader, 'texture3')
-        self.alphaGammaLoc = glGetUniformLocation(self.shader, 'alphaGamma')
-        self.betaGammaLoc = glGetUniformLocation(self.shader, 'betaGamma')
-        self.targetGammaLoc = glGetUniformLocation(self.shader, 'targetGamma')
-        self.mediaGammaLoc = glGetUniformLocation(self.shader, 'mediaGamma')
-        self.warpMatLoc = glGetUniformLocation(self.shader, 'warpMat')
+        self.warpMat = self.getWarpMat()
+
+        self.srgbTarget = TextureImage.useSrgb and \
+                          self.blendMode in ['rendermap', 'packed', 'baked'] and \
+                          isSrgbGamma(self.targetGamma) and \
+                          isFramebufferSrgb()
+
+        self.__compileShader()
+
+    def __uploadWarp(self):
+        """ Loads the pfm data (or the render map), and the blend maps
+        if they are linearized ahead of time, into textures for the
+        current window size. """
 
+        self.blendMode = self.getBlendMode()
+        self.blendSize = tuple(self.windowSize)
+
+        # Load the pfm data as a floating-point texture.
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glBindTexture(GL_TEXTURE_2D, self.pfmtexobj)
+
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+
+        if self.blendMode == 'rendermap':
+            # The render map takes the place of the pfm data.
+            self.renderMap = RenderMap.compileRenderMap(self, RenderMap.renderMapFormat)
+            data = numpy.ascontiguousarray(self.renderMap.data)
+            internalFormat, type = renderMapFormats[self.renderMap.format]
+
+            # PyOpenGL doesn't accept half-float arrays, so we pass a
+            # pointer to the data instead.
+            with Profiler.span('MpacsWarp2DShader.uploadRenderMap', data.nbytes):
+                glTexImage2DFromBuffer(GL_TEXTURE_2D, 0, internalFormat,
+                                       data.shape[1], data.shape[0], 0, GL_RGBA, type,
+                                       data.ctypes.data_as(ctypes.c_void_p))
+            return
+
+        # Upload only the first two elements of the UV data.  The
+        # third is mostly NaN's, which aren't really useful, and can
+        # confuse OpenGL into ignoring the first two; a two-component
+        # texture reads back a zero there instead.  This is the only
+        # copy we make of the pfm data, and it also converts it to
+        # native byte order.
+        if self.blendMode == 'packed':
+            # The pfm grid is the size of the window, so the blend
+            # scale and offset can go in the other two.
+            uvs = numpy.empty((self.pfm.ySize, self.pfm.xSize, 4), dtype = 'float32')
+            uvs[:,:,0:2] = self.pfm.getArray()[:,:,0:2]
+            uvs[:,:,2:4] = self.bakeBlendMaps()
+            internalFormat, format = GL_RGBA32F, GL_RGBA
+        else:
+            uvs = numpy.ascontiguousarray(self.pfm.getArray()[:,:,0:2], dtype = 'float32')
+            internalFormat, format = GL_RG32F, GL_RG
+
+        with Profiler.span('MpacsWarp2DShader.uploadPfm', uvs.nbytes):
+            glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, self.pfm.xSize, self.pfm.ySize, 0, format, GL_FLOAT, uvs)
+
+        if self.blendMode == 'baked':
+            # The blend scale and offset are well within the range
+            # and precision of half floats.
+            blend = self.bakeBlendMaps()
+            if self.blendtexobj is None:
+                self.blendtexobj = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, self.blendtexobj)
+            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RG16F, blend.shape[1], blend.shape[0], 0, GL_RG, GL_FLOAT, blend)
+
+    def __getShaderDefines(self):
+        """ Returns the #defines that select the variant of the
+        fragment shader for the current blend mode and media. """
+
+        defines = []
+        if self.blendMode == 'rendermap':
+            defines.append('RENDER_MAP')
+        elif self.blendMode == 'packed':
+            defines.append('PACKED_BLEND')
+        if self.mediaTiles:
+            defines.append('TILED_MEDIA')
+            if self.mediaTiles[0][0].srgb:
+                defines.append('SRGB_MEDIA')
+        elif self.media is not None and self.media.srgb:
+            defines.append('SRGB_MEDIA')
+        if self.srgbTarget:
+            defines.append('SRGB_TARGET')
+        return tuple(defines)
+
+    def __compileShader(self):
+        """ Makes the fragment shader variant for the current state
+        the one in use.  The programs are shared by all of the
+        regions drawn in the same context, so each variant is only
+        compiled (or loaded from the cache) the first time any of
+        them needs it. """
+
+        defines = self.__getShaderDefines()
+        if self.blendMode == 'none':
+            source = fragmentShaderNoBlend
+        elif self.blendMode == 'pow':
+            source = fragmentShaderWithBlend
+        else:
+            source = fragmentShaderBakedBlend
+        source = ''.join(['#define %s\n' % (d) for d in defines]) + source
+
+        self.shaderDefines = defines
+        self.shaderProgram = ShaderCache.getProgram(vertexShader, source, uniformNames)
+        self.shader = self.shaderProgram.program
+
+        uniforms = self.shaderProgram.uniforms
+        self.texture0Loc = uniforms['texture0']
+        self.texture1Loc = uniforms['texture1']
+        self.texture2Loc = uniforms['texture2']
+        self.texture3Loc = uniforms['texture3']
+        self.alphaGammaLoc = uniforms['alphaGamma']
+        self.betaGammaLoc = uniforms['betaGamma']
+        self.targetGammaLoc = uniforms['targetGamma']
+        self.mediaGammaLoc = uniforms['mediaGamma']
+        self.warpMatLoc = uniforms['warpMat']
+        self.tileBoundsLoc = uniforms['tileBounds']
+
+    @Profiler.profiled('MpacsWarp2DShader.draw')
     def draw(self):
+        self.updateMedia()
+        if self.blendMode in ['rendermap', 'packed', 'baked'] and \
+           tuple(self.windowSize) != self.blendSize:
+            # The blend maps must be resampled to the new window size.
+            self.__uploadWarp()
+        if self.__getShaderDefines() != self.shaderDefines:
+            # The media has been replaced with one that is (or isn't)
+            # sRGB-encoded or tiled, or the blend maps have moved.
+            self.__compileShader()
+
+        self.gpuTimer.begin()
         glPushClientAttrib(GL_CLIENT_ALL_ATTRIB_BITS)
 
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(GL_TEXTURE_2D, self.pfmtexobj)
-        glActiveTexture(GL_TEXTURE1)
-        glBindTexture(GL_TEXTURE_2D, self.media.texobj)
-        glActiveTexture(GL_TEXTURE2)
-        glBindTexture(GL_TEXTURE_2D, self.alpha.texobj)
-        glActiveTexture(GL_TEXTURE3)
-        glBindTexture(GL_TEXTURE_2D, self.beta.texobj)
-
-        shaders.glUseProgram(self.shader)
+        if self.blendMode == 'pow':
+            glActiveTexture(GL_TEXTURE2)
+            glBindTexture(GL_TEXTURE_2D, self.alpha.texobj)
+            glActiveTexture(GL_TEXTURE3)
+            glBindTexture(GL_TEXTURE_2D, self.beta.texobj)
+        elif self.blendMode == 'baked':
+            glActiveTexture(GL_TEXTURE2)
+            glBindTexture(GL_TEXTURE_2D, self.blendtexobj)
+
+        glUseProgram(self.shader)
         glUniform1i(self.texture0Loc, 0)
         glUniform1i(self.texture1Loc, 1)
         glUniform1i(self.texture2Loc, 2)
@@ -189,7 +476,6 @@ class MpacsWarp2DShader(MpacsWarp2D):
         glUniform1f(self.betaGammaLoc, self.betaGamma)
         glUniform1f(self.targetGammaLoc, self.targetGamma)
         glUniform1f(self.mediaGammaLoc, self.mediaGamma)
-        glUniformMatrix4fv(self.warpMatLoc, 1, GL_FALSE, self.warpMat)
 
         glEnableClientState(GL_VERTEX_ARRAY)
         glEnableClientState(GL_TEXTURE_COORD_ARRAY)
@@ -198,10 +484,55 @@ class MpacsWarp2DShader(MpacsWarp2D):
         glVertexPointer(2, GL_FLOAT, 0, None)
         glTexCoordPointer(2, GL_FLOAT, 0, None)
 
-        glDrawArrays(GL_TRIANGLES, 0, 6)
+        if self.srgbTarget:
+            glEnable(GL_FRAMEBUFFER_SRGB)
+
+        # The media texture may hold only the part of the media that
+        # this region samples, or it may take several tiles, each
+        # drawn in a pass of its own.
+        for media, bounds in self.mediaTiles or [(self.media, None)]:
+            glActiveTexture(GL_TEXTURE1)
+            glBindTexture(GL_TEXTURE_2D, media.texobj)
+            cropMat = media.getCropMat()
+            if self.blendMode == 'rendermap':
+                warpMat = cropMat
+            else:
+                warpMat = self.warpMat.dot(cropMat)
+            glUniformMatrix4fv(self.warpMatLoc, 1, GL_FALSE, warpMat)
+            if bounds is not None:
+                u0, v0, u1, v1 = bounds
+                glUniform4f(self.tileBoundsLoc,
+                            u0 * cropMat[0][0] + cropMat[3][0], v0 * cropMat[1][1] + cropMat[3][1],
+                            u1 * cropMat[0][0] + cropMat[3][0], v1 * cropMat[1][1] + cropMat[3][1])
+            glDrawArrays(GL_TRIANGLES, 0, 6)
+
+        if self.srgbTarget:
+            glDisable(GL_FRAMEBUFFER_SRGB)
 
         glUseProgram(0)
 
         glPopClientAttrib()
+        self.gpuTimer.end()
 
         self.saveOutputImage()
+
+def isSrgbGamma(gamma):
+    """ Returns true if the indicated gamma is close enough to 2.2 to
+    be approximated by the sRGB curve. """
+    return abs(gamma - 2.2) <= srgbGammaTolerance
+
+def isFramebufferSrgb():
+    """ Returns true if the framebuffer currently bound for drawing
+    gamma-encodes colors written with GL_FRAMEBUFFER_SRGB
+    enabled. """
+
+    if glGetIntegerv(GL_DRAW_FRAMEBUFFER_BINDING):
+        attachment = GL_COLOR_ATTACHMENT0
+    else:
+        attachment = GL_BACK_LEFT
+    try:
+        encoding = glGetFramebufferAttachmentParameteriv(
+            GL_DRAW_FRAMEBUFFER, attachment, GL_FRAMEBUFFER_ATTACHMENT_COLOR_ENCODING)
+    except GLError:
+        return False
+    return encoding == GL_SRGB
@@ -3,25 +3,64 @@ from xml.etree import ElementTree
 import PfmFile
 import TextureImage
 import os.path
+import hashlib
+import struct
+import zlib
+import numpy
+import Profiler
+
+# The size of each compressed block read while inflating a subfile.
+inflateBlockSize = 1 << 20
 
 class MpcdiFile:
-    def __init__(self, filename = None):
+    def __init__(self, filename = None, assetCache = None, lazy = False,
+                 verbose = True):
         self.filename = None
         self.zip = None
         self.doc = None
         self.profile = None
         self.buffers = {}
         self.regions = {}
+        self.regionIndex = {}
+        self.regionIdList = []
+        self.contentHash = None
+
+        # The SHA-1 of each subfile's data, by name, as computed by
+        # getSubfileDigest(), and whether those saved in the
+        # assetCache have been looked up yet.
+        self.subfileDigests = {}
+        self.savedDigestsLoaded = False
+
+        # If this is set to an AssetCache, decoded pfm grids and blend
+        # maps are stored there, and reused by later runs.
+        self.assetCache = assetCache
+
+        # If this file was opened by an MpcdiLibrary, decoded assets
+        # are shared with the library's other bundles.
+        self.library = None
+
+        # If lazy is true, read() only builds the regionIndex, and each
+        # RegionDef is constructed the first time it is requested with
+        # getRegion().
+        self.lazy = lazy
+
+        # Set this false to suppress the progress messages.
+        self.verbose = verbose
 
         if filename:
             self.read(filename)
 
+    @Profiler.profiled('MpcdiFile.read')
     def read(self, filename):
         """ Reads the mpcdi file and sets up the corresponding data
         structures internally. """
 
         self.filename = filename
-        print "Reading %s" % (self.filename)
+        self.contentHash = None
+        self.subfileDigests = {}
+        self.savedDigestsLoaded = False
+        if self.verbose:
+            print "Reading %s" % (self.filename)
 
         if os.path.isdir(self.filename):
             # Read a directory directly
@@ -30,31 +69,243 @@ class MpcdiFile:
             # Read a zipfile via the ZipFile module
             self.zip = zipfile.ZipFile(self.filename, 'r')
 
-        docData = self.extractSubfile('mpcdi.xml')
-        self.doc = ElementTree.fromstring(docData)
-
+        self.doc = None
         self.profile = None
         self.buffers = {}
         self.regions = {}
+        self.regionIndex = {}
         self.regionIdList = []  # sorted in file order
 
-        self.profile = self.doc.attrib['profile']
+        self.__readIndex()
+
+        if not self.lazy:
+            for regionId in self.regionIdList:
+                self.getRegion(regionId)
+
+    @Profiler.profiled('MpcdiFile.readIndex')
+    def __readIndex(self):
+        """ Scans mpcdi.xml in a single streaming pass, filling in the
+        buffers and a RegionSummary for each region in regionIndex,
+        without constructing any RegionDef objects.  Each element is
+        cleared once it has been summarized, so the parsed tree is
+        never held in memory as a whole. """
+
+        file = self.openSubfile('mpcdi.xml')
+        buffer = None
+        for event, elem in ElementTree.iterparse(file, events = ('start', 'end')):
+            if event == 'start':
+                if self.doc is None:
+                    self.doc = elem
+                    self.profile = elem.attrib['profile']
+                elif elem.tag == 'buffer':
+                    # The attributes are available at the start tag.
+                    buffer = BufferDef(elem)
+                    self.buffers[buffer.id] = buffer
+
+            elif elem.tag == 'region' and buffer is not None:
+                summary = RegionSummary(buffer, elem)
+                self.regionIndex[summary.id] = summary
+                self.regionIdList.append(summary.id)
+                elem.clear()
+
+            elif elem.tag == 'buffer':
+                buffer = None
+                elem.clear()
+
+            elif elem.tag == 'fileset':
+                regionName = elem.attrib['region']
+                self.regionIndex[regionName].addFileset(elem)
+                elem.clear()
+        file.close()
+
+    def getRegion(self, regionId):
+        """ Returns the RegionDef for the indicated region id,
+        constructing it on first request. """
+
+        region = self.regions.get(regionId, None)
+        if region is None:
+            summary = self.regionIndex[regionId]
+            region = RegionDef(summary.buffer, summary.xregion)
+            if summary.xfileset is not None:
+                region.addFileset(summary.xfileset)
+            self.regions[regionId] = region
+
+            if self.verbose:
+                print "Found region %s of size %s, %s" % (region.id, region.Xresolution, region.Yresolution)
+
+        return region
+
+    def getContentHash(self):
+        """ Returns a hex string that identifies the contents of the
+        mpcdi file, suitable for keying on-disk caches.  This is
+        computed from the SHA-1 of each subfile's data (see
+        getSubfileDigest()), not from the file's name or timestamp,
+        nor from the CRC-32's in a zipfile's central directory, which
+        can't be trusted to tell an edited member from the
+        original. """
+
+        if self.contentHash is None:
+            if self.zip:
+                names = [info.filename for info in self.zip.infolist()]
+            else:
+                names = []
+                for dirpath, dirnames, filenames in os.walk(self.filename):
+                    dirnames.sort()
+                    for filename in filenames:
+                        pathname = os.path.join(dirpath, filename)
+                        names.append(os.path.relpath(pathname, self.filename))
+
+            numDigests = len(self.subfileDigests)
+            hash = hashlib.sha1()
+            for name in sorted(names):
+                hash.update('%s %s\n' % (name, self.getSubfileDigest(name)))
+            self.contentHash = hash.hexdigest()
+
+            if len(self.subfileDigests) != numDigests:
+                self.__saveDigests()
+
+        return self.contentHash
+
+    @Profiler.profiled('MpcdiFile.digest')
+    def getSubfileDigest(self, filename):
+        """ Returns the SHA-1 of the data of the named subfile, as a
+        hex string.  Each subfile is read for this at most once.  If
+        there is an assetCache, the digests are also saved there, with
+        the size and modification time of each file (or the CRC-32 of
+        each zipfile member, and the size and modification time of the
+        zipfile), so a warm start needn't read them again; an edit
+        that preserved all of those would go unnoticed. """
 
-        xdisplay = self.doc.find('display')
-        for xbuffer in xdisplay.iter('buffer'):
-            buffer = BufferDef(xbuffer)
-            self.buffers[buffer.id] = buffer
+        if not self.savedDigestsLoaded:
+            self.__loadDigests()
 
-            for xregion in xbuffer.iter('region'):
-                region = RegionDef(buffer, xregion)
-                self.regions[region.id] = region
-                self.regionIdList.append(region.id)
+        digest = self.subfileDigests.get(filename, None)
+        if digest is None:
+            hash = hashlib.sha1()
+            file = self.openSubfile(filename)
+            while True:
+                block = file.read(1 << 20)
+                if not block:
+                    break
+                hash.update(block)
+            file.close()
+            digest = hash.hexdigest()
+            self.subfileDigests[filename] = digest
 
-        xfiles = self.doc.find('files')
-        for xfileset in xfiles.iter('fileset'):
-            regionName = xfileset.attrib['region']
-            region = self.regions[regionName]
-            region.addFileset(xfileset)
+        return digest
+
+    def __setSubfileDigest(self, filename, data):
+        """ Records the digest of the named subfile, from its data (as
+        returned by extractSubfileArray()) if it isn't already known,
+        so that getSubfileDigest() needn't read it again. """
+
+        if not self.savedDigestsLoaded:
+            self.__loadDigests()
+        if filename not in self.subfileDigests:
+            self.subfileDigests[filename] = hashlib.sha1(data).hexdigest()
+
+    def __getBundleKey(self):
+        """ Returns the string that identifies this mpcdi file's
+        digests in the assetCache. """
+
+        pathname = os.path.abspath(self.filename)
+        if self.zip:
+            st = os.stat(pathname)
+            return 'zip %s %s %r' % (pathname, st.st_size, st.st_mtime)
+        return 'dir %s' % (pathname)
+
+    def __getSubfileStamp(self, filename):
+        """ Returns the list of numbers that must be unchanged for a
+        saved digest of the named subfile to be trusted. """
+
+        if self.zip:
+            info = self.zip.getinfo(filename)
+            return [info.CRC & 0xffffffff, info.file_size]
+        st = os.stat(os.path.join(self.filename, filename))
+        return [st.st_size, st.st_mtime]
+
+    def __loadDigests(self):
+        self.savedDigestsLoaded = True
+        if not self.assetCache:
+            return
+
+        saved = self.assetCache.loadDigests(self.__getBundleKey())
+        if not saved:
+            return
+        for filename, (stamp, digest) in saved.items():
+            try:
+                if self.__getSubfileStamp(filename) != stamp:
+                    continue
+            except (KeyError, OSError):
+                # It's no longer there.
+                continue
+            self.subfileDigests.setdefault(filename, digest)
+
+    def __saveDigests(self):
+        if not self.assetCache:
+            return
+
+        saved = {}
+        for filename, digest in self.subfileDigests.items():
+            saved[filename] = (self.__getSubfileStamp(filename), digest)
+        self.assetCache.storeDigests(self.__getBundleKey(), saved)
+
+    def getSubfileKey(self, filename):
+        """ Returns a string that identifies the contents of the
+        named subfile, such that byte-identical subfiles in different
+        mpcdi files have the same key.  This is the subfile's digest
+        (see getSubfileDigest()), so it is computed only once for each
+        subfile; a zipfile member's CRC-32 and size wouldn't do, since
+        all of the pfm files of one resolution have the same size.
+        (They do rule out a match, though; see __findSharedAsset().) """
+
+        return 'sha1 %s' % (self.getSubfileDigest(filename))
+
+    def __getSubfileStub(self, kind, filename):
+        """ Returns the (kind, size, CRC-32) of the named subfile, as
+        known without reading it, for MpcdiLibrary.mightShareAsset().
+        The CRC-32 is None for a file in a directory. """
+
+        if self.zip:
+            info = self.zip.getinfo(filename)
+            return (kind, info.file_size, info.CRC & 0xffffffff)
+        return (kind, os.path.getsize(os.path.join(self.filename, filename)), None)
+
+    def __findSharedAsset(self, kind, filename):
+        """ Returns (array, data): the array decoded from an identical
+        subfile by another bundle of the same MpcdiLibrary, or None;
+        and the data of the named subfile, if it had to be read to
+        compute its key, so that it needn't be read again to decode
+        it, or None.  The subfile isn't read at all if its digest is
+        already known, or if no asset in the library has the same
+        size and CRC-32. """
+
+        if not self.library:
+            return None, None
+
+        if not self.savedDigestsLoaded:
+            self.__loadDigests()
+        data = None
+        if filename not in self.subfileDigests:
+            if not self.library.mightShareAsset(self.__getSubfileStub(kind, filename)):
+                return None, None
+            data = self.extractSubfileArray(filename)
+            self.__setSubfileDigest(filename, data)
+
+        key = '%s %s' % (kind, self.getSubfileKey(filename))
+        return self.library.findSharedAsset(key), data
+
+    def __storeSharedAsset(self, kind, filename, array, data = None):
+        """ Offers the array decoded from the named subfile to the
+        other bundles of the MpcdiLibrary.  If the subfile's data is
+        given, its key is computed from that, rather than by reading
+        it again. """
+
+        if self.library:
+            if data is not None:
+                self.__setSubfileDigest(filename, data)
+            key = '%s %s' % (kind, self.getSubfileKey(filename))
+            self.library.storeSharedAsset(key, array, self.__getSubfileStub(kind, filename))
 
     def extractSubfile(self, filename):
         """ Returns the string data from the subfile within the mpcdi
@@ -65,19 +316,175 @@ class MpcdiFile:
         else:
             return open(os.path.join(self.filename, filename), 'rb').read()
 
+    def openSubfile(self, filename):
+        """ Returns a file-like object for streaming the named subfile
+        within the mpcdi file, without reading it all into memory. """
+
+        if self.zip:
+            return self.zip.open(filename)
+        else:
+            return open(os.path.join(self.filename, filename), 'rb')
+
+    @Profiler.profiled('MpcdiFile.extract', Profiler.arrayBytes)
+    def extractSubfileArray(self, filename):
+        """ Returns the data of the named subfile within the mpcdi file
+        as a read-only uint8 numpy array, without making an
+        intermediate Python string.  Files in a directory, and files
+        stored uncompressed in a zipfile, are memory-mapped directly;
+        deflated files are inflated straight into a preallocated
+        array. """
+
+        if not self.zip:
+            pathname = os.path.join(self.filename, filename)
+            if os.path.getsize(pathname) == 0:
+                return numpy.zeros(0, dtype = 'uint8')
+            return numpy.memmap(pathname, dtype = 'uint8', mode = 'r')
+
+        info = self.zip.getinfo(filename)
+        if info.flag_bits & 0x1 or info.file_size == 0:
+            # Encrypted (or empty); let the zipfile module handle it.
+            array = numpy.frombuffer(self.zip.read(filename), dtype = 'uint8')
+            return array
+
+        if info.compress_type == zipfile.ZIP_STORED:
+            return numpy.memmap(self.filename, dtype = 'uint8', mode = 'r',
+                                offset = self.__getDataOffset(info),
+                                shape = (info.file_size,))
+
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            return self.__inflateSubfile(info)
+
+        # Some other compression method; let the zipfile module
+        # handle it.
+        return numpy.frombuffer(self.zip.read(filename), dtype = 'uint8')
+
+    def __getDataOffset(self, info):
+        """ Returns the offset within the zipfile at which the data
+        for the indicated ZipInfo begins, following its local file
+        header. """
+
+        file = open(self.filename, 'rb')
+        file.seek(info.header_offset)
+        header = file.read(zipfile.sizeFileHeader)
+        file.close()
+
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile, 'Bad local file header for %s' % (info.filename)
+
+        return info.header_offset + zipfile.sizeFileHeader + \
+               fields[zipfile._FH_FILENAME_LENGTH] + \
+               fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+    @Profiler.profiled('MpcdiFile.inflate', Profiler.arrayBytes)
+    def __inflateSubfile(self, info):
+        """ Inflates the deflated subfile described by the indicated
+        ZipInfo into a new uint8 array, one block at a time. """
+
+        array = numpy.empty(info.file_size, dtype = 'uint8')
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        crc = 0
+        p = 0
+
+        file = open(self.filename, 'rb')
+        file.seek(self.__getDataOffset(info))
+        remaining = info.compress_size
+        while remaining > 0 or decompressor.unconsumed_tail:
+            if decompressor.unconsumed_tail:
+                block = decompressor.unconsumed_tail
+            else:
+                block = file.read(min(remaining, inflateBlockSize))
+                remaining -= len(block)
+                if not block:
+                    break
+
+            # Limit each piece to the space left in the array; any
+            # input that doesn't fit is kept in unconsumed_tail.
+            piece = decompressor.decompress(block, max(info.file_size - p, 1))
+            if p + len(piece) > info.file_size:
+                raise zipfile.BadZipfile, 'Too much data in %s' % (info.filename)
+            array[p:p + len(piece)] = numpy.frombuffer(piece, dtype = 'uint8')
+            crc = zlib.crc32(piece, crc)
+            p += len(piece)
+        file.close()
+
+        if p != info.file_size or (crc & 0xffffffff) != info.CRC:
+            raise zipfile.BadZipfile, 'Bad CRC-32 for %s' % (info.filename)
+
+        array.flags.writeable = False
+        return array
+
+    def isSubfileCompressed(self, filename):
+        """ Returns true if the named subfile must be inflated to be
+        read, or false if it can be memory-mapped directly. """
+
+        if not self.zip:
+            return False
+        return self.zip.getinfo(filename).compress_type != zipfile.ZIP_STORED
+
+    @Profiler.profiled('MpcdiFile.extractPfmFile')
     def extractPfmFile(self, filename):
         """ Returns a PfmFile object corresponding to the named
-        file.pfm within the mpcdi file. """
+        file.pfm within the mpcdi file.  The pfm data is not copied;
+        see extractSubfileArray(). """
+
+        array, data = self.__findSharedAsset('pfm', filename)
+        if array is not None:
+            return PfmFile.PfmFile(filename = filename, array = array)
+
+        if not self.zip:
+            # The PfmFile can memory-map the file itself.
+            pfm = PfmFile.PfmFile(filename = os.path.join(self.filename, filename))
+            self.__storeSharedAsset('pfm', filename, pfm.getArray())
+            return pfm
 
-        data = self.extractSubfile(filename)
-        return PfmFile.PfmFile(filename = filename, data = data)
+        # There's no point in caching a pfm file that we can already
+        # memory-map in place.
+        useCache = self.assetCache and self.isSubfileCompressed(filename)
+        if useCache:
+            array = self.assetCache.load(self.getContentHash(), filename)
+            if array is not None:
+                self.__storeSharedAsset('pfm', filename, array)
+                return PfmFile.PfmFile(filename = filename, array = array)
 
+        if data is None:
+            data = self.extractSubfileArray(filename)
+        pfm = PfmFile.PfmFile(filename = filename, data = data)
+
+        if useCache:
+            self.assetCache.store(self.getContentHash(), filename, pfm.getArray())
+        self.__storeSharedAsset('pfm', filename, pfm.getArray(), data)
+        return pfm
+
+    @Profiler.profiled('MpcdiFile.extractTextureImage')
     def extractTextureImage(self, filename):
         """ Returns a TextureImage object corresponding to the named
-        file.png within the mpcdi file. """
+        file.png within the mpcdi file.  The encoded data is released
+        once the image has been decoded. """
+
+        array, data = self.__findSharedAsset('image', filename)
+        if array is not None:
+            return TextureImage.TextureImage(filename = filename, array = array)
 
-        data = self.extractSubfile(filename)
-        return TextureImage.TextureImage(filename = filename, data = data)
+        if self.assetCache:
+            array = self.assetCache.load(self.getContentHash(), filename)
+            if array is not None:
+                self.__storeSharedAsset('image', filename, array)
+                return TextureImage.TextureImage(filename = filename, array = array)
+
+        if data is None:
+            data = self.extractSubfileArray(filename)
+        image = TextureImage.TextureImage(filename = filename, data = data)
+
+        if self.assetCache:
+            # Decode it now, so we can save the result for next time.
+            self.assetCache.store(self.getContentHash(), filename, image.getArray())
+        if self.library:
+            # Likewise, decode it now so the other bundles can share
+            # it.  (The image releases the data as it is decoded, so
+            # keep hold of it for the key.)
+            self.__storeSharedAsset('image', filename, image.getArray(), data)
+        return image
 
 class BufferDef:
     def __init__(self, xbuffer):
@@ -90,6 +497,50 @@ class BufferDef:
                 value = int(value)
             setattr(self, keyword, value)
 
+class RegionSummary:
+    """ The compact index entry for a region: its buffer, resolution
+    and file paths, as read by MpcdiFile without constructing the full
+    RegionDef. """
+
+    def __init__(self, buffer, xregion):
+        self.buffer = buffer
+        self.id = xregion.attrib['id']
+
+        # A detached copy of just the parts of the region and fileset
+        # elements that RegionDef reads, so that the parsed elements
+        # themselves can be cleared.
+        self.xregion = copyElement(xregion, ['frustum', 'coordinateFrame'])
+        self.xfileset = None
+
+        # Integer properties
+        for keyword in ['Xresolution', 'Yresolution']:
+            value = xregion.attrib[keyword]
+            if value:
+                value = int(value)
+            setattr(self, keyword, value)
+
+        # The path of each file in the region's fileset, by keyword.
+        self.paths = {}
+
+    def addFileset(self, xfileset):
+        fileKeywords = ['geometryWarpFile', 'alphaMap', 'betaMap', 'distortionMap']
+        self.xfileset = copyElement(xfileset, fileKeywords)
+        for keyword in fileKeywords:
+            xpath = xfileset.find(keyword + '/path')
+            if xpath is not None:
+                self.paths[keyword] = xpath.text
+
+def copyElement(elem, tags):
+    """ Returns a new element with the tag and attributes of the
+    indicated one, holding only those of its children (and their
+    subtrees, which are not copied) with the indicated tags. """
+
+    copy = ElementTree.Element(elem.tag, dict(elem.attrib))
+    for child in elem:
+        if child.tag in tags:
+            copy.append(child)
+    return copy
+
 class RegionDef:
     def __init__(self, buffer, xregion):
         self.buffer = buffer
@@ -120,8 +571,6 @@ class RegionDef:
         if xframe:
             self.frame = FrameDef(xframe)
 
-        print "Found region %s of size %s, %s" % (self.id, self.Xresolution, self.Yresolution)
-
     def addFileset(self, xfileset):
         for keyword in ['geometryWarpFile', 'alphaMap', 'betaMap', 'distortionMap']:
             xfile = xfileset.find(keyword, None)
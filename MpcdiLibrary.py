@@ -0,0 +1,161 @@
+from MpcdiFile import MpcdiFile
+import weakref
+import os.path
+
+class MpcdiLibrary:
+    """
+    An index of many mpcdi files ("bundles"), for instance one for each
+    show configuration of a venue.  Each bundle is opened, lazily, the
+    first time it is needed, and only the index of its mpcdi.xml is
+    read until one of its regions is requested.
+
+    The decoded pfm grids and alpha and beta maps are shared between
+    all of the bundles in the library: a member that is byte-identical
+    to one already decoded for another bundle (as judged by the SHA-1
+    of its data) is not decoded again.  A member is only read to
+    compute its SHA-1 if an asset already decoded has the same size
+    and CRC-32.  Each bundle still gets its own PfmFile and
+    TextureImage objects, and hence its own OpenGL textures; only the
+    decoded arrays are shared.  The library holds only weak
+    references to them, so each is freed once no bundle is using it
+    any more.
+    """
+
+    def __init__(self, assetCache = None, verbose = True):
+        # The filename of each bundle, and the MpcdiFile, once it has
+        # been opened, by bundle id.
+        self.filenames = {}
+        self.bundles = {}
+        self.bundleIdList = []  # sorted in the order added
+
+        # The decoded arrays shared between bundles, by the key
+        # returned by MpcdiFile.getSubfileKey(); and the (kind, size,
+        # CRC-32) of the subfile each was decoded from, by the same
+        # key, for mightShareAsset().
+        self.assets = weakref.WeakValueDictionary()
+        self.assetStubs = {}
+        self.numAssetsShared = 0
+
+        self.assetCache = assetCache
+        self.verbose = verbose
+
+    def addBundle(self, filename, bundleId = None):
+        """ Adds the indicated mpcdi file to the library, without
+        opening it, and returns its bundle id.  If bundleId is
+        omitted, the filename itself is used.  Adding the same bundle
+        again has no effect. """
+
+        if bundleId is None:
+            bundleId = filename
+        if bundleId in self.filenames:
+            if os.path.abspath(self.filenames[bundleId]) != os.path.abspath(filename):
+                raise StandardError, 'Bundle %s is already defined as %s' % (bundleId, self.filenames[bundleId])
+            return bundleId
+
+        self.filenames[bundleId] = filename
+        self.bundleIdList.append(bundleId)
+        return bundleId
+
+    def getBundle(self, bundleId):
+        """ Returns the MpcdiFile for the indicated bundle, opening
+        it if necessary. """
+
+        mpcdi = self.bundles.get(bundleId, None)
+        if mpcdi is None:
+            mpcdi = MpcdiFile(assetCache = self.assetCache, lazy = True,
+                              verbose = self.verbose)
+            mpcdi.library = self
+            mpcdi.read(self.filenames[bundleId])
+            self.bundles[bundleId] = mpcdi
+        return mpcdi
+
+    def closeBundle(self, bundleId):
+        """ Forgets the opened MpcdiFile for the indicated bundle, if
+        any; it will be reopened if it is needed again.  The assets it
+        decoded are freed as soon as nothing else is using them. """
+
+        mpcdi = self.bundles.pop(bundleId, None)
+        if mpcdi is not None and mpcdi.zip:
+            mpcdi.zip.close()
+
+    def setAssetCache(self, assetCache):
+        """ Sets the AssetCache used by all of the bundles, including
+        those already opened. """
+
+        self.assetCache = assetCache
+        for mpcdi in self.bundles.values():
+            mpcdi.assetCache = assetCache
+
+    def getBufferIds(self, bundleId):
+        """ Returns the sorted list of buffer ids defined in the
+        indicated bundle. """
+        return sorted(self.getBundle(bundleId).buffers.keys())
+
+    def getRegion(self, bundleId, regionId):
+        """ Returns the RegionDef for the indicated region of the
+        indicated bundle. """
+        return self.getBundle(bundleId).getRegion(regionId)
+
+    def findRegions(self, regionId = None, bufferId = None, bundleIds = None):
+        """ Returns a list of (bundleId, RegionSummary) for each
+        region, across all of the bundles (or only those named in
+        bundleIds), that matches regionId and bufferId.  Either may
+        be None to match any id.  Only the index of each bundle is
+        read. """
+
+        if bundleIds is None:
+            bundleIds = self.bundleIdList
+
+        result = []
+        for bundleId in bundleIds:
+            mpcdi = self.getBundle(bundleId)
+            for id in mpcdi.regionIdList:
+                summary = mpcdi.regionIndex[id]
+                if regionId is not None and summary.id != regionId:
+                    continue
+                if bufferId is not None and summary.buffer.id != bufferId:
+                    continue
+                result.append((bundleId, summary))
+        return result
+
+    def findSharedAsset(self, key):
+        """ Returns the decoded array previously stored with
+        storeSharedAsset() under the indicated key, or None. """
+
+        array = self.assets.get(key, None)
+        if array is not None:
+            self.numAssetsShared += 1
+        return array
+
+    def storeSharedAsset(self, key, array, stub = None):
+        """ Records the decoded array for the indicated key, for the
+        benefit of the other bundles.  stub is the (kind, size,
+        CRC-32) of the subfile it was decoded from; see
+        mightShareAsset(). """
+        self.assets[key] = array
+        if stub is not None:
+            self.assetStubs[key] = stub
+
+    def mightShareAsset(self, stub):
+        """ Returns true if an asset decoded from a subfile with the
+        indicated (kind, size, CRC-32) is still in the library, so
+        that a bundle needn't read a subfile to compute its key when
+        no asset could match it.  A CRC-32 of None (for a file in a
+        directory) matches any. """
+
+        kind, size, crc = stub
+        for key, (assetKind, assetSize, assetCrc) in self.assetStubs.items():
+            if key not in self.assets:
+                # It has been freed.
+                del self.assetStubs[key]
+                continue
+            if assetKind == kind and assetSize == size and \
+               (crc is None or assetCrc is None or assetCrc == crc):
+                return True
+        return False
+
+    def purgeAssets(self):
+        """ Forgets all of the shared assets.  Those still in use by a
+        warp remain in memory until the warp is freed. """
+        self.assets = weakref.WeakValueDictionary()
+        self.assetStubs = {}
@@ -0,0 +1,173 @@
+import os
+import sys
+import getopt
+import ctypes
+
+# The offscreen backends that may be selected.  "egl" uses an EGL
+# display with no window system (Mesa's surfaceless platform, or a
+# GPU driver's default display), and "osmesa" uses Mesa's off-screen
+# software renderer.
+backends = ['egl', 'osmesa']
+
+# The backend selected by selectPlatform(), or None if OpenGL
+# contexts are created with GLUT windows as usual.
+backend = None
+
+# The one OffscreenContext, created by getContext().
+context = None
+
+def selectPlatform(name):
+    """ Selects the indicated offscreen backend.  PyOpenGL binds to its
+    platform (GLX, EGL or OSMesa) when it is first imported, so this
+    must be called before anything imports OpenGL; and once it has
+    been, GLUT can no longer be used. """
+
+    global backend
+    if name not in backends:
+        raise StandardError, 'Unknown offscreen backend %s' % (name)
+    if 'OpenGL.platform' in sys.modules and os.environ.get('PYOPENGL_PLATFORM') != name:
+        raise StandardError, 'OpenGL has already been imported; select the offscreen backend first'
+
+    os.environ['PYOPENGL_PLATFORM'] = name
+    if name == 'egl':
+        # Without this, Mesa's EGL looks for an X or Wayland display.
+        os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+    backend = name
+
+def selectPlatformFromArgs(args, shortOptions):
+    """ Looks for -H backend among the indicated command-line
+    arguments, parsed with the indicated getopt option string, and
+    selects that backend.  Errors in the arguments, or an unknown
+    backend, are left for the program's own option parsing to
+    report. """
+
+    try:
+        opts, args = getopt.getopt(args, shortOptions)
+    except getopt.error:
+        return
+
+    for opt, arg in opts:
+        if opt == '-H' and arg in backends:
+            selectPlatform(arg)
+
+class OffscreenContext:
+    """
+    An OpenGL context that needs no window system at all, for
+    rendering into framebuffer objects on a headless machine.  The
+    context is created with the backend chosen by selectPlatform(),
+    either of which works with Mesa's software renderer on a machine
+    with no GPU.
+
+    The default framebuffer is only a placeholder (a 1x1 pbuffer, or
+    nothing at all where the driver allows it); all of the rendering
+    is expected to go into framebuffer objects.
+    """
+
+    def __init__(self):
+        self.display = None
+        self.surface = None
+        self.context = None
+        self.buffer = None
+
+        if backend == 'egl':
+            self.__createEgl()
+        elif backend == 'osmesa':
+            self.__createOSMesa()
+        else:
+            raise StandardError, 'No offscreen backend has been selected'
+
+    def __createEgl(self):
+        from OpenGL import EGL
+
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not self.display or not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise StandardError, 'Could not initialize EGL'
+
+        attribs = [
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE, 8,
+            EGL.EGL_GREEN_SIZE, 8,
+            EGL.EGL_BLUE_SIZE, 8,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE,
+            ]
+        config = EGL.EGLConfig()
+        numConfigs = EGL.EGLint()
+        EGL.eglChooseConfig(self.display, (EGL.EGLint * len(attribs))(*attribs),
+                            ctypes.pointer(config), 1, ctypes.pointer(numConfigs))
+        if numConfigs.value < 1:
+            raise StandardError, 'No EGL config supports desktop OpenGL in a pbuffer'
+
+        # The pbuffer is never drawn to, but some drivers won't make a
+        # context current without a surface.
+        attribs = [EGL.EGL_WIDTH, 1, EGL.EGL_HEIGHT, 1, EGL.EGL_NONE]
+        self.surface = EGL.eglCreatePbufferSurface(self.display, config,
+                                                   (EGL.EGLint * len(attribs))(*attribs))
+        if not self.surface:
+            # We can still go on, if the driver supports surfaceless
+            # contexts.
+            self.surface = EGL.EGL_NO_SURFACE
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not self.context:
+            raise StandardError, 'Could not create an EGL context'
+
+    def __createOSMesa(self):
+        from OpenGL import osmesa, arrays
+
+        self.context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self.context:
+            raise StandardError, 'Could not create an OSMesa context'
+
+        # OSMesa always renders into a buffer in our memory; this one
+        # is only the placeholder.
+        self.buffer = arrays.GLubyteArray.zeros((1, 1, 4))
+
+    def makeCurrent(self):
+        if backend == 'egl':
+            from OpenGL import EGL
+            if not EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+                raise StandardError, 'Could not make the EGL context current'
+        else:
+            from OpenGL import osmesa
+            from OpenGL.GL import GL_UNSIGNED_BYTE
+            if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL_UNSIGNED_BYTE, 1, 1):
+                raise StandardError, 'Could not make the OSMesa context current'
+
+    def release(self):
+        """ Destroys the context, and everything created within it. """
+
+        if backend == 'egl':
+            from OpenGL import EGL
+            EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+            EGL.eglDestroyContext(self.display, self.context)
+            if self.surface:
+                EGL.eglDestroySurface(self.display, self.surface)
+            EGL.eglTerminate(self.display)
+        else:
+            from OpenGL import osmesa
+            osmesa.OSMesaDestroyContext(self.context)
+
+        self.display = None
+        self.surface = None
+        self.context = None
+        self.buffer = None
+
+def getContext():
+    """ Returns the one OffscreenContext, creating it the first time,
+    and makes it current.  All of the windows share it, each with its
+    own framebuffer object. """
+
+    global context
+    if context is None:
+        context = OffscreenContext()
+    context.makeCurrent()
+    return context
+
+def releaseContext():
+    global context
+    if context is not None:
+        context.release()
+        context = None
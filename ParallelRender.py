@@ -0,0 +1,173 @@
+from TextureImage import TextureImage
+import MediaSequence
+import RemapTable
+import multiprocessing
+import tempfile
+import hashlib
+import shutil
+import numpy
+import time
+import os
+
+# The list of MpacsWarp2DNumPy objects being rendered.  This is set up
+# in the parent process before the pool is created, so each worker
+# inherits the warps (and their pfm grids and decoded blend maps)
+# through fork(), instead of receiving a pickled copy.
+warps = []
+
+# The directory holding the decoded media frames, as .npy files that
+# each worker memory-maps; the operating system shares the pages
+# between all of the processes.
+scratchDirectory = None
+
+# The number of distinct media files decoded into the scratch
+# directory at a time.  All of the frames that use them are rendered,
+# and the decoded copies deleted, before the next batch is decoded, so
+# that a long sequence never needs RAM (or /dev/shm) for all of its
+# frames at once.
+mediaBatchSize = 32
+
+class RenderJob:
+    """ A single frame to render: the index of a warp in warps, the
+    media filename, and the output filename. """
+
+    def __init__(self, warpIndex, mediaFilename, outputFilename):
+        self.warpIndex = warpIndex
+        self.mediaFilename = mediaFilename
+        self.outputFilename = outputFilename
+
+def renderWindows(windows, numProcesses, chunkSize = None):
+    """ Renders all of the frames requested by the indicated main.py
+    Window objects, each of which must already have set up an
+    MpacsWarp2DNumPy object, across a pool of numProcesses worker
+    processes.  Regions and frame ranges are independent, so they are
+    all fanned out across the pool together, mediaBatchSize media
+    files at a time. """
+
+    global warps, scratchDirectory
+
+    warps = []
+    jobs = []
+    for window in windows:
+        warpIndex = len(warps)
+        warps.append(window.warp)
+        if window.inputSequence:
+            filenames = MediaSequence.listMediaSequence(window.inputSequence)
+            for frameIndex in range(len(filenames)):
+                jobs.append(RenderJob(warpIndex, filenames[frameIndex],
+                                      window.outputPattern % (frameIndex)))
+        else:
+            jobs.append(RenderJob(warpIndex, window.mediaFilename, window.outputFilename))
+
+    if not jobs:
+        return
+
+    # Prefer a RAM-backed filesystem for the decoded frames.
+    if os.path.isdir('/dev/shm'):
+        scratchDirectory = tempfile.mkdtemp(prefix = 'pympcdi', dir = '/dev/shm')
+    else:
+        scratchDirectory = tempfile.mkdtemp(prefix = 'pympcdi')
+
+    # Unless the remap tables are already being cached, share them
+    # through the scratch directory, so that each region is compiled
+    # only once rather than once per worker.
+    savedCacheDirectory = RemapTable.cacheDirectory
+    if not RemapTable.cacheDirectory:
+        RemapTable.cacheDirectory = os.path.join(scratchDirectory, 'remap')
+
+    # The jobs that use each distinct media file, with the files in
+    # the order they are first needed.
+    mediaFilenames = []
+    mediaJobs = {}
+    for job in jobs:
+        if job.mediaFilename not in mediaJobs:
+            mediaFilenames.append(job.mediaFilename)
+            mediaJobs[job.mediaFilename] = []
+        mediaJobs[job.mediaFilename].append(job)
+
+    startTime = time.time()
+    decodeTime = 0.0
+    compileTime = 0.0
+    tables = set()
+    pool = multiprocessing.Pool(numProcesses)
+    try:
+        for i in range(0, len(mediaFilenames), mediaBatchSize):
+            batchFilenames = mediaFilenames[i : i + mediaBatchSize]
+            batchJobs = []
+            for mediaFilename in batchFilenames:
+                batchJobs += mediaJobs[mediaFilename]
+
+            # First, decode each distinct media file in the batch
+            # exactly once.
+            t = time.time()
+            mediaSizes = dict(zip(batchFilenames, pool.map(decodeMedia, batchFilenames)))
+            decodeTime += time.time() - t
+
+            # Then compile the remap table for each region and media
+            # size that hasn't been seen already.
+            t = time.time()
+            batchTables = set([(job.warpIndex, mediaSizes[job.mediaFilename]) for job in batchJobs])
+            pool.map(compileTable, sorted(batchTables - tables))
+            tables |= batchTables
+            compileTime += time.time() - t
+
+            # Finally, render the batch's frames, in chunks so that
+            # each worker keeps reusing the same regions.
+            batchChunkSize = chunkSize
+            if not batchChunkSize:
+                batchChunkSize = max(1, len(batchJobs) / (numProcesses * 4))
+            pool.map(renderJob, batchJobs, batchChunkSize)
+
+            for mediaFilename in batchFilenames:
+                os.unlink(getMediaScratchFilename(mediaFilename))
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        RemapTable.cacheDirectory = savedCacheDirectory
+        shutil.rmtree(scratchDirectory, ignore_errors = True)
+
+    totalTime = time.time() - startTime
+    print "Rendered %s frames of %s regions with %s processes in %.2f s (%.2f s decoding %s media files, %.2f s compiling %s remap tables)" % (
+        len(jobs), len(warps), numProcesses, totalTime,
+        decodeTime, len(mediaFilenames), compileTime, len(tables))
+
+def getMediaScratchFilename(mediaFilename):
+    """ Returns the filename of the decoded copy of the indicated media
+    file within the scratch directory. """
+    key = hashlib.sha1(mediaFilename).hexdigest()
+    return os.path.join(scratchDirectory, 'media_%s.npy' % (key))
+
+def decodeMedia(mediaFilename):
+    """ Worker function: decodes the media file into the scratch
+    directory, and returns its size as (width, height). """
+
+    array = TextureImage(mediaFilename).getArray()
+    numpy.save(getMediaScratchFilename(mediaFilename), array)
+    return (array.shape[1], array.shape[0])
+
+def loadMedia(mediaFilename):
+    """ Returns a TextureImage for the decoded media in the scratch
+    directory, memory-mapped rather than read. """
+
+    array = numpy.load(getMediaScratchFilename(mediaFilename), mmap_mode = 'r')
+    return TextureImage(mediaFilename, array = array)
+
+def compileTable(args):
+    """ Worker function: compiles (and caches) the remap table for the
+    indicated warp and media size. """
+
+    warpIndex, mediaSize = args
+    RemapTable.compileRemapTable(warps[warpIndex], mediaSize)
+
+def renderJob(job):
+    """ Worker function: renders a single frame. """
+
+    warp = warps[job.warpIndex]
+    warp.setMedia(loadMedia(job.mediaFilename))
+    warp.setOutputFilename(job.outputFilename)
+    warp.draw()
+    warp.finishOutput()
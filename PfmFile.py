@@ -1,24 +1,61 @@
 import string
+import numpy
+import Profiler
+
+# The header is just a magic number and three small numbers; this is
+# more than enough to hold it.
+maxHeaderSize = 1024
 
 class PfmFile:
-    def __init__(self, filename = None, data = None):
+    def __init__(self, filename = None, data = None, array = None):
         self.filename = None
         self.data = None
+        self.array = None
 
-        if filename or data:
+        if array is not None:
+            self.setArray(array, filename = filename)
+        elif filename or data is not None:
             self.read(filename = filename, data = data)
 
+    def setArray(self, array, filename = None):
+        """ Sets the pfm data from an already-decoded array of shape
+        (ySize, xSize, numComponents), for instance one loaded from an
+        AssetCache. """
+
+        self.filename = filename
+        self.data = None
+        self.array = array
+        self.ySize, self.xSize, self.numComponents = array.shape
+        self.dtype = array.dtype
+        self.shape = array.shape
+        self.dataOffset = None
+        if self.dtype.byteorder == '>':
+            self.scale = 1.0
+        else:
+            self.scale = -1.0
+
+    @Profiler.profiled('PfmFile.read')
     def read(self, filename = None, data = None):
-        """ Reads the pfm file and stores the data internally.  If
-        data is not None, it provides the pre-read pfm file data as a
-        Python string. """
-        
+        """ Reads the pfm file header.  If data is not None, it
+        provides the pre-read pfm file data as a Python string or any
+        other object supporting the buffer interface (for instance, a
+        numpy array or mmap); otherwise, only the header is read from
+        disk here, and the payload is memory-mapped by getArray() the
+        first time it is needed. """
+
         self.filename = filename
+        self.data = data
+        self.array = None
+
         if data is None:
-            data = open(filename, 'rb').read()
+            file = open(filename, 'rb')
+            header = file.read(maxHeaderSize)
+            file.close()
+        else:
+            header = memoryview(data)[:maxHeaderSize].tobytes()
 
         # First two characters are the magic number.
-        magicNumber = data[:2]
+        magicNumber = header[:2]
         if magicNumber == 'PF':
             self.numComponents = 3
         elif magicNumber == 'Pf':
@@ -30,18 +67,44 @@ class PfmFile:
         # characters preceding each one, and exactly one whitespace
         # character following each one.
         p = 2
-        self.xSize, p = self.__readNumber(data, p, int)
-        self.ySize, p = self.__readNumber(data, p, int)
-        self.scale, p = self.__readNumber(data, p, float)
-        self.data = data[p:]
-
-        assert len(self.data) == self.xSize * self.ySize * self.numComponents * 4
+        self.xSize, p = self.__readNumber(header, p, int)
+        self.ySize, p = self.__readNumber(header, p, int)
+        self.scale, p = self.__readNumber(header, p, float)
+        self.dataOffset = p
 
         # The pfm scale is defined to be negative if the data is
-        # little-endian, and positive if it is big-endian.  We don't
-        # attempt to convert it here; this assertion assumes that we
-        # are running on a little-endian machine.
-        assert self.scale < 0
+        # little-endian, and positive if it is big-endian.
+        if self.scale < 0:
+            self.dtype = numpy.dtype('<f4')
+        else:
+            self.dtype = numpy.dtype('>f4')
+
+        self.shape = (self.ySize, self.xSize, self.numComponents)
+
+    def getArray(self):
+        """ Returns the pfm payload as a read-only numpy array of shape
+        (ySize, xSize, numComponents), in the byte order of the file.
+        This is a view onto the original data, or a memory map of the
+        file on disk; it is not a copy. """
+
+        if self.array is None:
+            self.array = self.__mapArray()
+
+        return self.array
+
+    @Profiler.profiled('PfmFile.getArray', Profiler.arrayBytes)
+    def __mapArray(self):
+        count = self.xSize * self.ySize * self.numComponents
+        if self.data is None:
+            array = numpy.memmap(self.filename, dtype = self.dtype, mode = 'r',
+                                 offset = self.dataOffset, shape = self.shape)
+        else:
+            assert len(memoryview(self.data)) - self.dataOffset == count * 4
+            array = numpy.frombuffer(self.data, dtype = self.dtype,
+                                     count = count, offset = self.dataOffset)
+            array = array.reshape(self.shape)
+            array.flags.writeable = False
+        return array
 
     def __readNumber(self, data, p, type):
         """ Finds q, the next whitespace character following a number
@@ -57,4 +120,3 @@ class PfmFile:
             q += 1
 
         return type(data[p:q]), q + 1
-    
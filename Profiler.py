@@ -0,0 +1,204 @@
+import threading
+import atexit
+import ctypes
+import ctypes.util
+import json
+import time
+import os
+
+# Set true by enable().  While this is false, span() returns a shared
+# do-nothing object, so the instrumentation costs only a function
+# call.
+enabled = False
+
+# The list of recorded spans, each a tuple (name, startNs, durationNs,
+# threadId, numBytes).
+events = []
+
+# The file to which the profile is written at exit, if any.
+outputFilename = None
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+
+def findClock():
+    """ Returns the clock_gettime() function from the C library, or
+    None if it isn't available. """
+    for name in ['c', 'rt']:
+        libname = ctypes.util.find_library(name)
+        if not libname:
+            continue
+        try:
+            lib = ctypes.CDLL(libname, use_errno = True)
+            clock_gettime = lib.clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        return clock_gettime
+    return None
+
+clock_gettime = findClock()
+
+def getNanoseconds():
+    """ Returns the current time of a monotonic clock, in integer
+    nanoseconds.  Where clock_gettime() isn't available, this falls
+    back to time.time(), which is neither monotonic nor as
+    precise. """
+
+    if clock_gettime:
+        t = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+        return t.tv_sec * 1000000000 + t.tv_nsec
+    return int(time.time() * 1e9)
+
+class Span:
+    """ A named interval of time being measured; use it as a context
+    manager.  Call addBytes() within it to record the amount of data
+    it processed. """
+
+    def __init__(self, name, numBytes):
+        self.name = name
+        self.numBytes = numBytes
+        self.start = None
+
+    def __enter__(self):
+        self.start = getNanoseconds()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        duration = getNanoseconds() - self.start
+        events.append((self.name, self.start, duration, threading.currentThread().ident, self.numBytes))
+        return False
+
+    def addBytes(self, numBytes):
+        self.numBytes += numBytes
+
+class NullSpan:
+    """ The do-nothing span returned by span() while profiling is
+    disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def addBytes(self, numBytes):
+        pass
+
+nullSpan = NullSpan()
+
+def span(name, numBytes = 0):
+    """ Returns a context manager that records the time spent within
+    it under the indicated name, if profiling is enabled. """
+
+    if not enabled:
+        return nullSpan
+    return Span(name, numBytes)
+
+def profiled(name, getBytes = None):
+    """ Returns a decorator that records each call to the decorated
+    function as a span under the indicated name.  If getBytes is
+    given, it is called with the function's return value to count the
+    bytes processed.  While profiling is disabled, the function is
+    called directly. """
+
+    def decorator(func):
+        def wrapper(*args, **kw):
+            if not enabled:
+                return func(*args, **kw)
+            s = Span(name, 0)
+            s.__enter__()
+            try:
+                result = func(*args, **kw)
+                if getBytes and result is not None:
+                    s.addBytes(getBytes(result))
+                return result
+            finally:
+                s.__exit__(None, None, None)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+def arrayBytes(array):
+    """ A getBytes function for profiled() that counts the size of a
+    returned numpy array. """
+    return array.nbytes
+
+def enable(filename = None):
+    """ Starts recording spans.  If filename is given, the profile is
+    written there when the program exits; see write(). """
+
+    global enabled, outputFilename
+    enabled = True
+    if filename and not outputFilename:
+        atexit.register(writeAtExit)
+    outputFilename = filename
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    del events[:]
+
+def getSummary():
+    """ Returns a dictionary of the totals for each span name: the
+    count, the total, minimum and maximum times in nanoseconds, and
+    the total bytes. """
+
+    summary = {}
+    for name, start, duration, threadId, numBytes in events:
+        entry = summary.get(name, None)
+        if entry is None:
+            entry = {'count' : 0, 'totalNs' : 0, 'minNs' : duration, 'maxNs' : duration, 'bytes' : 0}
+            summary[name] = entry
+        entry['count'] += 1
+        entry['totalNs'] += duration
+        entry['minNs'] = min(entry['minNs'], duration)
+        entry['maxNs'] = max(entry['maxNs'], duration)
+        entry['bytes'] += numBytes
+    return summary
+
+def getChromeTrace():
+    """ Returns the recorded spans in the Chrome trace event format
+    (as read by chrome://tracing and Perfetto), with the summary from
+    getSummary() included under the key 'summary'. """
+
+    pid = os.getpid()
+    traceEvents = []
+    for name, start, duration, threadId, numBytes in events:
+        event = {
+            'name' : name,
+            'ph' : 'X',
+            'ts' : start / 1000.0,
+            'dur' : duration / 1000.0,
+            'pid' : pid,
+            'tid' : threadId,
+            }
+        if numBytes:
+            event['args'] = {'bytes' : numBytes}
+        traceEvents.append(event)
+
+    return {
+        'traceEvents' : traceEvents,
+        'displayTimeUnit' : 'ns',
+        'summary' : getSummary(),
+        }
+
+def write(filename):
+    """ Writes the profile to the indicated file, as JSON in the
+    Chrome trace event format. """
+
+    file = open(filename, 'w')
+    json.dump(getChromeTrace(), file, sort_keys = True)
+    file.close()
+
+def writeAtExit():
+    if outputFilename:
+        write(outputFilename)
+        print "Wrote profile of %s spans to %s" % (len(events), outputFilename)
@@ -0,0 +1,150 @@
+import os
+import hashlib
+import numpy
+
+# If this is set to a directory name, compiled tables are saved there
+# and reused on subsequent runs.
+cacheDirectory = None
+
+# Bump this whenever the table layout or the warping math changes, so
+# that stale tables in the cache are ignored.
+formatVersion = 1
+
+class RemapTable:
+    """
+    A region's warp compiled down to a per-output-pixel lookup table.
+
+    For each pixel of the output window, the table records the flat
+    indices of the four media pixels surrounding its sample point,
+    and the bilinear weight of each.  Since the pfm grid, the region
+    transform and the V-flip never change for a region, all of the
+    coordinate math is done once; after that, warping a frame is a
+    single gather and weighted sum.  The table depends on the media
+    size, but not on the media contents.
+    """
+
+    def __init__(self, filename = None):
+        self.windowSize = None
+        self.mediaSize = None
+
+        # int32 of shape (height, width, 4): flat media pixel indices.
+        self.indices = None
+
+        # float16 of shape (height, width, 4): bilinear weights.
+        # These are all zero for output pixels that don't see the
+        # media at all (for instance, NaN's in the pfm file).
+        self.weights = None
+
+        if filename:
+            self.read(filename)
+
+    def compile(self, warp, mediaSize):
+        """ Computes the table for the indicated MpacsWarp2D object
+        and media size (width, height). """
+
+        self.windowSize = tuple(warp.windowSize)
+        self.mediaSize = tuple(mediaSize)
+        mediaWidth, mediaHeight = self.mediaSize
+
+        u, v, pfmX, pfmY = warp.computeMediaUVs()
+        x = u * mediaWidth - 0.5
+        y = v * mediaHeight - 0.5
+
+        valid = ~(numpy.isnan(x) | numpy.isnan(y))
+        x = numpy.clip(numpy.where(valid, x, 0), 0, mediaWidth - 1)
+        y = numpy.clip(numpy.where(valid, y, 0), 0, mediaHeight - 1)
+
+        x0 = numpy.minimum(x.astype('int32'), max(mediaWidth - 2, 0))
+        y0 = numpy.minimum(y.astype('int32'), max(mediaHeight - 2, 0))
+        x1 = numpy.minimum(x0 + 1, mediaWidth - 1)
+        y1 = numpy.minimum(y0 + 1, mediaHeight - 1)
+        fx = x - x0
+        fy = y - y0
+
+        self.indices = numpy.dstack([
+            y0 * mediaWidth + x0, y0 * mediaWidth + x1,
+            y1 * mediaWidth + x0, y1 * mediaWidth + x1]).astype('int32')
+
+        weights = numpy.dstack([
+            (1 - fx) * (1 - fy), fx * (1 - fy),
+            (1 - fx) * fy, fx * fy])
+        weights[~valid] = 0
+        self.weights = weights.astype('float16')
+
+    def apply(self, media):
+        """ Warps media, an array of shape (mediaHeight, mediaWidth,
+        numChannels), and returns a float32 array of shape (height,
+        width, numChannels) in the same units as the media. """
+
+        assert (media.shape[1], media.shape[0]) == self.mediaSize
+        flat = media.reshape(-1, media.shape[2])
+
+        result = numpy.zeros(self.indices.shape[:2] + (flat.shape[1],), dtype = 'float32')
+        for i in range(4):
+            weight = self.weights[:,:,i:i+1].astype('float32')
+            result += flat[self.indices[:,:,i]] * weight
+        return result
+
+    def getValidMask(self):
+        """ Returns a boolean array of shape (height, width), true for
+        the output pixels that see the media. """
+        return self.weights.any(axis = 2)
+
+    def write(self, filename):
+        """ Saves the table to the indicated filename.  The file is
+        written under a temporary name and renamed into place, so a
+        concurrent reader never sees a partial table. """
+
+        tempFilename = '%s.%s.tmp' % (filename, os.getpid())
+        file = open(tempFilename, 'wb')
+        numpy.savez(file, version = formatVersion,
+                    windowSize = self.windowSize, mediaSize = self.mediaSize,
+                    indices = self.indices, weights = self.weights)
+        file.close()
+        os.rename(tempFilename, filename)
+
+    def read(self, filename):
+        """ Loads a table previously saved with write(). """
+
+        data = numpy.load(filename)
+        if int(data['version']) != formatVersion:
+            raise StandardError, 'Remap table %s has the wrong version' % (filename)
+        self.windowSize = tuple(data['windowSize'])
+        self.mediaSize = tuple(data['mediaSize'])
+        self.indices = data['indices']
+        self.weights = data['weights']
+
+def getCacheKey(warp, mediaSize):
+    """ Returns a string that uniquely identifies the table that would
+    be compiled for the indicated warp and media size. """
+
+    key = '%s %s %s %s %s' % (
+        formatVersion, warp.mpcdi.getContentHash(), warp.region.id,
+        tuple(warp.windowSize), tuple(mediaSize))
+    return hashlib.sha1(key).hexdigest()
+
+def compileRemapTable(warp, mediaSize):
+    """ Returns a RemapTable for the indicated MpacsWarp2D object and
+    media size, loading it from cacheDirectory if it has been compiled
+    before, or compiling it (and saving it there) if not. """
+
+    if not cacheDirectory:
+        table = RemapTable()
+        table.compile(warp, mediaSize)
+        return table
+
+    filename = os.path.join(cacheDirectory, getCacheKey(warp, mediaSize) + '.npz')
+    if os.path.exists(filename):
+        try:
+            return RemapTable(filename)
+        except Exception, e:
+            print "Ignoring unreadable remap table %s: %s" % (filename, e)
+
+    table = RemapTable()
+    table.compile(warp, mediaSize)
+
+    if not os.path.isdir(cacheDirectory):
+        os.makedirs(cacheDirectory)
+    table.write(filename)
+    print "Wrote %s" % (filename)
+    return table
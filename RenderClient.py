@@ -0,0 +1,193 @@
+help = """
+RenderClient.py
+
+This program sends render requests to a running RenderServer.py, and
+reports how long each one took.  See RenderServer.py -h.
+
+Options:
+
+    -S socketFilename
+        The Unix socket the server is listening on.  The default is
+        %s.
+
+    -m mpcdiFilename
+        The mpcdi file to render.  This is required.
+
+    -r regionName
+        The name of a region to render.  This option may be repeated;
+        if it is omitted, every region in the file is rendered.
+
+    -i mediaFilename
+        The media file to warp.  The default is a plain grid.
+
+    -o outputFilename
+        The image filename to save the warped output to.  If more
+        than one region is rendered, this must contain "%%s", which
+        is replaced by the name of each region.
+
+    -N count
+        Send the same request this many times, and report the
+        latency of each.  The default is 1.
+
+    -p
+        Only check that the server is responding.
+
+    -t
+        Print the server's statistics.
+
+    -x
+        Ask the server to shut down.
+
+    -h
+        Show this help.
+
+"""
+
+import socket
+import getopt
+import json
+import time
+import sys
+import os
+
+# The socket the server listens on, unless another is specified.
+defaultSocketFilename = '/tmp/pympcdi_render.sock'
+
+def usage(code, msg = ''):
+    print >> sys.stderr, help % (defaultSocketFilename)
+    print >> sys.stderr, msg
+    sys.exit(code)
+
+def writeMessage(file, message):
+    """ Sends the indicated dictionary as one line of JSON. """
+    file.write(json.dumps(message) + '\n')
+    file.flush()
+
+def readMessage(file):
+    """ Reads one line of JSON, and returns the dictionary, or None at
+    the end of the stream. """
+    line = file.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+class RenderClient:
+    """
+    A connection to a RenderServer.  Each method sends one request
+    and waits for the response, which is returned as a dictionary.
+    Requests that fail on the server raise StandardError.
+
+    The filenames in a request are made absolute here, since the
+    server may not be running in the same directory.
+    """
+
+    def __init__(self, socketFilename = None):
+        if socketFilename is None:
+            socketFilename = defaultSocketFilename
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socketFilename)
+        self.file = self.socket.makefile('rw')
+
+    def render(self, mpcdiFilename, mediaFilename, outputFilename, regions = None):
+        """ Renders the indicated media through the indicated regions
+        of the mpcdi file (or all of them, if regions is None), and
+        saves the results.  If more than one region is rendered, the
+        output filename must contain "%s", which is replaced by each
+        region name.  The images have been written by the time this
+        returns. """
+
+        request = {
+            'mpcdi' : os.path.abspath(mpcdiFilename),
+            'media' : os.path.abspath(mediaFilename),
+            'output' : os.path.abspath(outputFilename),
+            }
+        if regions is not None:
+            request['regions'] = list(regions)
+        return self.send(request)
+
+    def ping(self):
+        return self.send({ 'command' : 'ping' })
+
+    def getStats(self):
+        return self.send({ 'command' : 'stats' })
+
+    def shutdown(self):
+        return self.send({ 'command' : 'shutdown' })
+
+    def send(self, request):
+        writeMessage(self.file, request)
+        response = readMessage(self.file)
+        if response is None:
+            raise StandardError, 'The render server closed the connection'
+        if response.get('status') != 'ok':
+            raise StandardError, response.get('message', 'The render server failed')
+        return response
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'S:m:r:i:o:N:ptxh')
+    except getopt.error, msg:
+        usage(1, msg)
+
+    socketFilename = None
+    mpcdiFilename = None
+    regions = None
+    mediaFilename = 'color_grid.png'
+    outputFilename = None
+    count = 1
+    command = None
+
+    for opt, arg in opts:
+        if opt == '-S':
+            socketFilename = arg
+        elif opt == '-m':
+            mpcdiFilename = arg
+        elif opt == '-r':
+            if regions is None:
+                regions = []
+            regions.append(arg)
+        elif opt == '-i':
+            mediaFilename = arg
+        elif opt == '-o':
+            outputFilename = arg
+        elif opt == '-N':
+            count = int(arg)
+        elif opt == '-p':
+            command = 'ping'
+        elif opt == '-t':
+            command = 'stats'
+        elif opt == '-x':
+            command = 'shutdown'
+        elif opt == '-h':
+            usage(0)
+
+    if not command and not (mpcdiFilename and outputFilename):
+        usage(1, 'Specify -m and -o, or -p, -t or -x.')
+
+    client = RenderClient(socketFilename)
+    try:
+        if command == 'stats':
+            print json.dumps(client.getStats(), indent = 2, sort_keys = True)
+        elif command:
+            client.send({ 'command' : command })
+        else:
+            for i in range(count):
+                startTime = time.time()
+                response = client.render(mpcdiFilename, mediaFilename, outputFilename, regions)
+                latency = time.time() - startTime
+                print "%s regions in %.1f ms (%.1f ms decoding, %.1f ms queued, %.1f ms rendering a batch of %s)" % (
+                    len(response['outputs']), latency * 1000.0, response['decodeTime'],
+                    response['queueTime'], response['renderTime'], response['batchSize'])
+    except StandardError, e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    finally:
+        client.close()
+
+if __name__ == '__main__':
+    main()
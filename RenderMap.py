@@ -0,0 +1,192 @@
+from MpacsWarp2DNumPy import linearizeBlendMaps
+import os
+import hashlib
+import numpy
+import Profiler
+
+# Set this true to have the shader renderer draw with a RenderMap
+# where it can, stored in the indicated format.
+useRenderMap = False
+renderMapFormat = 'unorm16'
+
+# If this is set to a directory name, compiled render maps are saved
+# there and reused on subsequent runs.
+cacheDirectory = None
+
+# Bump this whenever the layout of the map or the warping math
+# changes, so that stale maps in the cache are ignored.
+formatVersion = 1
+
+# The formats a render map may be stored in, and the numpy type of
+# each.
+renderMapTypes = {
+    'unorm16' : 'uint16',
+    'float16' : 'float16',
+    }
+
+class RenderMap:
+    """
+    A region's warp and blend fused into one four-channel image at
+    the resolution of the output window, so that the shader renderer
+    needs only two texture fetches per fragment: the render map, then
+    the media.
+
+    The first two channels hold the media texture coordinate seen by
+    the center of each output pixel, after the pfm lookup and the
+    warp matrix; the other two hold the linearized blend, as a scale,
+    alpha * (1 - beta), and an offset, beta.  Output pixels that
+    don't see the media (NaN's in the pfm file) have a scale and
+    offset of zero, so they are drawn black.
+
+    The map is stored either as normalized 16-bit integers
+    ('unorm16'), which resolve the media coordinate to 1/65535
+    everywhere, or as half floats ('float16'), which are coarser
+    toward 1.0.  The 'unorm16' format clamps the coordinates to [0,
+    1], as the GL_CLAMP media texture would anyway.  Only
+    single-channel blend maps can be stored.
+    """
+
+    def __init__(self, filename = None):
+        self.windowSize = None
+        self.format = None
+
+        # uint16 or float16 of shape (height, width, 4).
+        self.data = None
+
+        if filename:
+            self.read(filename)
+
+    @Profiler.profiled('RenderMap.compile')
+    def compile(self, warp, format = 'unorm16'):
+        """ Computes the map for the indicated MpacsWarp2D object at
+        its current window size. """
+
+        values = computeRenderValues(warp)
+
+        self.windowSize = tuple(warp.windowSize)
+        self.format = format
+        if format == 'unorm16':
+            values = numpy.clip(values, 0.0, 1.0)
+            self.data = numpy.round(values * 65535.0).astype('uint16')
+        elif format == 'float16':
+            self.data = values.astype('float16')
+        else:
+            raise StandardError, 'Unknown render map format %s' % (format)
+
+    def getValues(self):
+        """ Returns the map decoded to float32, as the shader sees
+        it. """
+
+        if self.format == 'unorm16':
+            return self.data.astype('float32') / 65535.0
+        return self.data.astype('float32')
+
+    def validate(self, warp):
+        """ Compares the map with the four-texture path for the
+        indicated warp (the pfm UV's, warp matrix and linearized
+        alpha and beta maps, as computed at full precision), and
+        returns (uvError, blendError): the maximum difference in the
+        media coordinate, in UV units, and in the blend scale or
+        offset, over the pixels that see the media. """
+
+        exact = computeRenderValues(warp)
+        if self.format == 'unorm16':
+            exact = numpy.clip(exact, 0.0, 1.0)
+
+        values = self.getValues()
+        valid = (exact[:,:,2] != 0) | (exact[:,:,3] != 0)
+        if not valid.any():
+            return 0.0, 0.0
+
+        error = numpy.abs(values - exact)[valid]
+        return float(error[:,0:2].max()), float(error[:,2:4].max())
+
+    def write(self, filename):
+        """ Saves the map to the indicated filename.  The file is
+        written under a temporary name and renamed into place, so a
+        concurrent reader never sees a partial map. """
+
+        tempFilename = '%s.%s.tmp' % (filename, os.getpid())
+        file = open(tempFilename, 'wb')
+        numpy.savez(file, version = formatVersion,
+                    windowSize = self.windowSize, format = self.format,
+                    data = self.data)
+        file.close()
+        os.rename(tempFilename, filename)
+
+    def read(self, filename):
+        """ Loads a map previously saved with write(). """
+
+        data = numpy.load(filename)
+        if int(data['version']) != formatVersion:
+            raise StandardError, 'Render map %s has the wrong version' % (filename)
+        self.windowSize = tuple(data['windowSize'])
+        self.format = str(data['format'])
+        self.data = data['data']
+        if self.data.dtype != numpy.dtype(renderMapTypes[self.format]):
+            raise StandardError, 'Render map %s has the wrong type' % (filename)
+
+def computeRenderValues(warp):
+    """ Returns the contents of the render map for the indicated warp
+    at full precision, as a float32 array of shape (height, width,
+    4). """
+
+    alpha = warp.alpha.getArray()
+    beta = warp.beta.getArray()
+    if alpha.shape[2] != 1 or beta.shape[2] != 1:
+        raise StandardError, 'Render maps support only single-channel blend maps'
+
+    u, v, pfmX, pfmY = warp.computeMediaUVs()
+    valid = ~(numpy.isnan(u) | numpy.isnan(v))
+
+    width, height = warp.windowSize
+    values = numpy.zeros((height, width, 4), dtype = 'float32')
+    values[:,:,0] = numpy.where(valid, u, 0.0)
+    values[:,:,1] = numpy.where(valid, v, 0.0)
+
+    if warp.includeBlend:
+        scale, offset = linearizeBlendMaps(alpha, warp.alphaGamma,
+                                           beta, warp.betaGamma, warp.windowSize)
+        values[:,:,2] = numpy.where(valid, scale[:,:,0], 0.0)
+        values[:,:,3] = numpy.where(valid, offset[:,:,0], 0.0)
+    else:
+        values[:,:,2] = numpy.where(valid, 1.0, 0.0)
+
+    return values
+
+def getCacheKey(warp, format):
+    """ Returns a string that uniquely identifies the map that would
+    be compiled for the indicated warp and format. """
+
+    key = '%s %s %s %s %s %s %s %s' % (
+        formatVersion, warp.mpcdi.getContentHash(), warp.region.id,
+        tuple(warp.windowSize), format, warp.includeBlend,
+        warp.alphaGamma, warp.betaGamma)
+    return hashlib.sha1(key).hexdigest()
+
+def compileRenderMap(warp, format = 'unorm16'):
+    """ Returns a RenderMap for the indicated MpacsWarp2D object,
+    loading it from cacheDirectory if it has been compiled before, or
+    compiling and validating it (and saving it there) if not. """
+
+    if cacheDirectory:
+        filename = os.path.join(cacheDirectory, getCacheKey(warp, format) + '.npz')
+        if os.path.exists(filename):
+            try:
+                return RenderMap(filename)
+            except Exception, e:
+                print "Ignoring unreadable render map %s: %s" % (filename, e)
+
+    renderMap = RenderMap()
+    renderMap.compile(warp, format)
+
+    uvError, blendError = renderMap.validate(warp)
+    print "%s render map: max UV error %.3g, max blend error %.3g" % (
+        warp.region.id, uvError, blendError)
+
+    if cacheDirectory:
+        if not os.path.isdir(cacheDirectory):
+            os.makedirs(cacheDirectory)
+        renderMap.write(filename)
+        print "Wrote %s" % (filename)
+    return renderMap
@@ -0,0 +1,607 @@
+help = """
+RenderServer.py
+
+This program is a long-running render service.  It keeps the mpcdi
+files it has read, and the warp objects it has initialized for their
+regions (with their meshes, textures and compiled shaders), for as
+long as it runs, and serves requests to render media through them
+over a Unix socket.  Each request then costs only the draw and the
+readback, instead of the whole startup of main.py.
+
+Each request and each response is one line of JSON.  A render
+request looks like this:
+
+    {"mpcdi": "/shows/a.mpcdi", "regions": ["r0", "r1"],
+     "media": "/frames/0001.png", "output": "/out/0001_%%s.png"}
+
+"regions" may be omitted to render every region in the file.  If more
+than one region is rendered, "%%s" in the output filename is replaced
+by each region name.  The response is sent once the images have been
+written:
+
+    {"status": "ok", "outputs": {"r0": ..., "r1": ...},
+     "decodeTime": ..., "queueTime": ..., "renderTime": ...,
+     "batchSize": ...}
+
+with the times in milliseconds; or {"status": "error", "message":
+...}.  {"command": "ping"}, {"command": "stats"} and {"command":
+"shutdown"} are also understood.  RenderClient.py sends these
+requests from the command line, or from Python.
+
+The requests from all of the connections are rendered by one thread,
+which owns the OpenGL context.  The requests that arrive while it is
+busy are gathered into a batch, and divided into a queue for each
+region.  The batch is rendered one media image at a time, through
+every region that shows it, so that each image is uploaded only once;
+the readbacks of the batch are collected together at the end.
+
+Options:
+
+    -S socketFilename
+        The Unix socket to listen on.  The default is %s.
+
+    -m mpcdiFilename
+        Load the indicated mpcdi file at startup, and initialize its
+        regions, instead of waiting for the first request for it.
+        This option may be repeated.
+
+    -r regionName
+        Initialize only the named regions of the preceding -m at
+        startup.  This option may be repeated.
+
+    -H backend
+        The offscreen backend to render with, "egl" or "osmesa"; see
+        main.py -h.  This is required unless -n is given.
+
+    -f
+        Use the fixed-function implementation instead of the
+        shader-based implementation.
+
+    -n
+        Use the CPU (NumPy) implementation instead of OpenGL.
+
+    -B batchSize
+        The maximum number of requests rendered in one batch.  The
+        default is 16.
+
+    -c cacheDirectory
+        Specify a directory in which to keep precompiled data across
+        runs; see main.py -h.
+
+    -q
+        Quiet mode: don't report each file, region and image.
+
+    -h
+        Show this help.
+
+"""
+
+import OffscreenContext
+import sys
+
+# -H selects the platform PyOpenGL binds to, so it must be found
+# before anything imports OpenGL.
+shortOptions = 'S:m:r:H:fnB:c:qh'
+OffscreenContext.selectPlatformFromArgs(sys.argv[1:], shortOptions)
+
+from MpcdiLibrary import MpcdiLibrary
+from TextureImage import TextureImage
+from MpacsWarp2DShader import MpacsWarp2DShader
+from MpacsWarp2DFixedFunction import MpacsWarp2DFixedFunction
+from MpacsWarp2DNumPy import MpacsWarp2DNumPy
+from RenderClient import defaultSocketFilename, readMessage, writeMessage
+from OpenGL.GL import *
+import SocketServer
+import ImageWriter
+import AssetCache
+import RemapTable
+import RenderMap
+import ShaderCache
+import collections
+import threading
+import traceback
+import Queue
+import getopt
+import time
+import os
+
+# The number of decoded media images the server keeps, so that media
+# that is rendered again (and hasn't changed on disk) isn't decoded
+# again.
+mediaCacheSize = 4
+
+def usage(code, msg = ''):
+    print >> sys.stderr, help % (defaultSocketFilename)
+    print >> sys.stderr, msg
+    sys.exit(code)
+
+class RenderRequest:
+    """ One request received from a client, waiting for the render
+    thread.  The connection's thread waits on self.done for the
+    response. """
+
+    def __init__(self, message, media = None):
+        self.message = message
+        self.command = message.get('command', 'render')
+        self.queuedTime = time.time()
+        self.done = threading.Event()
+        self.response = None
+
+        # The decoded media, as a TextureImage; and the output
+        # filename for each region, filled in by
+        # RenderServer.prepareRequest().
+        self.media = media
+        self.decodeTime = 0.0
+        self.outputs = {}
+        self.error = None
+
+    def finish(self, response):
+        self.response = response
+        self.done.set()
+
+class RegionRenderer:
+    """
+    The warp object for one region, initialized once and kept for the
+    life of the server, with its own framebuffer object to render
+    into (if it uses OpenGL), and the queue of frames it is to render
+    in the current batch.
+    """
+
+    def __init__(self, mpcdi, region, warpClass):
+        self.region = region
+        self.warp = warpClass(mpcdi, region)
+        self.windowSize = self.warp.windowSize
+        self.useGL = (warpClass is not MpacsWarp2DNumPy)
+
+        # The (RenderRequest, outputFilename) pairs to render in the
+        # current batch.
+        self.queue = []
+
+        self.numFrames = 0
+        self.renderTime = 0.0
+
+        if self.useGL:
+            self.setupFbo()
+        self.warp.initGL()
+
+    def setupFbo(self):
+        self.rbobj = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.rbobj)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8,
+                              self.windowSize[0], self.windowSize[1])
+
+        self.fbobj = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbobj)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+                                  GL_RENDERBUFFER, self.rbobj)
+
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        assert(status == GL_FRAMEBUFFER_COMPLETE)
+
+    def makeCurrent(self):
+        """ Directs rendering to this region's framebuffer object,
+        with the projection main.py uses for its FBOs. """
+
+        width, height = self.windowSize
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbobj)
+        glViewport(0, 0, width, height)
+
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(0, 1, 1, 0, -100, 100)
+
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+
+    def renderFrame(self, request, outputFilename):
+        """ Renders the media of the indicated request, one of those
+        queued for this region.  The image is not necessarily written
+        until finishOutput() is called. """
+
+        startTime = time.time()
+        if self.useGL:
+            self.makeCurrent()
+
+        # The regions all render in one context, so they share the
+        # media's texture; it is uploaded by the first.
+        self.warp.setMedia(request.media)
+        self.warp.setOutputFilename(outputFilename)
+        if self.useGL:
+            glClear(GL_COLOR_BUFFER_BIT)
+        self.warp.draw()
+
+        self.numFrames += 1
+        self.renderTime += time.time() - startTime
+
+    def finishOutput(self):
+        if self.useGL:
+            glBindFramebuffer(GL_FRAMEBUFFER, self.fbobj)
+        self.warp.finishOutput()
+
+class ConnectionHandler(SocketServer.StreamRequestHandler):
+    """ Reads the requests from one client connection, in its own
+    thread, and hands each to the RenderServer in turn. """
+
+    def handle(self):
+        renderServer = self.server.renderServer
+        while True:
+            try:
+                message = readMessage(self.rfile)
+            except ValueError, e:
+                writeMessage(self.wfile, { 'status' : 'error', 'message' : 'Invalid request: %s' % (e) })
+                continue
+            if message is None:
+                break
+            if not isinstance(message, dict):
+                writeMessage(self.wfile, { 'status' : 'error', 'message' : 'Invalid request' })
+                continue
+
+            writeMessage(self.wfile, renderServer.submit(message))
+            if message.get('command') == 'shutdown':
+                # The render thread waits for this before it exits.
+                renderServer.shutdownReplied.set()
+
+class ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class RenderServer:
+    """
+    Serves render requests over a Unix socket.  The socket is served
+    by a thread for each connection, which parses each request and
+    decodes its media; the rendering itself is done by serveForever(),
+    which must be called from the thread that owns the OpenGL
+    context (if any).
+    """
+
+    def __init__(self, socketFilename, warpClass, batchSize = 16, verbose = True):
+        self.socketFilename = socketFilename
+        self.warpClass = warpClass
+        self.batchSize = batchSize
+        self.verbose = verbose
+
+        self.library = MpcdiLibrary(verbose = verbose)
+
+        # The RegionRenderer for each (bundleId, regionId), created
+        # the first time the region is needed.
+        self.renderers = {}
+        self.rendererKeys = []
+
+        # The RenderRequests waiting for the render thread.
+        self.requests = Queue.Queue()
+
+        # The recently decoded media, by (filename, mtime, size); see
+        # getMedia().
+        self.mediaCache = collections.OrderedDict()
+        self.mediaLock = threading.Lock()
+
+        self.numRequests = 0
+        self.numBatches = 0
+        self.running = False
+        self.shutdownReplied = threading.Event()
+
+        if self.warpClass is not MpacsWarp2DNumPy:
+            OffscreenContext.getContext()
+
+    def getRenderer(self, mpcdiFilename, regionId):
+        """ Returns the RegionRenderer for the indicated region,
+        creating it if necessary.  This must be called from the render
+        thread. """
+
+        bundleId = self.library.addBundle(mpcdiFilename)
+        key = (bundleId, regionId)
+        renderer = self.renderers.get(key, None)
+        if renderer is None:
+            mpcdi = self.library.getBundle(bundleId)
+            if regionId not in mpcdi.regionIdList:
+                raise StandardError, 'No region %s in %s' % (regionId, bundleId)
+            region = mpcdi.getRegion(regionId)
+            renderer = RegionRenderer(mpcdi, region, self.warpClass)
+            self.renderers[key] = renderer
+            self.rendererKeys.append(key)
+            if self.verbose:
+                print "Initialized %s region %s at size %s, %s" % (
+                    bundleId, regionId, renderer.windowSize[0], renderer.windowSize[1])
+        return renderer
+
+    def preload(self, mpcdiFilename, regionIds = None):
+        """ Initializes the indicated regions of the mpcdi file (or all
+        of them) ahead of the first request. """
+
+        bundleId = self.library.addBundle(mpcdiFilename)
+        if regionIds is None:
+            regionIds = self.library.getBundle(bundleId).regionIdList
+        for regionId in regionIds:
+            self.getRenderer(mpcdiFilename, regionId)
+
+    def submit(self, message):
+        """ Queues the indicated request message for the render
+        thread, waits for it, and returns the response.  This is
+        called from the connection threads. """
+
+        command = message.get('command', 'render')
+        media = None
+        decodeTime = 0.0
+        if command == 'render':
+            try:
+                # The media is decoded here, in the connection's own
+                # thread, rather than holding up the render thread.
+                startTime = time.time()
+                media = self.getMedia(str(message['media']))
+                decodeTime = time.time() - startTime
+            except Exception, e:
+                return { 'status' : 'error', 'message' : 'Could not read media: %s' % (e) }
+        elif command not in ['ping', 'stats', 'shutdown']:
+            return { 'status' : 'error', 'message' : 'Unknown command %s' % (command) }
+
+        request = RenderRequest(message, media)
+        request.decodeTime = decodeTime
+        self.requests.put(request)
+        request.done.wait()
+        return request.response
+
+    def getMedia(self, filename):
+        """ Returns a decoded TextureImage for the indicated media
+        file, reusing one decoded recently if the file hasn't changed
+        since. """
+
+        stat = os.stat(filename)
+        key = (filename, stat.st_mtime, stat.st_size)
+        with self.mediaLock:
+            media = self.mediaCache.pop(key, None)
+            if media is not None:
+                # Move it to the most recently used end.
+                self.mediaCache[key] = media
+                return media
+
+        media = TextureImage(filename)
+        media.getArray()
+
+        with self.mediaLock:
+            self.mediaCache[key] = media
+            while len(self.mediaCache) > mediaCacheSize:
+                self.mediaCache.popitem(last = False)
+        return media
+
+    def serveForever(self):
+        """ Listens on the socket, and renders the requests as they
+        arrive, until a shutdown request is received. """
+
+        if os.path.exists(self.socketFilename):
+            os.unlink(self.socketFilename)
+        server = ThreadingUnixStreamServer(self.socketFilename, ConnectionHandler)
+        server.renderServer = self
+
+        thread = threading.Thread(target = server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        if self.verbose:
+            print "Listening on %s" % (self.socketFilename)
+
+        self.running = True
+        try:
+            while self.running:
+                # Wait for a request, then take whatever else has
+                # arrived in the meantime along with it.
+                batch = [self.requests.get()]
+                while len(batch) < self.batchSize:
+                    try:
+                        batch.append(self.requests.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                try:
+                    self.renderBatch(batch)
+                except Exception, e:
+                    # Keep serving, and don't leave any client waiting
+                    # for an answer that will never come.
+                    traceback.print_exc()
+                    self.abandonBatch(batch, e)
+
+            # Give the connection that asked us to stop a chance to
+            # receive its answer.
+            self.shutdownReplied.wait(5.0)
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(self.socketFilename)
+
+    def renderBatch(self, batch):
+        """ Renders all of the indicated RenderRequests, region by
+        region, and answers each of them. """
+
+        startTime = time.time()
+        self.numBatches += 1
+
+        renders = []
+        for request in batch:
+            if request.command == 'render':
+                self.prepareRequest(request)
+                renders.append(request)
+            else:
+                self.runCommand(request)
+
+        # Render each media image through every region that shows it
+        # before going on to the next; a region releases the texture
+        # of its previous media as it takes up the next, so taking
+        # the regions in the outer loop would upload each image again
+        # for every region.  Then collect all of the readbacks, so
+        # that the readback of one region overlaps the rendering of
+        # the next.
+        touched = []
+        for key in self.rendererKeys:
+            renderer = self.renderers[key]
+            if renderer.queue:
+                touched.append(renderer)
+
+        mediaList = []
+        for request in renders:
+            if request.media not in mediaList:
+                mediaList.append(request.media)
+
+        for media in mediaList:
+            for renderer in touched:
+                for request, outputFilename in renderer.queue:
+                    if request.media is not media:
+                        continue
+                    try:
+                        renderer.renderFrame(request, outputFilename)
+                    except Exception, e:
+                        request.error = request.error or str(e)
+
+        for renderer in touched:
+            renderer.queue = []
+
+        for renderer in touched:
+            try:
+                renderer.finishOutput()
+            except Exception, e:
+                # We can't tell which frame failed to be written.
+                for request in renders:
+                    if renderer.region.id in request.outputs:
+                        request.error = request.error or str(e)
+
+        endTime = time.time()
+        for request in renders:
+            self.numRequests += 1
+            if request.error:
+                request.finish({ 'status' : 'error', 'message' : request.error })
+                continue
+            request.finish({
+                'status' : 'ok',
+                'outputs' : request.outputs,
+                'decodeTime' : request.decodeTime * 1000.0,
+                'queueTime' : (startTime - request.queuedTime) * 1000.0,
+                'renderTime' : (endTime - startTime) * 1000.0,
+                'batchSize' : len(renders),
+                })
+
+    def abandonBatch(self, batch, e):
+        """ Answers each request in the indicated batch that hasn't
+        been answered already with the indicated exception, and
+        empties the regions' queues. """
+
+        for renderer in self.renderers.values():
+            renderer.queue = []
+        for request in batch:
+            if not request.done.isSet():
+                request.finish({ 'status' : 'error', 'message' : 'Render failed: %s' % (e) })
+
+    def prepareRequest(self, request):
+        """ Looks up the regions named by the indicated request, and
+        adds the request to each region's queue. """
+
+        message = request.message
+        try:
+            mpcdiFilename = str(message['mpcdi'])
+            output = str(message['output'])
+            regionIds = message.get('regions', None)
+            if regionIds is None:
+                bundleId = self.library.addBundle(mpcdiFilename)
+                regionIds = self.library.getBundle(bundleId).regionIdList
+            regionIds = map(str, regionIds)
+
+            if len(regionIds) > 1 and '%s' not in output:
+                raise StandardError, 'The output filename must contain %s to render more than one region'
+
+            renderers = []
+            for regionId in regionIds:
+                renderers.append(self.getRenderer(mpcdiFilename, regionId))
+        except Exception, e:
+            request.error = str(e)
+            return
+
+        for regionId, renderer in zip(regionIds, renderers):
+            if '%s' in output:
+                outputFilename = output.replace('%s', regionId)
+            else:
+                outputFilename = output
+            request.outputs[regionId] = outputFilename
+            renderer.queue.append((request, outputFilename))
+
+    def runCommand(self, request):
+        if request.command == 'ping':
+            request.finish({ 'status' : 'ok' })
+
+        elif request.command == 'stats':
+            regions = []
+            for bundleId, regionId in self.rendererKeys:
+                renderer = self.renderers[(bundleId, regionId)]
+                regions.append({
+                    'mpcdi' : bundleId,
+                    'region' : regionId,
+                    'frames' : renderer.numFrames,
+                    'renderTime' : renderer.renderTime * 1000.0,
+                    })
+            request.finish({
+                'status' : 'ok',
+                'requests' : self.numRequests,
+                'batches' : self.numBatches,
+                'regions' : regions,
+                })
+
+        elif request.command == 'shutdown':
+            # Finish this batch, then stop.
+            self.running = False
+            request.finish({ 'status' : 'ok' })
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortOptions)
+    except getopt.error, msg:
+        usage(1, msg)
+
+    socketFilename = defaultSocketFilename
+    warpClass = MpacsWarp2DShader
+    batchSize = 16
+    verbose = True
+    assetCache = None
+
+    # The (mpcdiFilename, regionIds) to preload.
+    preloads = []
+
+    for opt, arg in opts:
+        if opt == '-S':
+            socketFilename = arg
+        elif opt == '-m':
+            preloads.append((arg, None))
+        elif opt == '-r':
+            if not preloads:
+                usage(1, '-r must follow -m.')
+            mpcdiFilename, regionIds = preloads[-1]
+            preloads[-1] = (mpcdiFilename, (regionIds or []) + [arg])
+        elif opt == '-H':
+            if arg not in OffscreenContext.backends:
+                usage(1, 'Unknown offscreen backend %s' % (arg))
+        elif opt == '-f':
+            warpClass = MpacsWarp2DFixedFunction
+        elif opt == '-n':
+            warpClass = MpacsWarp2DNumPy
+        elif opt == '-B':
+            batchSize = int(arg)
+        elif opt == '-c':
+            RemapTable.cacheDirectory = os.path.join(arg, 'remap')
+            RenderMap.cacheDirectory = os.path.join(arg, 'rendermap')
+            ShaderCache.cacheDirectory = os.path.join(arg, 'shaders')
+            assetCache = AssetCache.AssetCache(os.path.join(arg, 'assets'))
+        elif opt == '-q':
+            verbose = False
+        elif opt == '-h':
+            usage(0)
+
+    if warpClass is not MpacsWarp2DNumPy and not OffscreenContext.backend:
+        usage(1, 'Specify -H, or -n to render without OpenGL.')
+
+    ImageWriter.reportWrites = verbose
+
+    renderServer = RenderServer(socketFilename, warpClass,
+                                batchSize = batchSize, verbose = verbose)
+    if assetCache:
+        renderServer.library.setAssetCache(assetCache)
+    for mpcdiFilename, regionIds in preloads:
+        renderServer.preload(os.path.abspath(mpcdiFilename), regionIds)
+
+    renderServer.serveForever()
+    OffscreenContext.releaseContext()
+
+if __name__ == '__main__':
+    main()
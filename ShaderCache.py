@@ -0,0 +1,161 @@
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+from OpenGL.raw.GL.VERSION.GL_4_1 import glGetProgramBinary as glGetProgramBinaryToBuffer
+from OpenGL.raw.GL.VERSION.GL_4_1 import glProgramBinary as glProgramBinaryFromBuffer
+from OpenGL import contextdata
+import os
+import ctypes
+import struct
+import hashlib
+import Profiler
+
+# If this is set to a directory name, the linked programs are saved
+# there with glGetProgramBinary(), and reloaded on subsequent runs
+# instead of being compiled again.
+cacheDirectory = None
+
+# Bump this whenever the layout of the cache files changes.
+formatVersion = 1
+
+# The key under which each context's programs are stored with
+# OpenGL.contextdata.
+contextDataKey = 'ShaderCache.programs'
+
+class ShaderProgram:
+    """ A linked shader program, and the locations of its uniforms,
+    which are looked up only once. """
+
+    def __init__(self, program, uniformNames):
+        self.program = program
+        self.uniforms = {}
+        for name in uniformNames:
+            self.uniforms[name] = glGetUniformLocation(program, name)
+
+def getProgram(vertexSource, fragmentSource, uniformNames):
+    """ Returns a ShaderProgram for the indicated vertex and fragment
+    shader sources, with the locations of the indicated uniforms.
+
+    Each program is linked only once in each OpenGL context, and
+    shared by everything drawn in that context.  If cacheDirectory is
+    set, the program binary is also saved there, and reloaded by
+    later runs on the same driver; if the driver rejects the saved
+    binary (for instance, because it has been upgraded), the program
+    is compiled from source again. """
+
+    programs = contextdata.getValue(contextDataKey)
+    if programs is None:
+        programs = {}
+        contextdata.setValue(contextDataKey, programs)
+
+    key = hashlib.sha1('%s\0%s' % (vertexSource, fragmentSource)).hexdigest()
+    shaderProgram = programs.get(key, None)
+    if shaderProgram is None:
+        program = None
+        filename = None
+        if cacheDirectory and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS):
+            filename = os.path.join(cacheDirectory, getCacheKey(vertexSource, fragmentSource) + '.bin')
+            program = loadProgramBinary(filename)
+
+        if program is None:
+            program = compileProgram(vertexSource, fragmentSource, filename is not None)
+            if filename:
+                saveProgramBinary(program, filename)
+
+        shaderProgram = ShaderProgram(program, uniformNames)
+        programs[key] = shaderProgram
+
+    return shaderProgram
+
+def getCacheKey(vertexSource, fragmentSource):
+    """ Returns a string that uniquely identifies the binary of the
+    indicated program on the current driver.  Program binaries are
+    only valid for the driver that produced them. """
+
+    key = '%s\0%s\0%s\0%s\0%s\0%s' % (
+        formatVersion, glGetString(GL_VENDOR), glGetString(GL_RENDERER),
+        glGetString(GL_VERSION), vertexSource, fragmentSource)
+    return hashlib.sha1(key).hexdigest()
+
+@Profiler.profiled('ShaderCache.compile')
+def compileProgram(vertexSource, fragmentSource, retrievable = False):
+    """ Compiles and links the indicated shaders, and returns the
+    program.  If retrievable is true, the program is marked so that
+    its binary can be saved afterwards. """
+
+    vs = shaders.compileShader(vertexSource, GL_VERTEX_SHADER)
+    fs = shaders.compileShader(fragmentSource, GL_FRAGMENT_SHADER)
+
+    program = glCreateProgram()
+    glAttachShader(program, vs)
+    glAttachShader(program, fs)
+    if retrievable:
+        glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    glLinkProgram(program)
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        raise RuntimeError, 'Link failure (%s): %s' % (
+            glGetProgramiv(program, GL_LINK_STATUS), glGetProgramInfoLog(program))
+
+    # The linked program doesn't need the shader objects any more.
+    glDetachShader(program, vs)
+    glDetachShader(program, fs)
+    glDeleteShader(vs)
+    glDeleteShader(fs)
+    return program
+
+@Profiler.profiled('ShaderCache.load')
+def loadProgramBinary(filename):
+    """ Creates a program from the binary previously saved in the
+    indicated file.  Returns None if there is no such file, or the
+    driver won't accept it. """
+
+    try:
+        file = open(filename, 'rb')
+        data = file.read()
+        file.close()
+    except IOError:
+        return None
+
+    if len(data) < 4:
+        return None
+    binaryFormat = struct.unpack('<I', data[:4])[0]
+    binary = data[4:]
+
+    program = glCreateProgram()
+    try:
+        glProgramBinaryFromBuffer(program, binaryFormat, binary, len(binary))
+        linked = (glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE)
+    except GLError:
+        # The driver doesn't support this binary format at all.
+        linked = False
+    if not linked:
+        print "Ignoring stale program binary %s" % (filename)
+        glDeleteProgram(program)
+        return None
+
+    return program
+
+def saveProgramBinary(program, filename):
+    """ Saves the binary of the indicated program to the indicated
+    file, if the driver will provide one. """
+
+    length = int(glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH))
+    if not length:
+        return
+
+    buffer = ctypes.create_string_buffer(length)
+    actualLength = ctypes.c_int()
+    binaryFormat = ctypes.c_uint()
+    glGetProgramBinaryToBuffer(program, length, ctypes.byref(actualLength),
+                               ctypes.byref(binaryFormat), buffer)
+
+    if not os.path.isdir(cacheDirectory):
+        os.makedirs(cacheDirectory)
+
+    # Write it under a temporary name and rename it into place, so a
+    # concurrent reader never sees a partial file.
+    tempFilename = '%s.%s.tmp' % (filename, os.getpid())
+    file = open(tempFilename, 'wb')
+    file.write(struct.pack('<I', binaryFormat.value))
+    file.write(buffer.raw[:actualLength.value])
+    file.close()
+    os.rename(tempFilename, filename)
@@ -0,0 +1,156 @@
+from PIL import Image
+from cStringIO import StringIO
+import zipfile
+import numpy
+import os
+
+class SyntheticMpcdi:
+    """
+    Describes a synthetic 2d-profile mpcdi file, for benchmarking and
+    testing: a single buffer divided into numRegions side-by-side
+    regions that overlap by a tenth of their width, each with a
+    smoothly distorted pfm grid of pfmSize, and optionally an alpha
+    and a beta map of the same size with the indicated bit depth.
+
+    Call write() to save it, either as a zipfile or, if asDirectory
+    is true, as a directory of files.
+    """
+
+    def __init__(self, numRegions = 2, regionSize = (1920, 1080),
+                 pfmSize = (128, 72), alpha = True, beta = True,
+                 bitDepth = 8, asDirectory = False, compress = True):
+        self.numRegions = numRegions
+        self.regionSize = regionSize
+        self.pfmSize = pfmSize
+        self.alpha = alpha
+        self.beta = beta
+        self.bitDepth = bitDepth
+        self.asDirectory = asDirectory
+        self.compress = compress
+
+    def getConfig(self):
+        """ Returns the parameters as a dictionary, for reporting. """
+        return {
+            'numRegions' : self.numRegions,
+            'regionSize' : list(self.regionSize),
+            'pfmSize' : list(self.pfmSize),
+            'alpha' : self.alpha,
+            'beta' : self.beta,
+            'bitDepth' : self.bitDepth,
+            'asDirectory' : self.asDirectory,
+            'compress' : self.compress,
+            }
+
+    def getRegionIds(self):
+        return ['region%s' % (i) for i in range(self.numRegions)]
+
+    def write(self, filename):
+        """ Writes the mpcdi file (or directory) to filename. """
+
+        members = self.makeMembers()
+        if self.asDirectory:
+            if not os.path.isdir(filename):
+                os.makedirs(filename)
+            for name, data in members:
+                file = open(os.path.join(filename, name), 'wb')
+                file.write(data)
+                file.close()
+        else:
+            if self.compress:
+                compression = zipfile.ZIP_DEFLATED
+            else:
+                compression = zipfile.ZIP_STORED
+            zip = zipfile.ZipFile(filename, 'w', compression)
+            for name, data in members:
+                zip.writestr(name, data)
+            zip.close()
+
+    def makeMembers(self):
+        """ Returns a list of (name, data) for each file within the
+        mpcdi file, beginning with mpcdi.xml. """
+
+        # Each region covers 1.1 / numRegions of the buffer, so that
+        # neighbors overlap by a tenth of a region.
+        xsize = min(1.0, 1.1 / self.numRegions)
+        if self.numRegions > 1:
+            step = (1.0 - xsize) / (self.numRegions - 1)
+        else:
+            step = 0.0
+        bufferX = int(round(self.regionSize[0] / xsize))
+        bufferY = self.regionSize[1]
+
+        xregions = []
+        xfilesets = []
+        members = []
+        for i, regionId in enumerate(self.getRegionIds()):
+            x = i * step
+            xregions.append('<region id="%s" Xresolution="%s" Yresolution="%s" x="%s" y="0.0" xsize="%s" ysize="1.0"></region>' % (
+                regionId, self.regionSize[0], self.regionSize[1], x, xsize))
+
+            fileset = '<geometryWarpFile><path>%s.pfm</path><componentDepth>2</componentDepth><bitdepth>32</bitdepth></geometryWarpFile>' % (regionId)
+            members.append(('%s.pfm' % (regionId), makePfm(self.pfmSize, i)))
+            for keyword, include, fade in [('alphaMap', self.alpha, True), ('betaMap', self.beta, False)]:
+                if not include:
+                    continue
+                name = '%s_%s.png' % (regionId, keyword)
+                fileset += '<%s><path>%s</path><componentDepth>1</componentDepth><bitdepth>%s</bitdepth><gammaEmbedded>2.2</gammaEmbedded></%s>' % (
+                    keyword, name, self.bitDepth, keyword)
+                members.append((name, makeBlendMap(self.pfmSize, self.bitDepth, fade)))
+            xfilesets.append('<fileset region="%s">%s</fileset>' % (regionId, fileset))
+
+        xml = '<?xml version="1.0" encoding="utf-8"?>\n' \
+              '<MPCDI profile="2d" geometry="1" version="1.0">\n' \
+              '<display><buffer id="buffer0" Xresolution="%s" Yresolution="%s">\n%s\n</buffer></display>\n' \
+              '<files>\n%s\n</files></MPCDI>\n' % (
+            bufferX, bufferY, '\n'.join(xregions), '\n'.join(xfilesets))
+
+        return [('mpcdi.xml', xml)] + members
+
+def makePfm(size, seed = 0):
+    """ Returns the data of a little-endian pfm file of the indicated
+    size (xSize, ySize), holding a smooth, slightly curved warp of
+    the unit square; seed varies the curvature. """
+
+    xSize, ySize = size
+    y, x = numpy.mgrid[0:ySize, 0:xSize].astype('float32')
+    u = x / max(xSize - 1, 1)
+    v = y / max(ySize - 1, 1)
+    uvs = numpy.empty((ySize, xSize, 3), dtype = '<f4')
+    uvs[:,:,0] = u + 0.03 * numpy.sin(v * 3.1 + seed)
+    uvs[:,:,1] = v + 0.02 * numpy.cos(u * 2.0 + seed)
+    uvs[:,:,2] = 0.0
+    return 'PF\n%s %s\n-1.0\n' % (xSize, ySize) + uvs.tostring()
+
+def makeBlendMap(size, bitDepth, fade):
+    """ Returns the data of a one-channel png file of the indicated
+    size and bit depth: a horizontal ramp from 30% to 100% if fade is
+    true (like an alpha map), or a dim constant otherwise (like a beta
+    map). """
+
+    xSize, ySize = size
+    x = numpy.mgrid[0:ySize, 0:xSize][1].astype('float32')
+    if fade:
+        value = 0.3 + 0.7 * x / max(xSize - 1, 1)
+    else:
+        value = numpy.zeros_like(x) + 0.05
+
+    if bitDepth == 16:
+        img = Image.fromarray(numpy.round(value * 65535).astype('int32'), 'I')
+    else:
+        img = Image.fromarray(numpy.round(value * 255).astype('uint8'), 'L')
+
+    data = StringIO()
+    img.save(data, 'png')
+    return data.getvalue()
+
+def makeMedia(size):
+    """ Returns a synthetic RGB media image of the indicated size, as
+    a TextureImage-compatible uint8 array. """
+
+    xSize, ySize = size
+    y, x = numpy.mgrid[0:ySize, 0:xSize]
+    media = numpy.empty((ySize, xSize, 3), dtype = 'uint8')
+    media[:,:,0] = (x * 255 / max(xSize - 1, 1))
+    media[:,:,1] = (y * 255 / max(ySize - 1, 1))
+    media[:,:,2] = ((x / 32 + y / 32) % 2) * 255
+    return media
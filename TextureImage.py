@@ -1,41 +1,232 @@
 from PIL import Image
 from OpenGL.GL import *
+from OpenGL.GL.ARB.texture_float import GL_LUMINANCE32F_ARB
+from OpenGL.raw.GL.VERSION.GL_1_0 import glTexImage2D as glTexImage2DFromBuffer
 from cStringIO import StringIO
+import weakref
+import ctypes
 import numpy
+import sys
+import Profiler
 
 useMipmapping = False
 
+# Set this true to allow the renderers that can take advantage of it
+# to upload 8-bit color media with sRGB texture formats, so that the
+# texture unit linearizes them, and to write to sRGB framebuffers;
+# see TextureImage.srgb.
+useSrgb = False
+
+# The pixel format for an image array with each number of channels.
+# One-channel images are luminance, so the fixed-function blend card
+# still sees the same value in all three colors.
+textureFormats = {
+    1 : GL_LUMINANCE,
+    3 : GL_RGB,
+    4 : GL_RGBA,
+    }
+
+# The pixel type, and the sized internal format for each number of
+# channels, for an image array of each dtype.
+textureTypes = {
+    'uint8' : (GL_UNSIGNED_BYTE, { 1 : GL_LUMINANCE8, 3 : GL_RGB8, 4 : GL_RGBA8 }),
+    'uint16' : (GL_UNSIGNED_SHORT, { 1 : GL_LUMINANCE16, 3 : GL_RGB16, 4 : GL_RGBA16 }),
+    'float32' : (GL_FLOAT, { 1 : GL_LUMINANCE32F_ARB, 3 : GL_RGB32F, 4 : GL_RGBA32F }),
+    }
+
+# The sRGB internal format for an 8-bit image array with each number
+# of channels.  There are none for other types.
+textureSrgbFormats = {
+    3 : GL_SRGB8,
+    4 : GL_SRGB8_ALPHA8,
+    }
+
 class TextureImage:
     """ A basic 2-d OpenGL texture image, as loaded from (for instance) a png file. """
 
-    def __init__(self, filename = None, data = None, flat = None):
+    def __init__(self, filename = None, data = None, flat = None, array = None):
         self.filename = filename
         self.data = data
         self.texobj = None
         self.flat = flat
+        self.image = None
+
+        # Set this true before initGL() to upload the image with an
+        # sRGB internal format, so that it is linearized as it is
+        # sampled.  initGL() clears it again if the image is not 8-bit
+        # RGB or RGBA.
+        self.srgb = False
+
+        # The decoded image, as returned by getArray().  This may be
+        # supplied up front, for instance from an AssetCache, in which
+        # case the image is never decoded at all.
+        self.array = array
+
+        # The number of calls to initGL() not yet matched by a call to
+        # releaseGL().  The image may be shown by several warps at
+        # once, which all share the one texture.
+        self.glRefCount = 0
+
+        # If this image is a crop of a larger one, made by crop(), the
+        # rectangle (x, y, width, height) it occupies within that
+        # image, and the size (xSize, ySize) of that image.
+        self.cropRect = None
+        self.fullSize = None
+
+        # The crops made of this image, by rectangle, so that a warp
+        # that asks for the same crop again shares its texture.
+        self.crops = weakref.WeakValueDictionary()
 
     def __read(self):
-        if self.data:
-            return Image.open(StringIO(self.data))
-        if self.filename:
-            return Image.open(self.filename)
-        if self.flat:
-            return Image.new(*self.flat)
+        if self.image is None:
+            if self.data is not None:
+                # The data may be a string or any other object with the
+                # buffer interface, like a numpy array; cStringIO reads
+                # it in place.
+                img = Image.open(StringIO(self.data))
+            elif self.filename:
+                img = Image.open(self.filename)
+            elif self.flat:
+                img = Image.new(*self.flat)
+            else:
+                assert False
 
-        assert False
+            img.load()
+            self.image = img
 
-    def initGL(self):
+            # We don't need the encoded data any more.
+            self.data = None
+
+        return self.image
+
+    def getArray(self):
+        """ Returns the decoded image as a numpy array of shape
+        (ySize, xSize, numChannels), with 1, 3 or 4 channels, and
+        dtype uint8 for 8-bit images, uint16 for 16-bit images, or
+        float32 for floating-point images.  Row 0 is the top of the
+        image.  The image is decoded only the first time; if the array
+        was supplied to the constructor, it is never decoded at
+        all. """
+
+        if self.array is None:
+            self.array = self.__decode()
+
+            # The array is all we need from now on.
+            self.image = None
+
+        return self.array
+
+    def crop(self, rect):
+        """ Returns a TextureImage holding only the indicated
+        rectangle (x, y, width, height), in pixels with y measured
+        from the top row, of this image.  The crop shares this image's
+        decoded array; only the rectangle is uploaded by initGL(). """
+
+        rect = tuple(rect)
+        image = self.crops.get(rect, None)
+        if image is None:
+            array = self.getArray()
+            x, y, width, height = rect
+            image = TextureImage(self.filename, array = array[y : y + height, x : x + width])
+            image.cropRect = rect
+            image.fullSize = (array.shape[1], array.shape[0])
+            self.crops[rect] = image
+        return image
+
+    def copy(self):
+        """ Returns a new TextureImage sharing this one's decoded array
+        (and crop, if any), to be uploaded as a texture of its
+        own. """
+
+        image = TextureImage(self.filename, array = self.getArray())
+        image.cropRect = self.cropRect
+        image.fullSize = self.fullSize
+        return image
+
+    def getCropMat(self):
+        """ Returns the 4x4 matrix that transforms texture coordinates
+        over the whole of the original image into texture coordinates
+        within this image, which may be a crop of it.  Like the warp
+        matrix, it acts on row vectors (u, v, 0, 1). """
+
+        if self.cropRect is None:
+            return numpy.identity(4)
+
+        x, y, width, height = self.cropRect
+        xSize, ySize = self.fullSize
+        return numpy.array(
+            [[float(xSize) / width, 0, 0, 0],
+             [0, float(ySize) / height, 0, 0],
+             [0, 0, 1, 0],
+             [-float(x) / width, -float(y) / height, 0, 1]])
+
+    @Profiler.profiled('TextureImage.decode', Profiler.arrayBytes)
+    def __decode(self):
         img = self.__read()
-        if img.mode not in ['RGB', 'L', 'I']:
-            img = img.convert('RGB')
+        if img.mode in ['I', 'I;16', 'I;16B', 'I;16L']:
+            # PIL loads most 16-bit image files as 32-bit integers.
+            array = numpy.asarray(img).astype('uint16')
+        elif img.mode == 'F':
+            array = numpy.asarray(img, dtype = 'float32')
+        else:
+            if img.mode in ['RGBA', 'LA'] or \
+               (img.mode == 'P' and 'transparency' in img.info):
+                mode = 'RGBA'
+            elif img.mode in ['1', 'L']:
+                mode = 'L'
+            else:
+                mode = 'RGB'
+            if img.mode != mode:
+                img = img.convert(mode)
+            array = numpy.asarray(img, dtype = 'uint8')
+        if array.ndim == 2:
+            array = array[:,:,numpy.newaxis]
+        return array
+
+    def initGL(self):
+        """ Uploads the decoded image as an OpenGL texture, straight
+        from the array returned by getArray(), with the internal
+        format that matches its type and number of channels.  If the
+        texture has already been uploaded, it is simply shared; the
+        srgb setting of the first call applies. """
+
+        self.glRefCount += 1
+        if self.texobj is not None:
+            return
+
+        array = self.getArray()
+        ySize, xSize, numChannels = array.shape
 
         max_texture_size = glGetIntegerv(GL_MAX_TEXTURE_SIZE);
-        if img.size[0] > max_texture_size or img.size[1] > max_texture_size:
-            new_size = (min(max_texture_size, img.size[0]),
-                        min(max_texture_size, img.size[1]))
+        if xSize > max_texture_size or ySize > max_texture_size:
+            new_size = (min(max_texture_size, xSize),
+                        min(max_texture_size, ySize))
 
-            print "Resizing image from %s to %s due to OpenGL limits" % (img.size, new_size)
-            img = img.resize(new_size, Image.BILINEAR)
+            # This loses detail, so it shouldn't pass unnoticed.  The
+            # shader-based warp tiles such media instead, where it
+            # can; see MpacsWarp2D.canTileMedia().
+            print >> sys.stderr, "WARNING: %s is %s, larger than the OpenGL limit of %s; downsampling it to %s, losing detail." % (
+                self.filename, (xSize, ySize), max_texture_size, new_size)
+            array = resizeArray(array, new_size)
+            ySize, xSize, numChannels = array.shape
+
+        format = textureFormats[numChannels]
+        type, internalFormat = textureTypes[array.dtype.name]
+        internalFormat = internalFormat[numChannels]
+        if self.srgb:
+            if array.dtype == numpy.uint8 and numChannels in textureSrgbFormats:
+                internalFormat = textureSrgbFormats[numChannels]
+            else:
+                self.srgb = False
+
+        # A crop is uploaded straight out of the rows of the whole
+        # image, with GL_UNPACK_ROW_LENGTH skipping over the rest of
+        # each row.  Otherwise, make sure the rows are packed tightly
+        # in native byte order; this is a no-op for an array fresh
+        # from getArray().
+        rowLength = getRowLength(array)
+        if rowLength is None:
+            array = numpy.ascontiguousarray(array, dtype = array.dtype.newbyteorder('='))
 
         self.texobj = glGenTextures(1)
         glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
@@ -54,39 +245,60 @@ class TextureImage:
             # Just use bilinear filtering.
             glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
 
-        if img.mode == 'I':
-            # PIL mode 'I': integer 32-bit pixels.  This is how PIL
-            # loads 16-bit image files.
-            img_data = numpy.fromstring(img.tobytes(), dtype = 'uint32')
-            num_pixels = img.size[0] * img.size[1]
-            type = GL_UNSIGNED_SHORT
-
-            if len(img_data) == num_pixels:
-                # Must be grayscale.
-                format = GL_LUMINANCE
-            elif len(img_data) == num_pixels * 3:
-                # Must be RGB.
-                format = GL_RGB
-            elif len(img_data) == num_pixels * 4:
-                # Must be RGBA.
-                format = GL_RGBA
+        with Profiler.span('TextureImage.upload', array.nbytes):
+            if rowLength is None:
+                glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, xSize, ySize, 0, format, type, array)
             else:
-                # What could it be?
-                assert False
-        else:
-            # Otherwise, it's an 8-bit format.
-            type = GL_UNSIGNED_BYTE
-            if img.mode == 'RGB':
-                format = GL_RGB
-            elif img.mode == 'L':
-                format = GL_LUMINANCE
-            else:
-                assert False
-            img_data = numpy.fromstring(img.tobytes(), dtype = 'uint8')
+                glPixelStorei(GL_UNPACK_ROW_LENGTH, rowLength)
+                glTexImage2DFromBuffer(GL_TEXTURE_2D, 0, internalFormat, xSize, ySize, 0, format, type,
+                                       array.ctypes.data_as(ctypes.c_void_p))
+                glPixelStorei(GL_UNPACK_ROW_LENGTH, 0)
 
-        glTexImage2D(GL_TEXTURE_2D, 0, format, img.size[0], img.size[1], 0, format, type, img_data)
+    def releaseGL(self):
+        """ Frees the OpenGL texture created by initGL(), once every
+        call to initGL() has been matched by a call to this. """
+        if self.glRefCount > 0:
+            self.glRefCount -= 1
+        if self.glRefCount == 0 and self.texobj is not None:
+            glDeleteTextures([self.texobj])
+            self.texobj = None
 
     def apply(self):
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(GL_TEXTURE_2D, self.texobj)
         glEnable(GL_TEXTURE_2D)
+
+def getRowLength(array):
+    """ Returns the row length, in pixels, to upload the indicated
+    image array with, if it is a window onto the rows of a larger
+    array (as made by TextureImage.crop()), or None if it is not,
+    or must be copied anyway. """
+
+    if not array.dtype.isnative:
+        return None
+    pixelStride = array.strides[2] * array.shape[2]
+    if array.strides[2] != array.dtype.itemsize or array.strides[1] != pixelStride:
+        return None
+    if array.strides[0] <= 0 or array.strides[0] % pixelStride:
+        return None
+    rowLength = array.strides[0] // pixelStride
+    if rowLength == array.shape[1]:
+        # It's already packed tightly.
+        return None
+    return rowLength
+
+def resizeArray(array, size):
+    """ Returns a copy of the image array, of shape (ySize, xSize,
+    numChannels), resized to size (xSize, ySize) with bilinear
+    filtering, one channel at a time. """
+
+    channels = []
+    for i in range(array.shape[2]):
+        channel = array[:,:,i]
+        if channel.dtype == numpy.uint8:
+            img = Image.fromarray(channel, 'L')
+        else:
+            img = Image.fromarray(channel.astype('float32'), 'F')
+        img = img.resize(size, Image.BILINEAR)
+        channels.append(numpy.asarray(img).astype(array.dtype))
+    return numpy.dstack(channels)
@@ -0,0 +1,294 @@
+import numpy
+
+class WarpMesh:
+    """
+    The vertex, UV and index arrays for rendering a pfm grid as a 2-d
+    triangle mesh, as used by MpacsWarp2DFixedFunction.  Each point in
+    the pfm file becomes a vertex, placed at the center of its grid
+    cell in the unit square, and each grid cell becomes two
+    triangles.
+
+    If tolerance is given, the mesh is decimated: grid rows and
+    columns are dropped wherever the UV's in between can be linearly
+    interpolated from the rows and columns that remain, to within
+    tolerance (in media UV units), across the triangles that are
+    actually drawn.  This keeps the grid rectilinear, so there are no
+    T-junctions, but can greatly reduce the vertex count for large pfm
+    files with smooth warps.
+
+    If useStrips is true, grid cells that touch a NaN UV (which pfm
+    files use to mark unused parts of the projector) are dropped
+    altogether, along with any vertices no longer referenced, and the
+    remaining cells are emitted as triangle strips, one for each run
+    of cells within a row, separated by restartIndex.  The indices
+    are 16-bit when the vertex count allows.
+    """
+
+    def __init__(self, pfm, tolerance = None, useStrips = False):
+        self.xSize = pfm.xSize
+        self.ySize = pfm.ySize
+        self.useStrips = useStrips
+        self.restartIndex = None
+
+        # Discard every third element of the UV data, which is mostly
+        # NaN's and isn't really useful, and can confuse OpenGL into
+        # ignoring the first two.  This also converts the data to
+        # native byte order.
+        uvs = numpy.ascontiguousarray(pfm.getArray()[:,:,0:2], dtype = 'float32')
+
+        if tolerance:
+            # Each of the two passes may contribute up to half of the
+            # error.  But checking the rows and columns separately
+            # doesn't bound the error within the cells (a twist, such
+            # as u = x * y, is linear along every row and column), so
+            # the triangles are checked afterwards.
+            self.xIndices = findLinearSpans(uvs, tolerance * 0.5)
+            self.yIndices = findLinearSpans(uvs.transpose(1, 0, 2), tolerance * 0.5)
+            self.xIndices, self.yIndices = refineCells(uvs, self.xIndices, self.yIndices, tolerance)
+            uvs = uvs[self.yIndices][:, self.xIndices]
+        else:
+            self.xIndices = numpy.arange(self.xSize)
+            self.yIndices = numpy.arange(self.ySize)
+
+        # The vertex positions are the centers of the grid cells that
+        # remain.
+        xs = (self.xIndices.astype('float32') + 0.5) / float(self.xSize)
+        ys = (self.yIndices.astype('float32') + 0.5) / float(self.ySize)
+        verts = numpy.empty((len(ys), len(xs), 2), dtype = 'float32')
+        verts[:,:,0] = xs[numpy.newaxis,:]
+        verts[:,:,1] = ys[:,numpy.newaxis]
+
+        self.uvs = uvs.reshape(-1, 2)
+        self.verts = verts.reshape(-1, 2)
+        if useStrips:
+            self.__makeStrips(uvs)
+        else:
+            self.indices = makeGridIndices(len(xs), len(ys))
+
+        self.numVertices = len(self.verts)
+        self.numIndices = len(self.indices)
+
+        # For reporting purposes, the size of the full, undecimated
+        # triangle mesh.
+        self.fullNumVertices = self.xSize * self.ySize
+        self.fullNumIndices = (self.xSize - 1) * (self.ySize - 1) * 6
+        self.fullNumBytes = self.fullNumVertices * 16 + self.fullNumIndices * 4
+
+    def getNumBytes(self):
+        """ Returns the total size of the vertex, UV and index
+        buffers. """
+        return self.verts.nbytes + self.uvs.nbytes + self.indices.nbytes
+
+    def getReport(self):
+        """ Returns a one-line summary of the savings made against
+        the full triangle mesh. """
+        return "%s of %s vertices, %s of %s indices, %s of %s bytes" % (
+            self.numVertices, self.fullNumVertices,
+            self.numIndices, self.fullNumIndices,
+            self.getNumBytes(), self.fullNumBytes)
+
+    def __makeStrips(self, uvs):
+        """ Computes self.indices as primitive-restart triangle
+        strips covering just the cells with four valid corners, and
+        discards the vertices that are no longer referenced.  uvs is
+        the grid of shape (ySize, xSize, 2). """
+
+        ySize, xSize = uvs.shape[:2]
+
+        # A cell is valid if none of its four corners has a NaN.
+        validVertex = numpy.isfinite(uvs).all(axis = 2)
+        validCell = validVertex[:-1,:-1] & validVertex[:-1,1:] & \
+                    validVertex[1:,:-1] & validVertex[1:,1:]
+
+        # Find the runs of consecutive valid cells in each row.
+        padded = numpy.zeros((ySize - 1, xSize + 1), dtype = 'int8')
+        padded[:,1:-1] = validCell
+        edges = numpy.diff(padded, axis = 1)
+        runRows, runStarts = numpy.nonzero(edges == 1)
+        runEnds = numpy.nonzero(edges == -1)[1]
+
+        # Each run of n cells becomes a strip of n + 1 vertex columns,
+        # alternating between the lower and upper vertex of each
+        # column, so that the triangles share the same diagonals as
+        # the triangle mesh.
+        numColumns = runEnds - runStarts + 1
+        runOffsets = numpy.cumsum(numColumns) - numColumns
+        columns = numpy.arange(numColumns.sum()) - numpy.repeat(runOffsets, numColumns)
+        columns += numpy.repeat(runStarts, numColumns)
+        rows = numpy.repeat(runRows, numColumns)
+
+        strips = numpy.empty((len(columns), 2), dtype = 'int64')
+        strips[:,0] = (rows + 1) * xSize + columns
+        strips[:,1] = rows * xSize + columns
+
+        # Keep only the referenced vertices, and renumber them.
+        used = numpy.zeros(xSize * ySize, dtype = 'bool')
+        used[strips.reshape(-1)] = True
+        newIndex = numpy.cumsum(used) - 1
+        self.verts = self.verts[used]
+        self.uvs = self.uvs[used]
+        strips = newIndex[strips]
+
+        # Use 16-bit indices if we can, keeping the largest value for
+        # the restart index.
+        if len(self.verts) < 0xffff:
+            dtype = 'uint16'
+            self.restartIndex = 0xffff
+        else:
+            dtype = 'uint32'
+            self.restartIndex = 0xffffffff
+
+        # Insert the restart index after each strip but the last.
+        stripEnds = (numpy.cumsum(numColumns) * 2)[:-1]
+        self.indices = numpy.insert(strips.reshape(-1), stripEnds, self.restartIndex).astype(dtype)
+
+def makeGridIndices(xSize, ySize):
+    """ Returns the triangle indices for a grid of xSize by ySize
+    vertices, stored row by row, as a flat uint32 array: two
+    triangles for each grid cell. """
+
+    xi = numpy.arange(xSize - 1, dtype = 'uint32')[numpy.newaxis,:]
+    yi = numpy.arange(ySize - 1, dtype = 'uint32')[:,numpy.newaxis]
+    vi0 = (xi) + (yi) * xSize
+    vi1 = (xi) + (yi + 1) * xSize
+    vi2 = (xi + 1) + (yi + 1) * xSize
+    vi3 = (xi + 1) + (yi) * xSize
+
+    tris = numpy.empty((ySize - 1, xSize - 1, 6), dtype = 'uint32')
+    tris[:,:,0] = vi2
+    tris[:,:,1] = vi0
+    tris[:,:,2] = vi1
+    tris[:,:,3] = vi3
+    tris[:,:,4] = vi0
+    tris[:,:,5] = vi2
+    return tris.reshape(-1)
+
+def findLinearSpans(uvs, tolerance):
+    """ Given uvs, an array of shape (ySize, xSize, 2), returns the
+    sorted indices of the columns that must be kept so that every
+    dropped column can be linearly interpolated, in every row, from
+    the nearest kept columns on either side to within tolerance.  The
+    first and last columns are always kept, and NaN's are never
+    interpolated over. """
+
+    xSize = uvs.shape[1]
+    keep = [0]
+    a = 0
+    while a < xSize - 1:
+        # Find the farthest column b such that the span a..b is
+        # linear: first by doubling the span, then by bisection.
+        good = a + 1
+        bad = None
+        step = 2
+        while bad is None:
+            b = a + step
+            if b >= xSize:
+                if isLinearSpan(uvs, a, xSize - 1, tolerance):
+                    good = xSize - 1
+                else:
+                    bad = xSize - 1
+                break
+            if isLinearSpan(uvs, a, b, tolerance):
+                good = b
+                step *= 2
+            else:
+                bad = b
+
+        if bad is not None:
+            while bad - good > 1:
+                mid = (good + bad) / 2
+                if isLinearSpan(uvs, a, mid, tolerance):
+                    good = mid
+                else:
+                    bad = mid
+
+        keep.append(good)
+        a = good
+
+    return numpy.array(keep)
+
+def refineCells(uvs, xIndices, yIndices, tolerance):
+    """ Given uvs, an array of shape (ySize, xSize, 2), and the
+    indices of the columns and rows to be kept, returns new (xIndices,
+    yIndices), with columns and rows added as needed so that every
+    point of uvs is within tolerance of the triangle that will cover
+    it.  See getCellErrors(). """
+
+    while True:
+        bad = getCellErrors(uvs, xIndices, yIndices) > tolerance
+        if not bad.any():
+            return xIndices, yIndices
+
+        # Split each bad cell across its longer side, at the middle.
+        cellRows, cellColumns = numpy.nonzero(bad)
+        x0 = xIndices[cellColumns]
+        x1 = xIndices[cellColumns + 1]
+        y0 = yIndices[cellRows]
+        y1 = yIndices[cellRows + 1]
+        splitX = (x1 - x0) >= (y1 - y0)
+        xIndices = numpy.union1d(xIndices, ((x0 + x1) / 2)[splitX])
+        yIndices = numpy.union1d(yIndices, ((y0 + y1) / 2)[~splitX])
+
+def getCellErrors(uvs, xIndices, yIndices):
+    """ Returns an array of shape (len(yIndices) - 1, len(xIndices)
+    - 1) giving, for each cell of the grid decimated to the indicated
+    columns and rows, the largest difference between the points of
+    uvs within the cell and the two triangles the cell is drawn as.
+    Each cell is split along the diagonal from its first corner to its
+    last, as by makeGridIndices() and WarpMesh.__makeStrips().  A NaN
+    that would be interpolated counts as an infinite error. """
+
+    ySize, xSize = uvs.shape[:2]
+
+    # The cell containing each column and row of uvs, and the
+    # position of each within its cell, from 0 to 1.  The last kept
+    # column or row belongs to the cell before it.
+    cx = numpy.clip(numpy.searchsorted(xIndices, numpy.arange(xSize), side = 'right') - 1, 0, len(xIndices) - 2)
+    cy = numpy.clip(numpy.searchsorted(yIndices, numpy.arange(ySize), side = 'right') - 1, 0, len(yIndices) - 2)
+    s = (numpy.arange(xSize) - xIndices[cx]) / (xIndices[cx + 1] - xIndices[cx]).astype('float32')
+    t = (numpy.arange(ySize) - yIndices[cy]) / (yIndices[cy + 1] - yIndices[cy]).astype('float32')
+
+    # The corners of the cell containing each point.
+    x0 = xIndices[cx][numpy.newaxis,:]
+    x1 = xIndices[cx + 1][numpy.newaxis,:]
+    y0 = yIndices[cy][:,numpy.newaxis]
+    y1 = yIndices[cy + 1][:,numpy.newaxis]
+    p00 = uvs[y0, x0]
+    p10 = uvs[y0, x1]
+    p01 = uvs[y1, x0]
+    p11 = uvs[y1, x1]
+
+    s = numpy.broadcast_to(s[numpy.newaxis,:,numpy.newaxis], p00.shape)
+    t = numpy.broadcast_to(t[:,numpy.newaxis,numpy.newaxis], p00.shape)
+    predicted = numpy.where(s >= t,
+                            p00 + s * (p10 - p00) + t * (p11 - p10),
+                            p00 + t * (p01 - p00) + s * (p11 - p01))
+    with numpy.errstate(invalid = 'ignore'):
+        error = numpy.abs(uvs - predicted).max(axis = 2)
+    error[numpy.isnan(error)] = numpy.inf
+
+    # The kept points themselves aren't interpolated at all.
+    error[numpy.ix_(yIndices, xIndices)] = 0.0
+
+    # The worst point of each cell.  The cells are contiguous runs of
+    # rows and columns, starting at each kept one but the last.
+    error = numpy.maximum.reduceat(error, yIndices[:-1], axis = 0)
+    return numpy.maximum.reduceat(error, xIndices[:-1], axis = 1)
+
+def isLinearSpan(uvs, a, b, tolerance):
+    """ Returns true if columns a + 1 through b - 1 of uvs are all
+    within tolerance of the linear interpolation between columns a
+    and b. """
+
+    if b - a < 2:
+        return True
+
+    t = (numpy.arange(1, b - a, dtype = 'float32') / float(b - a))[numpy.newaxis,:,numpy.newaxis]
+    start = uvs[:, a:a+1]
+    end = uvs[:, b:b+1]
+    predicted = start + (end - start) * t
+    error = numpy.abs(uvs[:, a+1:b] - predicted)
+
+    # A NaN anywhere makes the comparison false, which is what we want.
+    with numpy.errstate(invalid = 'ignore'):
+        return bool(numpy.all(error <= tolerance))
@@ -0,0 +1,397 @@
+help = """
+benchmark.py
+
+This program measures the time taken by each stage of the warping
+pipeline, from reading the mpcdi file to saving the rendered frame,
+against a synthetic mpcdi file generated to order.  The results are
+written as JSON, so that runs against different versions of this code
+can be compared to catch regressions.
+
+By default, only the stages that need no OpenGL context are measured,
+including rendering with the CPU (NumPy) implementation, so it runs
+headless.  With -G, the OpenGL stages are measured too, within a
+hidden GLUT window, or with -H, within an offscreen context that needs
+no window system; both also work with Mesa's software renderer.
+
+Options:
+
+    -n numRegions
+        The number of regions in the synthetic mpcdi file.  The
+        default is 2.
+
+    -r width,height
+        The resolution of each region.  The default is 1920,1080.
+
+    -p width,height
+        The size of each pfm grid, and of the alpha and beta maps.
+        The default is 128,72.
+
+    -a
+        Omit the alpha maps.
+
+    -b
+        Omit the beta maps.
+
+    -d bitDepth
+        The bit depth of the alpha and beta maps, 8 or 16.  The
+        default is 8.
+
+    -D
+        Write the mpcdi file as a directory instead of a zipfile.
+
+    -s
+        Store the members of the zipfile uncompressed.
+
+    -m width,height
+        The size of the media image.  The default is 1920,1080.
+
+    -f frames
+        The number of frames to draw for each renderer.  The default
+        is 20.
+
+    -R repeat
+        The number of times to repeat each of the loading stages.
+        The default is 5.
+
+    -G
+        Also measure the OpenGL stages.
+
+    -H backend
+        Create the OpenGL context for -G offscreen, with the
+        indicated backend, "egl" or "osmesa", instead of in a hidden
+        GLUT window.
+
+    -o output.json
+        Write the results to the indicated file instead of to
+        standard output.
+
+    -h
+        Show this help.
+
+"""
+
+import OffscreenContext
+import sys
+
+# -H selects the platform PyOpenGL binds to, so it must be found
+# before anything imports OpenGL.
+shortOptions = 'n:r:p:abd:Dsm:f:R:GH:o:h'
+OffscreenContext.selectPlatformFromArgs(sys.argv[1:], shortOptions)
+
+from MpcdiFile import MpcdiFile
+from TextureImage import TextureImage
+from WarpMesh import WarpMesh
+from MpacsWarp2DNumPy import MpacsWarp2DNumPy
+from SyntheticMpcdi import SyntheticMpcdi, makeMedia
+import ImageWriter
+from PIL import Image
+import tempfile
+import platform
+import getopt
+import shutil
+import numpy
+import json
+import time
+import os
+
+# The version of the JSON report; change it if the meaning of the
+# results changes.
+reportVersion = 1
+
+def usage(code, msg = ''):
+    print >> sys.stderr, help
+    print >> sys.stderr, msg
+    sys.exit(code)
+
+class StageTimer:
+    """ Collects the time taken by each named stage, over repeated
+    calls. """
+
+    def __init__(self):
+        self.samples = {}
+        self.stageNames = []
+
+    def time(self, name, func, *args):
+        """ Calls func(*args) and records the time it takes under the
+        indicated stage name.  Returns the result of func. """
+
+        start = time.time()
+        result = func(*args)
+        self.add(name, time.time() - start)
+        return result
+
+    def add(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = []
+            self.stageNames.append(name)
+            print >> sys.stderr, name
+        self.samples[name].append(seconds)
+
+    def getResults(self):
+        """ Returns a dictionary of statistics, in milliseconds, for
+        each stage. """
+
+        results = {}
+        for name, samples in self.samples.items():
+            ms = numpy.array(samples) * 1000.0
+            results[name] = {
+                'count' : len(samples),
+                'min' : float(ms.min()),
+                'median' : float(numpy.median(ms)),
+                'mean' : float(ms.mean()),
+                'max' : float(ms.max()),
+                }
+        return results
+
+def loadPfm(mpcdi, region):
+    """ Reads the pfm file of the indicated region, and converts its
+    UV's as the renderers do. """
+
+    pfm = mpcdi.extractPfmFile(region.geometryWarpFile.path)
+    numpy.ascontiguousarray(pfm.getArray()[:,:,0:2], dtype = 'float32')
+    return pfm
+
+def decodeImage(mpcdi, filename):
+    return mpcdi.extractTextureImage(filename).getArray()
+
+def benchmarkLoading(timer, filename, repeat):
+    """ Times reading the mpcdi file, and the pfm files and blend maps
+    of each of its regions.  Returns the last MpcdiFile read. """
+
+    for i in range(repeat):
+        mpcdi = timer.time('MpcdiFile.read', lambda: MpcdiFile(filename, verbose = False))
+        for regionId in mpcdi.regionIdList:
+            region = mpcdi.getRegion(regionId)
+            pfm = timer.time('PfmFile.read', loadPfm, mpcdi, region)
+            for blendMap in [region.alphaMap, region.betaMap]:
+                if blendMap:
+                    timer.time('TextureImage.decode', decodeImage, mpcdi, blendMap.path)
+            timer.time('WarpMesh', WarpMesh, pfm)
+
+    return mpcdi
+
+def benchmarkMedia(timer, mediaFilename, repeat):
+    """ Times decoding the media image. """
+
+    for i in range(repeat):
+        media = timer.time('TextureImage.decode.media', TextureImage(mediaFilename).getArray)
+    return media
+
+def benchmarkNumPy(timer, mpcdi, media, outputFilename, numFrames):
+    """ Times the CPU renderer, on the first region. """
+
+    warp = MpacsWarp2DNumPy(mpcdi, mpcdi.getRegion(mpcdi.regionIdList[0]))
+    warp.setMedia(TextureImage(array = media))
+    timer.time('MpacsWarp2DNumPy.initGL', warp.initGL)
+
+    # The first frame also compiles the remap table.
+    timer.time('MpacsWarp2DNumPy.compile', warp.draw)
+    for i in range(numFrames):
+        timer.time('MpacsWarp2DNumPy.draw', warp.draw)
+
+    warp.setOutputFilename(outputFilename)
+    for i in range(numFrames):
+        timer.time('MpacsWarp2DNumPy.saveOutputImage', saveAndFlush, warp)
+
+def saveAndFlush(warp):
+    warp.saveOutputImage()
+    ImageWriter.getDefaultWriter().flush()
+
+def createGLContext(size):
+    """ Creates a hidden window, or an offscreen context if -H was
+    given, with a framebuffer object of the indicated size to render
+    into, and makes it current. """
+
+    if OffscreenContext.backend:
+        OffscreenContext.getContext()
+        setupFbo(size)
+        return
+
+    from OpenGL.GLUT import glutInit, glutInitDisplayMode, glutInitWindowPosition, \
+         glutCreateWindow, GLUT_RGB, GLUT_DOUBLE
+    glutInit(sys.argv)
+    glutInitDisplayMode(GLUT_RGB | GLUT_DOUBLE)
+    glutInitWindowPosition(12000, 12000)  # probably this is offscreen.
+    glutCreateWindow('benchmark')
+    setupFbo(size)
+
+def setupFbo(size):
+    from OpenGL.GL import glGenRenderbuffers, glBindRenderbuffer, glRenderbufferStorage, \
+         glGenFramebuffers, glBindFramebuffer, glFramebufferRenderbuffer, \
+         glCheckFramebufferStatus, GL_RENDERBUFFER, GL_RGBA8, GL_FRAMEBUFFER, \
+         GL_COLOR_ATTACHMENT0, GL_FRAMEBUFFER_COMPLETE
+
+    rbobj = glGenRenderbuffers(1)
+    glBindRenderbuffer(GL_RENDERBUFFER, rbobj)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, size[0], size[1])
+    fbobj = glGenFramebuffers(1)
+    glBindFramebuffer(GL_FRAMEBUFFER, fbobj)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, rbobj)
+    status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+    assert(status == GL_FRAMEBUFFER_COMPLETE)
+
+def benchmarkGL(timer, mpcdi, media, outputFilename, numFrames, repeat):
+    """ Times the texture upload, and the initialization and drawing
+    of both OpenGL renderers, on the first region.  An OpenGL context
+    must be current. """
+
+    from OpenGL.GL import glFinish, glViewport, glMatrixMode, glLoadIdentity, \
+         glOrtho, glClear, glGetString, GL_PROJECTION, GL_MODELVIEW, \
+         GL_COLOR_BUFFER_BIT, GL_RENDERER
+    from MpacsWarp2DShader import MpacsWarp2DShader
+    from MpacsWarp2DFixedFunction import MpacsWarp2DFixedFunction
+
+    region = mpcdi.getRegion(mpcdi.regionIdList[0])
+    width, height = region.Xresolution, region.Yresolution
+    glViewport(0, 0, width, height)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    glOrtho(0, 1, 1, 0, -100, 100)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+
+    for i in range(repeat):
+        image = TextureImage(array = media)
+        start = time.time()
+        image.initGL()
+        glFinish()
+        timer.add('TextureImage.upload', time.time() - start)
+        image.releaseGL()
+
+    for warpClass in [MpacsWarp2DShader, MpacsWarp2DFixedFunction]:
+        name = warpClass.__name__
+        warp = warpClass(mpcdi, region)
+        warp.setMedia(TextureImage(array = media))
+
+        start = time.time()
+        warp.initGL()
+        glFinish()
+        timer.add(name + '.initGL', time.time() - start)
+
+        for i in range(numFrames):
+            start = time.time()
+            glClear(GL_COLOR_BUFFER_BIT)
+            warp.draw()
+            glFinish()
+            timer.add(name + '.draw', time.time() - start)
+
+        # saveOutputImage() is called by draw(); here it is timed on
+        # its own, after each frame has finished rendering.
+        for i in range(numFrames):
+            warp.draw()
+            glFinish()
+            warp.setOutputFilename(outputFilename)
+            timer.time(name + '.saveOutputImage', warp.saveOutputImage)
+            warp.setOutputFilename(None)
+        timer.time(name + '.finishOutput', warp.finishOutput)
+
+    return glGetString(GL_RENDERER)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortOptions)
+    except getopt.error, msg:
+        usage(1, msg)
+
+    synthetic = SyntheticMpcdi()
+    mediaSize = (1920, 1080)
+    numFrames = 20
+    repeat = 5
+    useGL = False
+    outputFilename = None
+
+    for opt, arg in opts:
+        if opt == '-n':
+            synthetic.numRegions = int(arg)
+        elif opt == '-r':
+            synthetic.regionSize = tuple(map(int, arg.split(',')))
+        elif opt == '-p':
+            synthetic.pfmSize = tuple(map(int, arg.split(',')))
+        elif opt == '-a':
+            synthetic.alpha = False
+        elif opt == '-b':
+            synthetic.beta = False
+        elif opt == '-d':
+            synthetic.bitDepth = int(arg)
+            if synthetic.bitDepth not in [8, 16]:
+                usage(1, 'The bit depth must be 8 or 16.')
+        elif opt == '-D':
+            synthetic.asDirectory = True
+        elif opt == '-s':
+            synthetic.compress = False
+        elif opt == '-m':
+            mediaSize = tuple(map(int, arg.split(',')))
+        elif opt == '-f':
+            numFrames = int(arg)
+        elif opt == '-R':
+            repeat = int(arg)
+        elif opt == '-G':
+            useGL = True
+        elif opt == '-H':
+            if arg not in OffscreenContext.backends:
+                usage(1, 'Unknown offscreen backend %s' % (arg))
+        elif opt == '-o':
+            outputFilename = arg
+        elif opt == '-h':
+            usage(0)
+
+    # Keep standard output for the report.
+    ImageWriter.reportWrites = False
+
+    report = runBenchmark(synthetic, mediaSize, numFrames, repeat, useGL)
+
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if outputFilename:
+        file = open(outputFilename, 'w')
+        file.write(text + '\n')
+        file.close()
+    else:
+        print text
+
+def runBenchmark(synthetic, mediaSize, numFrames, repeat, useGL):
+    """ Generates the synthetic mpcdi file in a scratch directory,
+    runs all of the benchmarks against it, and returns the report as
+    a dictionary. """
+
+    import PIL, OpenGL
+
+    scratchDirectory = tempfile.mkdtemp(prefix = 'pympcdi_benchmark')
+    try:
+        filename = os.path.join(scratchDirectory, 'synthetic.mpcdi')
+        synthetic.write(filename)
+        mediaFilename = os.path.join(scratchDirectory, 'media.png')
+        Image.fromarray(makeMedia(mediaSize)).save(mediaFilename)
+        outputFilename = os.path.join(scratchDirectory, 'output.png')
+
+        timer = StageTimer()
+        mpcdi = benchmarkLoading(timer, filename, repeat)
+        media = benchmarkMedia(timer, mediaFilename, repeat)
+        benchmarkNumPy(timer, mpcdi, media, outputFilename, numFrames)
+
+        renderer = None
+        if useGL:
+            region = mpcdi.getRegion(mpcdi.regionIdList[0])
+            createGLContext((region.Xresolution, region.Yresolution))
+            renderer = benchmarkGL(timer, mpcdi, media, outputFilename, numFrames, repeat)
+    finally:
+        shutil.rmtree(scratchDirectory, ignore_errors = True)
+
+    return {
+        'version' : reportVersion,
+        'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform' : {
+            'python' : platform.python_version(),
+            'machine' : platform.machine(),
+            'system' : platform.system(),
+            'numpy' : numpy.__version__,
+            'pillow' : PIL.__version__,
+            'pyopengl' : OpenGL.__version__,
+            'renderer' : renderer,
+            },
+        'config' : dict(synthetic.getConfig(), mediaSize = list(mediaSize),
+                        numFrames = numFrames, repeat = repeat, useGL = useGL),
+        'stages' : timer.getResults(),
+        }
+
+if __name__ == '__main__':
+    main()
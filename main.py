@@ -1,13 +1,37 @@
-from MpcdiFile import MpcdiFile
+import OffscreenContext
 import sys
 import getopt
+
+# The command-line options.  -H is picked out of them before anything
+# else is imported, because it selects the platform PyOpenGL binds to
+# when it is first imported.
+shortOptions = 'm:i:o:I:O:P:V:r:s:g:j:c:C:d:a:T:R:H:bfnSMFEGlqh'
+OffscreenContext.selectPlatformFromArgs(sys.argv[1:], shortOptions)
+
+from MpcdiLibrary import MpcdiLibrary
 import copy
 from OpenGL.GL import *
-from OpenGL.GLUT import *
+if not OffscreenContext.backend:
+    from OpenGL.GLUT import *
 import TextureImage
+import MpacsWarp2D
+import RemapTable
+import RenderMap
+import ShaderCache
+import AssetCache
+import MediaSequence
+import MediaLibrary
+import MediaStream
+import ParallelRender
+import Profiler
+import GpuTimer
+import os.path
+import time
 
 from MpacsWarp2DShader import MpacsWarp2DShader
 from MpacsWarp2DFixedFunction import MpacsWarp2DFixedFunction
+from MpacsWarp2DNumPy import MpacsWarp2DNumPy
+from MpacsWarp2DAtlas import MpacsWarp2DAtlas
 
 help = """
 
@@ -45,6 +69,22 @@ Options:
         Specify an optional image filename to save the warped output
         to.  The default is not to save it, only to display it.
 
+    -I inputSequence
+        Render a sequence of media files in batch, instead of a
+        single image.  The sequence may be named by a directory, in
+        which case all of the images within it are rendered in sorted
+        order, or by a (quoted) glob pattern such as 'frames/*.png'.
+        This requires -O.
+
+    -O outputPattern
+        Specify the output filenames for -I, as a pattern containing a
+        printf-style integer directive that is replaced by the frame
+        number, counting from 0; for instance, 'out/region1_%04d.png'.
+
+    -P prefetchCount
+        Specify the number of frames of -I to decode ahead of the
+        renderer, in a background thread.  The default is 4.
+
     -s width,height
         Specify the size of the window.
 
@@ -58,10 +98,115 @@ Options:
         Enable mipmapping.  Without this option simple bilinear
         filtering is used instead.
 
+    -F
+        Upload the whole media image for every region.  Without this
+        option, a region that samples only a small part of a large
+        media image (or an image too large for one texture) uploads
+        only the rectangle it samples.  This is never done with -M.
+
+        If the rectangle is still larger than the OpenGL maximum
+        texture size, the shader-based implementation uploads it as
+        several tiles, drawn in a pass each.  Otherwise (with -f, -a,
+        -V, -F or -M), an image larger than the maximum texture size
+        is downsampled to fit, losing detail, with a warning.
+
     -f
         Use the fixed-function implementation instead of the
         shader-based implementation.
 
+    -d tolerance
+        Decimate the mesh used by the fixed-function implementation,
+        dropping the pfm grid rows and columns that can be linearly
+        interpolated from their neighbors to within this tolerance,
+        in media UV units (for instance, 0.0002).
+
+    -S
+        Build the mesh used by the fixed-function implementation as
+        triangle strips, omitting the grid cells that touch a NaN in
+        the pfm file.
+
+    -a layout
+        Atlas mode: render every region of the buffer that contains
+        the named region into one window, in a single pass, with one
+        shared media texture and one readback per frame.  The layout
+        is either "packed", to draw each region at its own resolution
+        side by side, or "buffer", to draw each region into its own
+        rectangle of the buffer.
+
+    -V inputSequence
+        Play a sequence of media files as video in the window,
+        looping, as with -I.  The frames are decoded in a background
+        thread and streamed into one media texture through a ring of
+        pixel buffer objects; frames that are not ready in time for
+        a redraw are skipped.
+
+    -n
+        Use the CPU (NumPy) implementation instead of OpenGL.  This
+        requires -o, and needs neither a display nor an OpenGL
+        context.
+
+    -j numProcesses
+        Render the -n regions (and the frames of their -I sequences)
+        in parallel, across a pool of this many processes.  The
+        default is to render them one at a time in this process.
+
+    -c cacheDirectory
+        Specify a directory in which to keep precompiled data across
+        runs, such as decoded pfm grids and blend maps, the remap
+        tables compiled by -n, the render maps compiled by -R, and
+        the binaries of the compiled shader programs.
+
+    -C cacheSize
+        Specify the maximum size, in megabytes, of the decoded assets
+        kept in the cache directory.  The least recently used assets
+        are deleted first.
+
+    -l
+        List the regions defined within the mpcdi file, with their
+        buffers, resolutions and data files, and exit without
+        rendering.  Only the index of the file is read.
+
+    -q
+        Quiet mode: don't report each file and region as it is read.
+
+    -R format
+        Draw with the shader-based implementation from a render map:
+        a single texture at the window resolution holding the
+        transformed media UV's and the linearized blend maps, so that
+        each pixel needs only two texture lookups.  The format is
+        either "unorm16", normalized 16-bit integers, or "float16",
+        half floats.  The maximum UV error of the map is reported
+        when it is compiled.  This requires single-channel blend
+        maps.
+
+    -E
+        Allow the shader-based implementation to use sRGB texture
+        formats for the media, and an sRGB framebuffer for the
+        output, in place of the gamma curves, when the media and
+        target gammas are close to 2.2.  This is faster but only
+        approximates a 2.2 gamma curve.
+
+    -G
+        Measure the time the GPU spends drawing each frame, with
+        OpenGL timer queries, and report the 50th, 95th and 99th
+        percentile times periodically and on exit.  The first frame
+        of each region is reported separately, as a warm-up time.
+
+    -H backend
+        Render offscreen, with no window system at all, instead of
+        in GLUT windows.  The backend is either "egl" or "osmesa";
+        both work with Mesa's software renderer on a machine with no
+        GPU.  Each region is drawn once into a framebuffer object,
+        saved, and the program exits.  This requires -o or -O for
+        every region.
+
+    -T traceFilename
+        Record the time spent in each stage of loading, setup,
+        drawing and readback, and write it to the indicated file on
+        exit, as JSON in the Chrome trace event format (which may be
+        viewed in chrome://tracing or Perfetto), with a summary of
+        the totals for each stage.
+
 """
 
 
@@ -76,21 +221,37 @@ class Window:
         self.mpcdiFilename = None
         self.mediaFilename = None
         self.outputFilename = None
+        self.inputSequence = None
+        self.outputPattern = None
+        self.prefetchCount = 4
+        self.streamSequence = None
         self.useFbo = False
         self.regionName = None
         self.mediaFilename = 'color_grid.png'
         self.targetGamma = None
         self.useFixedFunction = False
+        self.meshTolerance = None
+        self.useStrips = False
+        self.useNumPy = False
+        self.atlasLayout = None
         self.windowSize = None
         self.includeBlend = None
 
+        # The size set by reshape(); see applyViewport().
+        self.viewportSize = None
+
         # MPCDI file.
         self.mpcdi = None
 
         # Warping object.
         self.warp = None
 
+        # The MediaStream for -V.
+        self.stream = None
+
+    @Profiler.profiled('Window.frame')
     def draw_bg(self):
+        self.applyViewport()
         glClear(GL_COLOR_BUFFER_BIT)
         self.warp.draw()
 
@@ -111,8 +272,23 @@ class Window:
 
         print "%s rendering at size %s, %s" % (self.regionName, width, height)
         self.warp.setWindowSize((width, height))
+        self.viewportSize = (width, height)
+
+        self.applyViewport()
+
+    def applyViewport(self):
+        """ Binds this window's framebuffer, and sets up the viewport
+        and projection for it.  All of the windows share one OpenGL
+        context, so this state is set again before each frame. """
 
-        h = float(height) / float(width);
+        if self.viewportSize is None:
+            return
+        width, height = self.viewportSize
+
+        if self.useFbo:
+            glBindFramebuffer(GL_FRAMEBUFFER, self.fbobj)
+        else:
+            glBindFramebuffer(GL_FRAMEBUFFER, 0)
         glViewport(0, 0, width, height)
 
         glMatrixMode(GL_PROJECTION)
@@ -122,11 +298,24 @@ class Window:
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
 
+    def makeCurrent(self):
+        """ Directs the OpenGL commands that follow to this window. """
+        if OffscreenContext.backend:
+            # All of the windows share the one context, and differ
+            # only in their framebuffer objects.
+            glBindFramebuffer(GL_FRAMEBUFFER, self.fbobj)
+        else:
+            glutSetWindow(self.windowId)
+
     def setupFbo(self):
         # All we need is a color buffer.
         self.rbobj = glGenRenderbuffers(1)
         glBindRenderbuffer(GL_RENDERBUFFER, self.rbobj)
-        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8,
+        if TextureImage.useSrgb:
+            format = GL_SRGB8_ALPHA8
+        else:
+            format = GL_RGBA8
+        glRenderbufferStorage(GL_RENDERBUFFER, format,
                               self.windowSize[0], self.windowSize[1])
 
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
@@ -147,28 +336,70 @@ class Window:
         if not self.regionName:
             self.regionName = self.mpcdi.regionIdList[0]
 
-        self.region = self.mpcdi.regions[self.regionName]
+        self.region = self.mpcdi.getRegion(self.regionName)
 
-        if self.useFixedFunction:
-            self.warp = MpacsWarp2DFixedFunction(self.mpcdi, self.region)
+        if self.useNumPy:
+            warpClass = MpacsWarp2DNumPy
+        elif self.useFixedFunction:
+            warpClass = MpacsWarp2DFixedFunction
         else:
-            self.warp = MpacsWarp2DShader(self.mpcdi, self.region)
+            warpClass = MpacsWarp2DShader
+
+        if self.atlasLayout:
+            self.warp = MpacsWarp2DAtlas(self.mpcdi, self.region.buffer.id,
+                                         warpClass, layout = self.atlasLayout)
+            warps = self.warp.warps
+            print "%s atlas of %s regions at size %s, %s" % (
+                self.region.buffer.id, len(warps),
+                self.warp.atlasSize[0], self.warp.atlasSize[1])
+        else:
+            self.warp = warpClass(self.mpcdi, self.region)
+            warps = [self.warp]
+
+        for warp in warps:
+            if self.targetGamma is not None:
+                warp.targetGamma = self.targetGamma
+
+            if self.includeBlend is not None:
+                warp.includeBlend = self.includeBlend
 
-        if self.targetGamma is not None:
-            self.warp.targetGamma = self.targetGamma
+            if self.meshTolerance is not None:
+                warp.meshTolerance = self.meshTolerance
 
-        if self.includeBlend is not None:
-            self.warp.includeBlend = self.includeBlend
+            if self.useStrips:
+                warp.useStrips = True
 
         if not self.windowSize:
-            self.windowSize = self.region.Xresolution, self.region.Yresolution
+            if self.atlasLayout:
+                self.windowSize = self.warp.atlasSize
+            else:
+                self.windowSize = self.region.Xresolution, self.region.Yresolution
 
         self.warp.setWindowSize(self.windowSize)
-        self.warp.setMediaFilename(self.mediaFilename)
+        if self.streamSequence:
+            self.setupStream()
+        elif not self.inputSequence:
+            # In batch mode, the media is supplied frame by frame
+            # instead.
+            self.warp.setMediaFilename(self.mediaFilename)
         if self.outputFilename:
             self.warp.setOutputFilename(self.outputFilename)
+        if self.outputFilename or self.outputPattern:
             self.useFbo = True
 
+        if self.useNumPy:
+            # There's no window to create.
+            self.warp.initGL()
+            return
+
+        if OffscreenContext.backend:
+            # There's no window to create either; we render straight
+            # into an FBO on the shared offscreen context.
+            OffscreenContext.getContext()
+            self.setupFbo()
+            self.warp.initGL()
+            return
+
         displayMode = GLUT_RGB | GLUT_DOUBLE
         glutInitDisplayMode(displayMode)
 
@@ -180,6 +411,11 @@ class Window:
             glutInitWindowPosition(-1, -1)
 
         self.windowId = glutCreateWindow(self.regionName)
+        if MediaLibrary.shareMedia:
+            # The windows created after this one draw with this
+            # window's context, so they all share the media textures
+            # and the shader programs.
+            glutSetOption(GLUT_RENDERING_CONTEXT, GLUT_USE_CURRENT_CONTEXT)
 
         if self.useFbo:
             # If we're using an FBO to render, we don't need an
@@ -187,29 +423,149 @@ class Window:
             self.setupFbo()
 
         self.warp.initGL()
+        if self.stream:
+            self.stream.startProducer(loopMediaSequence(self.streamFilenames))
 
         glutDisplayFunc(self.draw)
         glutReshapeFunc(self.reshape)
         glutKeyboardFunc(self.key)
 
+    def setupStream(self):
+        """ Creates the MediaStream that plays self.streamSequence,
+        sized to match its first frame. """
+
+        self.streamFilenames = MediaSequence.listMediaSequence(self.streamSequence)
+        if not self.streamFilenames:
+            print >> sys.stderr, "No media files found in %s" % (self.streamSequence)
+            sys.exit(1)
+
+        first = TextureImage.TextureImage(self.streamFilenames[0]).getArray()
+        self.stream = MediaStream.MediaStream((first.shape[1], first.shape[0]),
+                                              first.shape[2], first.dtype)
+        self.warp.setMediaStream(self.stream)
+
+    def renderBatchFrame(self, media, frameIndex, waitTime):
+        """ Renders one frame of self.inputSequence to the file named
+        by self.outputPattern, reusing the one warp object that has
+        already been set up by setupDisplay(); only the media texture
+        changes from frame to frame.  See renderBatches(). """
+
+        frameStart = time.time()
+        if not self.useNumPy:
+            self.makeCurrent()
+            if self.viewportSize is None:
+                self.reshape(*self.windowSize)
+        if not self.useNumPy and not MediaLibrary.shareMedia:
+            # This window's context can't see the textures of the
+            # others, so it needs an upload of its own; the decoded
+            # frame is still shared.
+            media = media.copy()
+        self.warp.setMedia(media)
+        self.warp.setOutputFilename(self.outputPattern % (frameIndex))
+        if self.useNumPy:
+            self.warp.draw()
+        else:
+            self.draw_bg()
+        frameTime = time.time() - frameStart
+
+        print "%s frame %s: %s, waited %.1f ms for decode, rendered in %.1f ms" % (
+            self.regionName, frameIndex, media.filename,
+            waitTime * 1000.0, frameTime * 1000.0)
+
+    def finishBatch(self):
+        """ Saves the frames still pending from renderBatchFrame(). """
+
+        if not self.useNumPy:
+            self.makeCurrent()
+        self.warp.finishOutput()
+
+        if not self.useNumPy and not OffscreenContext.backend:
+            # We're done with this window.
+            glutDestroyWindow(self.windowId)
+
+def renderBatches(batchWindows):
+    """ Renders the -I sequences of the indicated windows.  The
+    windows showing the same sequence are driven together, frame by
+    frame, from one MediaPrefetcher, so each frame is decoded only
+    once, and (if MediaLibrary.shareMedia is set) uploaded as only
+    one texture, however many regions show it.  The frames are
+    decoded ahead of time in a background thread. """
+
+    sequences = []
+    sequenceWindows = {}
+    for window in batchWindows:
+        if window.inputSequence not in sequenceWindows:
+            sequences.append(window.inputSequence)
+            sequenceWindows[window.inputSequence] = []
+        sequenceWindows[window.inputSequence].append(window)
+
+    for inputSequence in sequences:
+        group = sequenceWindows[inputSequence]
+        filenames = MediaSequence.listMediaSequence(inputSequence)
+        if not filenames:
+            print >> sys.stderr, "No media files found in %s" % (inputSequence)
+            sys.exit(1)
+
+        prefetchCount = max([window.prefetchCount for window in group])
+        prefetcher = MediaSequence.MediaPrefetcher(filenames, prefetchCount)
+        startTime = time.time()
+        frameIndex = 0
+        for media in prefetcher:
+            waitTime = prefetcher.lastWaitTime
+            for window in group:
+                window.renderBatchFrame(media, frameIndex, waitTime)
+                # Only the first window waited for it.
+                waitTime = 0.0
+            frameIndex += 1
+
+        for window in group:
+            window.finishBatch()
+        totalTime = time.time() - startTime
+        print "%s rendered %s frames in %.2f s (%.1f frames per second, %.2f s waiting for decode)" % (
+            ', '.join([window.regionName for window in group]), frameIndex, totalTime,
+            frameIndex / max(totalTime, 1e-6), prefetcher.waitTime)
+
+def loopMediaSequence(filenames):
+    """ Yields a TextureImage for each of filenames, over and over;
+    the images are decoded by the consumer. """
+    while True:
+        for filename in filenames:
+            yield TextureImage.TextureImage(filename)
+
 defaultWindowParams = Window()
 currentWindow = defaultWindowParams
 windows = []
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'm:i:o:r:s:g:bfMh')
+    opts, args = getopt.getopt(sys.argv[1:], shortOptions)
 except getopt.error, msg:
     usage(1, msg)
 
-# A global table of MPCDI files read from disk.
-mpcdis = {}
+# -q must be known before the first -m is processed.
+verbose = ('-q', '') not in opts
+
+# Likewise -T, so that loading the mpcdi files is profiled too.
+for opt, arg in opts:
+    if opt == '-T':
+        Profiler.enable(arg)
+
+# All of the MPCDI files read from disk.  Regions that use identical
+# pfm files or blend maps share the decoded data.
+library = MpcdiLibrary(verbose = verbose)
+
+# Set true by -l to list the regions and exit.
+listRegions = False
+
+# The number of processes to render -n regions with, if -j is given.
+numProcesses = 1
+
+# The on-disk cache of decoded assets, if -c is given.
+assetCache = None
+assetCacheSize = None
 
 def readMpcdi(mpcdiFilename):
-    mpcdi = mpcdis.setdefault(mpcdiFilename, None)
-    if mpcdi is None:
-        mpcdi = MpcdiFile(mpcdiFilename)
-        mpcdis[mpcdiFilename] = mpcdi
-    return mpcdi
+    # Only the regions we actually display are read in full.
+    return library.getBundle(library.addBundle(mpcdiFilename))
 
 for opt, arg in opts:
     if opt == '-m':
@@ -219,6 +575,14 @@ for opt, arg in opts:
         currentWindow.mediaFilename = arg
     elif opt == '-o':
         currentWindow.outputFilename = arg
+    elif opt == '-I':
+        currentWindow.inputSequence = arg
+    elif opt == '-O':
+        currentWindow.outputPattern = arg
+    elif opt == '-P':
+        currentWindow.prefetchCount = int(arg)
+    elif opt == '-V':
+        currentWindow.streamSequence = arg
     elif opt == '-r':
         # Each occurrence of -r defines a new region.  The parameters
         # following -r apply to the region we just named.
@@ -233,11 +597,63 @@ for opt, arg in opts:
         currentWindow.includeBlend = False
     elif opt == '-f':
         currentWindow.useFixedFunction = True
+    elif opt == '-d':
+        currentWindow.meshTolerance = float(arg)
+    elif opt == '-S':
+        currentWindow.useStrips = True
+    elif opt == '-n':
+        currentWindow.useNumPy = True
+    elif opt == '-a':
+        if arg not in ['packed', 'buffer']:
+            usage(1, 'Unknown atlas layout %s' % (arg))
+        currentWindow.atlasLayout = arg
+    elif opt == '-j':
+        numProcesses = int(arg)
+    elif opt == '-c':
+        RemapTable.cacheDirectory = os.path.join(arg, 'remap')
+        RenderMap.cacheDirectory = os.path.join(arg, 'rendermap')
+        ShaderCache.cacheDirectory = os.path.join(arg, 'shaders')
+        assetCache = AssetCache.AssetCache(os.path.join(arg, 'assets'))
+    elif opt == '-C':
+        assetCacheSize = int(float(arg) * 1024 * 1024)
     elif opt == '-M':
         TextureImage.useMipmapping = True
+    elif opt == '-F':
+        MpacsWarp2D.cropMedia = False
+    elif opt == '-R':
+        if arg not in RenderMap.renderMapTypes:
+            usage(1, 'Unknown render map format %s' % (arg))
+        RenderMap.useRenderMap = True
+        RenderMap.renderMapFormat = arg
+    elif opt == '-E':
+        TextureImage.useSrgb = True
+    elif opt == '-G':
+        GpuTimer.enable()
+    elif opt == '-l':
+        listRegions = True
+    elif opt == '-H':
+        if arg not in OffscreenContext.backends:
+            usage(1, 'Unknown offscreen backend %s' % (arg))
+    elif opt in ['-q', '-T']:
+        pass
     elif opt == '-h':
         usage(0)
 
+if listRegions:
+    for bundleId in library.bundleIdList:
+        print "%s:" % (bundleId)
+        for bundleId, summary in library.findRegions(bundleIds = [bundleId]):
+            print "  %s: buffer %s, %s x %s" % (
+                summary.id, summary.buffer.id, summary.Xresolution, summary.Yresolution)
+            for keyword, path in sorted(summary.paths.items()):
+                print "    %s: %s" % (keyword, path)
+    sys.exit(0)
+
+if assetCache:
+    if assetCacheSize is not None:
+        assetCache.maxSize = assetCacheSize
+    library.setAssetCache(assetCache)
+
 if currentWindow is defaultWindowParams:
     # No regionName has been specified, so no explicit Window object
     # was created; use the default.
@@ -247,13 +663,76 @@ for window in windows:
     if not window.mpcdiFilename:
         print >> sys.stderr, "No mpcdi filename specified.  Use -h for help."
         sys.exit(1)
+    if bool(window.inputSequence) != bool(window.outputPattern):
+        print >> sys.stderr, "-I and -O must be used together.  Use -h for help."
+        sys.exit(1)
+    if window.streamSequence and (window.useNumPy or window.inputSequence):
+        print >> sys.stderr, "-V cannot be used with -n or -I.  Use -h for help."
+        sys.exit(1)
+    if window.useNumPy and window.atlasLayout:
+        print >> sys.stderr, "-a cannot be used with -n.  Use -h for help."
+        sys.exit(1)
+    if window.useNumPy and not (window.outputFilename or window.outputPattern):
+        print >> sys.stderr, "-n requires an output filename.  Use -h for help."
+        sys.exit(1)
+    if OffscreenContext.backend and window.streamSequence:
+        print >> sys.stderr, "-V cannot be used with -H.  Use -h for help."
+        sys.exit(1)
+    if OffscreenContext.backend and not (window.outputFilename or window.outputPattern):
+        print >> sys.stderr, "-H requires an output filename.  Use -h for help."
+        sys.exit(1)
 
-glutInit(sys.argv)
+# We only need GLUT if at least one region is rendered with OpenGL,
+# and not offscreen.
+useGlut = False
+for window in windows:
+    if not window.useNumPy and not OffscreenContext.backend:
+        useGlut = True
+
+if useGlut:
+    glutInit(sys.argv)
+    if not glutSetOption:
+        # Without freeglut, each window gets a context of its own,
+        # and they can't share their media.
+        MediaLibrary.shareMedia = False
 allOutputFilename = True
+interactiveWindows = []
 for window in windows:
     window.setupDisplay()
-    if not window.outputFilename:
-        allOutputFilename = False
+    if not window.inputSequence:
+        interactiveWindows.append(window)
+        if not window.outputFilename:
+            allOutputFilename = False
+
+# The CPU-rendered regions can be fanned out across a process pool.
+numPyWindows = [window for window in windows if window.useNumPy]
+if numPyWindows and numProcesses > 1:
+    ParallelRender.renderWindows(numPyWindows, numProcesses)
+else:
+    for window in numPyWindows:
+        if not window.inputSequence:
+            window.warp.draw()
+            window.warp.finishOutput()
+
+# Batch sequences are rendered directly, without the GLUT main loop.
+renderBatches([window for window in windows
+               if window.inputSequence and not (window.useNumPy and numProcesses > 1)])
+
+if OffscreenContext.backend:
+    # With no window system there is no main loop either: draw each
+    # region once, save it, and exit.
+    for window in interactiveWindows:
+        if not window.useNumPy:
+            window.makeCurrent()
+            window.reshape(*window.windowSize)
+            window.draw_bg()
+            window.warp.finishOutput()
+    OffscreenContext.releaseContext()
+    sys.exit(0)
+
+if not useGlut or not interactiveWindows:
+    # Everything has already been rendered.
+    sys.exit(0)
 
 quitCount = 0
 def quitFunc():
@@ -262,6 +741,10 @@ def quitFunc():
     if quitCount < 50:
         return
 
+    for window in interactiveWindows:
+        glutSetWindow(window.windowId)
+        window.warp.finishOutput()
+
     print "Exiting"
     sys.exit(0)
 
@@ -270,5 +753,15 @@ if allOutputFilename:
     # quit after one frame, it sometimes locks up; some weird glut
     # interaction I suppose.)
     glutIdleFunc(quitFunc)
+else:
+    streamWindows = [window for window in interactiveWindows if window.stream]
+    if streamWindows:
+        def animateFunc():
+            # Keep redrawing the video windows; each redraw shows the
+            # newest frame that has been decoded.
+            for window in streamWindows:
+                glutSetWindow(window.windowId)
+                glutPostRedisplay()
+        glutIdleFunc(animateFunc)
 
 glutMainLoop()
@@ -0,0 +1,51 @@
+import unittest
+import tempfile
+import shutil
+import os
+from MpcdiLibrary import MpcdiLibrary
+from MpacsWarp2DAtlas import MpacsWarp2DAtlas
+from MpacsWarp2DShader import MpacsWarp2DShader
+from MediaStream import MediaStream
+from TextureImage import TextureImage
+from SyntheticMpcdi import SyntheticMpcdi, makeMedia
+
+class TestMpacsWarp2DAtlas(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'pympcdi_test')
+        self.synthetic = SyntheticMpcdi(numRegions = 2, regionSize = (160, 90), pfmSize = (16, 9))
+        filename = os.path.join(self.directory, 'test.mpcdi')
+        self.synthetic.write(filename)
+
+        self.library = MpcdiLibrary(verbose = False)
+        self.mpcdi = self.library.getBundle(self.library.addBundle(filename))
+        regionId = self.synthetic.getRegionIds()[0]
+        self.atlas = MpacsWarp2DAtlas(self.mpcdi, self.mpcdi.getRegion(regionId).buffer.id,
+                                      MpacsWarp2DShader)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def testLayout(self):
+        self.assertEqual(len(self.atlas.warps), 2)
+        self.assertEqual(tuple(self.atlas.atlasSize), (320, 90))
+        self.assertEqual(tuple(self.atlas.windowSize), (320, 90))
+
+    def testSetMediaStream(self):
+        # This is what main.py -a -V does before initGL().
+        stream = MediaStream((320, 180))
+        self.atlas.setMediaStream(stream)
+        self.assertIs(self.atlas.media, stream)
+        self.assertIs(self.atlas.mediaStream, stream)
+        for warp in self.atlas.warps:
+            self.assertIs(warp.media, stream)
+
+    def testSetMedia(self):
+        media = TextureImage(array = makeMedia((320, 180)))
+        self.atlas.setMedia(media)
+        self.assertIs(self.atlas.media, media)
+        for warp in self.atlas.warps:
+            self.assertIs(warp.media, media)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import subprocess
+import tempfile
+import shutil
+import sys
+import os
+from PIL import Image
+from MpcdiLibrary import MpcdiLibrary
+from MpacsWarp2DNumPy import MpacsWarp2DNumPy
+from SyntheticMpcdi import SyntheticMpcdi, makeMedia
+from test_RenderServer import findOffscreenBackend, readImage, rootDirectory
+
+class TestMpacsWarp2DNumPy(unittest.TestCase):
+    """ Compares the NumPy implementation with the shader-based
+    implementation, rendered offscreen, if there is a backend for
+    that. """
+
+    # The largest difference allowed in any color, in 8-bit levels,
+    # for the bilinear filtering of different hardware.
+    tolerance = 2
+
+    def setUp(self):
+        self.backend = findOffscreenBackend()
+        if not self.backend:
+            self.skipTest('No offscreen OpenGL backend is available')
+
+        self.directory = tempfile.mkdtemp(prefix = 'pympcdi_test')
+        self.mpcdiFilename = os.path.join(self.directory, 'test.mpcdi')
+        SyntheticMpcdi(numRegions = 2, regionSize = (320, 180), pfmSize = (32, 18)).write(self.mpcdiFilename)
+
+        # A checkerboard, so that any error in the sample position
+        # shows.
+        self.mediaSize = (640, 360)
+        self.mediaFilename = os.path.join(self.directory, 'media.png')
+        Image.fromarray(makeMedia(self.mediaSize)).save(self.mediaFilename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def render(self, regionId, renderArgs):
+        outputFilename = os.path.join(self.directory, '%s_%s.png' % (regionId, renderArgs[0]))
+        subprocess.check_call([sys.executable, os.path.join(rootDirectory, 'main.py'),
+                               '-q', '-m', self.mpcdiFilename, '-r', regionId,
+                               '-i', self.mediaFilename, '-o', outputFilename] + renderArgs,
+                              stdout = open(os.devnull, 'w'))
+        return readImage(outputFilename).astype('int32')
+
+    def getInteriorMask(self, regionId):
+        """ Returns the mask of the output pixels whose samples of the
+        pfm grid and of the media lie between texel centers.  Nearer
+        the edges, the shader's GL_CLAMP textures blend in their
+        border color, where MpacsWarp2DNumPy clamps to the edge
+        texels. """
+
+        library = MpcdiLibrary(verbose = False)
+        mpcdi = library.getBundle(library.addBundle(self.mpcdiFilename))
+        warp = MpacsWarp2DNumPy(mpcdi, mpcdi.getRegion(regionId))
+        u, v, pfmX, pfmY = warp.computeMediaUVs()
+
+        xSize, ySize = self.mediaSize
+        x = u * xSize - 0.5
+        y = v * ySize - 0.5
+        return (x >= 0) & (x <= xSize - 1) & (y >= 0) & (y <= ySize - 1) & \
+               (pfmX >= 0) & (pfmX <= warp.pfm.xSize - 1) & \
+               (pfmY >= 0) & (pfmY <= warp.pfm.ySize - 1)
+
+    def testMatchesShader(self):
+        for regionId in ['region0', 'region1']:
+            numPyImage = self.render(regionId, ['-n'])
+            shaderImage = self.render(regionId, ['-H', self.backend])
+            self.assertEqual(numPyImage.shape, shaderImage.shape)
+
+            mask = self.getInteriorMask(regionId)
+            self.assertGreater(mask.mean(), 0.8)
+            difference = abs(numPyImage - shaderImage)[mask]
+            self.assertLessEqual(difference.max(), self.tolerance)
+
+if __name__ == '__main__':
+    unittest.main()
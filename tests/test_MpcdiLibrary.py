@@ -0,0 +1,101 @@
+import unittest
+import tempfile
+import shutil
+import os
+from MpcdiFile import MpcdiFile
+from MpcdiLibrary import MpcdiLibrary
+from SyntheticMpcdi import SyntheticMpcdi
+
+class TestMpcdiLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'pympcdi_test')
+        self.library = MpcdiLibrary(verbose = False)
+
+        # Count the reads of each subfile, by bundle.
+        self.reads = {}
+        self.extractSubfileArray = MpcdiFile.extractSubfileArray
+        self.openSubfile = MpcdiFile.openSubfile
+
+        def extractSubfileArray(mpcdi, filename):
+            key = (os.path.basename(mpcdi.filename), filename)
+            self.reads[key] = self.reads.get(key, 0) + 1
+            return self.extractSubfileArray(mpcdi, filename)
+
+        def openSubfile(mpcdi, filename):
+            key = (os.path.basename(mpcdi.filename), filename)
+            self.reads[key] = self.reads.get(key, 0) + 1
+            return self.openSubfile(mpcdi, filename)
+
+        MpcdiFile.extractSubfileArray = extractSubfileArray
+        MpcdiFile.openSubfile = openSubfile
+
+    def tearDown(self):
+        MpcdiFile.extractSubfileArray = self.extractSubfileArray
+        MpcdiFile.openSubfile = self.openSubfile
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def addBundle(self, name, numRegions, asDirectory = False):
+        filename = os.path.join(self.directory, name)
+        synthetic = SyntheticMpcdi(numRegions = numRegions, regionSize = (160, 90),
+                                   pfmSize = (16, 9), asDirectory = asDirectory)
+        synthetic.write(filename)
+        return self.library.getBundle(self.library.addBundle(filename))
+
+    def extractAll(self, mpcdi):
+        """ Decodes every pfm and blend map of the bundle, and returns
+        the decoded arrays, which keep them in the library. """
+
+        arrays = []
+        for regionId in mpcdi.regionIdList:
+            arrays.append(mpcdi.extractPfmFile('%s.pfm' % (regionId)).getArray())
+            for keyword in ['alphaMap', 'betaMap']:
+                name = '%s_%s.png' % (regionId, keyword)
+                arrays.append(mpcdi.extractTextureImage(name).getArray())
+        return arrays
+
+    def testSharedAcrossBundles(self):
+        first = self.addBundle('first.mpcdi', 2)
+        firstArrays = self.extractAll(first)
+        # The blend maps are the same in every region.
+        self.assertEqual(self.library.numAssetsShared, 2)
+
+        second = self.addBundle('second.mpcdi', 3)
+        secondArrays = self.extractAll(second)
+
+        # region0 and region1 are identical in both bundles, and
+        # region2's blend maps are identical to the others; only
+        # region2.pfm is new.
+        self.assertEqual(self.library.numAssetsShared, 2 + 8)
+        self.assertIs(secondArrays[0], firstArrays[0])
+        self.assertIs(secondArrays[3], firstArrays[3])
+
+        # Each subfile is read at most once, whether for its key or to
+        # decode it.
+        for key, count in self.reads.items():
+            self.assertEqual(count, 1, key)
+
+    def testSharedWithDirectory(self):
+        first = self.addBundle('first.mpcdi', 2)
+        firstArrays = self.extractAll(first)
+
+        # A directory has no CRC-32's, but its files are still matched
+        # by their SHA-1.
+        second = self.addBundle('second', 2, asDirectory = True)
+        secondArrays = self.extractAll(second)
+        self.assertIs(secondArrays[0], firstArrays[0])
+        self.assertIs(secondArrays[3], firstArrays[3])
+
+    def testFreedAssetsAreNotCandidates(self):
+        # The arrays aren't kept, so they are freed at once.
+        first = self.addBundle('first.mpcdi', 2)
+        self.extractAll(first)
+
+        second = self.addBundle('second.mpcdi', 2)
+        secondArrays = self.extractAll(second)
+        self.assertEqual(self.library.numAssetsShared, 2 + 2)
+        self.assertEqual(self.reads[('second.mpcdi', 'region0.pfm')], 1)
+        self.assertEqual(self.reads[('second.mpcdi', 'region0_alphaMap.png')], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+import unittest
+import subprocess
+import tempfile
+import shutil
+import socket
+import threading
+import time
+import sys
+import os
+import numpy
+from PIL import Image
+from RenderClient import RenderClient
+from SyntheticMpcdi import SyntheticMpcdi, makeMedia
+
+rootDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The offscreen backend found by findOffscreenBackend(), or False if
+# there is none.
+offscreenBackend = None
+
+def findOffscreenBackend():
+    """ Returns the first offscreen backend (see OffscreenContext)
+    that can create a context here, or None if none can. """
+
+    global offscreenBackend
+    if offscreenBackend is None:
+        offscreenBackend = False
+        for backend in ['egl', 'osmesa']:
+            status = subprocess.call(
+                [sys.executable, '-c',
+                 'import OffscreenContext; OffscreenContext.selectPlatform("%s"); '
+                 'OffscreenContext.getContext()' % (backend)],
+                cwd = rootDirectory, stdout = open(os.devnull, 'w'), stderr = subprocess.STDOUT)
+            if status == 0:
+                offscreenBackend = backend
+                break
+    return offscreenBackend or None
+
+def startServer(socketFilename, renderArgs = ['-n']):
+    """ Starts RenderServer.py with the indicated options selecting
+    its implementation (by default the NumPy implementation, which
+    needs no OpenGL), and returns the process once it is accepting
+    connections. """
+
+    process = subprocess.Popen([sys.executable, os.path.join(rootDirectory, 'RenderServer.py'),
+                                '-q', '-S', socketFilename] + renderArgs)
+    deadline = time.time() + 30.0
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise StandardError, 'RenderServer.py exited with %s' % (process.returncode)
+        try:
+            client = RenderClient(socketFilename)
+        except socket.error:
+            time.sleep(0.1)
+            continue
+        client.ping()
+        client.close()
+        return process
+
+    process.kill()
+    raise StandardError, 'RenderServer.py did not start'
+
+def waitForExit(process, timeout = 30.0):
+    """ Returns the exit code of the process, or None if it is still
+    running after timeout seconds. """
+
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    return process.poll()
+
+def readImage(filename):
+    return numpy.asarray(Image.open(filename))
+
+class TestRenderServer(unittest.TestCase):
+
+    # The options of RenderServer.py and main.py that select the
+    # implementation to test.
+    renderArgs = ['-n']
+
+    # The number of different media images rendered at once by
+    # testConcurrentRequests().
+    numMedia = 3
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix = 'pympcdi_test')
+        cls.mpcdiFilename = os.path.join(cls.directory, 'test.mpcdi')
+        cls.synthetic = SyntheticMpcdi(numRegions = 2, regionSize = (160, 90), pfmSize = (16, 9))
+        cls.synthetic.write(cls.mpcdiFilename)
+        cls.mediaFilename = os.path.join(cls.directory, 'media.png')
+        Image.fromarray(makeMedia((320, 180))).save(cls.mediaFilename)
+
+        # Media that is different enough from one image to the next
+        # that the output of each is recognizable.
+        cls.mediaFilenames = []
+        for i in range(cls.numMedia):
+            filename = os.path.join(cls.directory, 'media%s.png' % (i))
+            Image.fromarray(numpy.roll(makeMedia((320, 180)), 50 * i, axis = 1)).save(filename)
+            cls.mediaFilenames.append(filename)
+
+        cls.socketFilename = os.path.join(cls.directory, 'render.sock')
+        cls.process = startServer(cls.socketFilename, cls.renderArgs)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.process.poll() is None:
+            cls.process.kill()
+            cls.process.wait()
+        shutil.rmtree(cls.directory, ignore_errors = True)
+
+    def setUp(self):
+        self.client = RenderClient(self.socketFilename)
+
+    def tearDown(self):
+        self.client.close()
+
+    def getFilename(self, name):
+        return os.path.join(self.directory, name)
+
+    def testRender(self):
+        regionId = self.synthetic.getRegionIds()[0]
+        outputFilename = self.getFilename('server.png')
+        response = self.client.render(self.mpcdiFilename, self.mediaFilename,
+                                      outputFilename, [regionId])
+        self.assertEqual(response['outputs'], { regionId : outputFilename })
+
+        # The server's output should match main.py's.
+        referenceFilename = self.getFilename('main.png')
+        subprocess.check_call([sys.executable, os.path.join(rootDirectory, 'main.py'),
+                               '-q', '-m', self.mpcdiFilename, '-r', regionId,
+                               '-i', self.mediaFilename, '-o', referenceFilename] + self.renderArgs,
+                              stdout = open(os.devnull, 'w'))
+        self.assertTrue(numpy.array_equal(readImage(outputFilename), readImage(referenceFilename)))
+
+    def testRenderAllRegions(self):
+        output = self.getFilename('all_%s.png')
+        response = self.client.render(self.mpcdiFilename, self.mediaFilename, output)
+
+        regionIds = self.synthetic.getRegionIds()
+        self.assertEqual(sorted(response['outputs'].keys()), sorted(regionIds))
+        for regionId in regionIds:
+            outputFilename = output.replace('%s', regionId)
+            self.assertEqual(response['outputs'][regionId], outputFilename)
+            self.assertEqual(readImage(outputFilename).shape[:2], (90, 160))
+
+    def testMultipleRegionsNeedPattern(self):
+        with self.assertRaises(StandardError):
+            self.client.render(self.mpcdiFilename, self.mediaFilename,
+                               self.getFilename('one.png'))
+
+    def testBadMedia(self):
+        with self.assertRaises(StandardError) as context:
+            self.client.render(self.mpcdiFilename, self.getFilename('missing.png'),
+                               self.getFilename('bad.png'))
+        self.assertIn('Could not read media', str(context.exception))
+
+        # The server carries on.
+        self.client.ping()
+
+    def testBadMpcdi(self):
+        with self.assertRaises(StandardError):
+            self.client.render(self.getFilename('missing.mpcdi'), self.mediaFilename,
+                               self.getFilename('bad_%s.png'))
+        with self.assertRaises(StandardError) as context:
+            self.client.render(self.mpcdiFilename, self.mediaFilename,
+                               self.getFilename('bad.png'), ['noSuchRegion'])
+        self.assertIn('noSuchRegion', str(context.exception))
+        self.client.ping()
+
+    def testStats(self):
+        regionId = self.synthetic.getRegionIds()[1]
+        self.client.render(self.mpcdiFilename, self.mediaFilename,
+                           self.getFilename('stats.png'), [regionId])
+
+        stats = self.client.getStats()
+        self.assertEqual(stats['status'], 'ok')
+        self.assertGreaterEqual(stats['requests'], 1)
+        self.assertGreaterEqual(stats['batches'], 1)
+        regions = [region['region'] for region in stats['regions']]
+        self.assertIn(regionId, regions)
+
+    def renderConcurrently(self, name):
+        """ Renders each of mediaFilenames through every region at
+        once, each from a connection of its own, and returns the
+        list of responses. """
+
+        clients = [RenderClient(self.socketFilename) for filename in self.mediaFilenames]
+        responses = [None] * len(clients)
+        errors = []
+        start = threading.Event()
+
+        def render(i):
+            start.wait()
+            try:
+                responses[i] = clients[i].render(self.mpcdiFilename, self.mediaFilenames[i],
+                                                 self.getFilename('%s%s_%%s.png' % (name, i)))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target = render, args = (i,)) for i in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        for client in clients:
+            client.close()
+
+        self.assertEqual(errors, [])
+        return responses
+
+    def testConcurrentRequests(self):
+        # The requests are only batched if they arrive while the
+        # server is busy, so try a few times.
+        for attempt in range(10):
+            name = 'batch%s_' % (attempt)
+            responses = self.renderConcurrently(name)
+            if max([response['batchSize'] for response in responses]) > 1:
+                break
+        else:
+            self.fail('The concurrent requests were never rendered in one batch')
+
+        # Each region's output for each media should match what it
+        # renders for that media alone.
+        regionIds = self.synthetic.getRegionIds()
+        references = {}
+        for i, mediaFilename in enumerate(self.mediaFilenames):
+            output = self.getFilename('alone%s_%%s.png' % (i))
+            response = self.client.render(self.mpcdiFilename, mediaFilename, output)
+            self.assertEqual(response['batchSize'], 1)
+            for regionId in regionIds:
+                references[(i, regionId)] = readImage(output.replace('%s', regionId))
+
+        for i, response in enumerate(responses):
+            self.assertEqual(sorted(response['outputs'].keys()), sorted(regionIds))
+            for regionId in regionIds:
+                image = readImage(response['outputs'][regionId])
+                self.assertTrue(numpy.array_equal(image, references[(i, regionId)]))
+                if i > 0:
+                    # Otherwise a mixup wouldn't show.
+                    self.assertFalse(numpy.array_equal(image, references[(0, regionId)]))
+
+class TestRenderServerGL(TestRenderServer):
+    """ Runs the same tests with the shader-based implementation,
+    rendering into framebuffer objects on an offscreen context, if
+    there is a backend for one. """
+
+    @classmethod
+    def setUpClass(cls):
+        backend = findOffscreenBackend()
+        if not backend:
+            raise unittest.SkipTest('No offscreen OpenGL backend is available')
+        cls.renderArgs = ['-H', backend]
+        super(TestRenderServerGL, cls).setUpClass()
+
+class TestRenderServerShutdown(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'pympcdi_test')
+        self.socketFilename = os.path.join(self.directory, 'render.sock')
+        self.process = startServer(self.socketFilename)
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def testShutdown(self):
+        client = RenderClient(self.socketFilename)
+        response = client.shutdown()
+        client.close()
+        self.assertEqual(response['status'], 'ok')
+
+        self.assertEqual(waitForExit(self.process), 0)
+        self.assertFalse(os.path.exists(self.socketFilename))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import unittest
+import numpy
+import PfmFile
+from WarpMesh import WarpMesh
+
+def makePfm(u, v):
+    """ Returns a PfmFile holding the indicated grids of U's and V's. """
+    array = numpy.dstack([u, v, numpy.zeros_like(u)]).astype('float32')
+    return PfmFile.PfmFile(array = array)
+
+def getTriangles(mesh):
+    """ Returns the list of vertex index triples of the triangles of
+    the mesh, whether it is drawn as a list or as strips. """
+
+    if not mesh.useStrips:
+        return mesh.indices.reshape(-1, 3)
+
+    triangles = []
+    strip = []
+    for index in list(mesh.indices) + [mesh.restartIndex]:
+        if index == mesh.restartIndex:
+            for i in range(len(strip) - 2):
+                triangles.append(strip[i:i + 3])
+            strip = []
+        else:
+            strip.append(index)
+    return triangles
+
+def getCellCounts(mesh):
+    """ Returns the number of triangles drawn within each cell of the
+    pfm grid, as an array of shape (ySize - 1, xSize - 1).  The mesh
+    must not be decimated. """
+
+    # Undo the vertex positions, which are at the cell centers.
+    grid = numpy.rint(mesh.verts * [mesh.xSize, mesh.ySize] - 0.5).astype('int')
+    counts = numpy.zeros((mesh.ySize - 1, mesh.xSize - 1), dtype = 'int')
+    for triangle in getTriangles(mesh):
+        x, y = grid[list(triangle)].transpose()
+        # Each triangle must lie within a single cell.
+        assert x.max() - x.min() == 1 and y.max() - y.min() == 1
+        counts[y.min(), x.min()] += 1
+    return counts
+
+def getMeshError(mesh, pfm):
+    """ Returns the largest difference between the UV's of the pfm
+    grid and those interpolated at the same points by the triangles
+    of the mesh. """
+
+    ySize, xSize = pfm.ySize, pfm.xSize
+    y, x = numpy.mgrid[0:ySize, 0:xSize]
+    points = numpy.empty((ySize * xSize, 2), dtype = 'float32')
+    points[:,0] = ((x.astype('float32') + 0.5) / float(xSize)).reshape(-1)
+    points[:,1] = ((y.astype('float32') + 0.5) / float(ySize)).reshape(-1)
+    expected = pfm.getArray()[:,:,0:2].reshape(-1, 2)
+
+    error = numpy.zeros(len(points))
+    covered = numpy.zeros(len(points), dtype = 'bool')
+    for i0, i1, i2 in getTriangles(mesh):
+        p0, p1, p2 = mesh.verts[i0], mesh.verts[i1], mesh.verts[i2]
+        det = (p1[0] - p0[0]) * (p2[1] - p0[1]) - (p2[0] - p0[0]) * (p1[1] - p0[1])
+        d = points - p0
+        b1 = (d[:,0] * (p2[1] - p0[1]) - (p2[0] - p0[0]) * d[:,1]) / det
+        b2 = ((p1[0] - p0[0]) * d[:,1] - d[:,0] * (p1[1] - p0[1])) / det
+        inside = (b1 >= -1e-4) & (b2 >= -1e-4) & (b1 + b2 <= 1 + 1e-4)
+        uv = mesh.uvs[i0] + b1[:,numpy.newaxis] * (mesh.uvs[i1] - mesh.uvs[i0]) + \
+             b2[:,numpy.newaxis] * (mesh.uvs[i2] - mesh.uvs[i0])
+        pointError = numpy.abs(uv - expected).max(axis = 1)
+        error[inside] = numpy.maximum(error[inside], pointError[inside])
+        covered |= inside
+
+    assert covered.all()
+    return error.max()
+
+class TestWarpMesh(unittest.TestCase):
+
+    def setUp(self):
+        y, x = numpy.mgrid[0:65, 0:65]
+        self.x = x / 64.0
+        self.y = y / 64.0
+
+    def testLinearGridCollapses(self):
+        pfm = makePfm(self.x * 0.5 + 0.25, self.y)
+        mesh = WarpMesh(pfm, tolerance = 2e-4)
+        self.assertEqual(mesh.numVertices, 4)
+        self.assertEqual(mesh.numIndices, 6)
+        self.assertLess(getMeshError(mesh, pfm), 2e-4)
+
+    def testTwistedGrid(self):
+        # u = x * y is linear along every row and column, but not
+        # across the cells.
+        pfm = makePfm(self.x * self.y, self.y)
+        mesh = WarpMesh(pfm, tolerance = 2e-4)
+        self.assertGreater(mesh.numVertices, 4)
+        self.assertLessEqual(getMeshError(mesh, pfm), 2e-4)
+
+    def testTwistedGridStrips(self):
+        pfm = makePfm(self.x * self.y, self.y)
+        mesh = WarpMesh(pfm, tolerance = 2e-4, useStrips = True)
+        self.assertLessEqual(getMeshError(mesh, pfm), 2e-4)
+
+    def testSmoothGrid(self):
+        pfm = makePfm(self.x + 0.01 * numpy.sin(3.0 * self.y), self.y + 0.02 * self.x * self.x)
+        mesh = WarpMesh(pfm, tolerance = 2e-4)
+        self.assertLess(mesh.numVertices, mesh.fullNumVertices / 10)
+        self.assertLessEqual(getMeshError(mesh, pfm), 2e-4)
+
+    def testNaNHolesStrips(self):
+        y, x = numpy.mgrid[0:9, 0:12] / 8.0
+        u, v = x.copy(), y.copy()
+        # An unused corner, a hole of a single vertex, and a row
+        # broken in two.
+        u[0:3, 0:4] = numpy.nan
+        v[5, 6] = numpy.nan
+        u[7, 9] = numpy.nan
+        pfm = makePfm(u, v)
+        mesh = WarpMesh(pfm, useStrips = True)
+
+        valid = numpy.isfinite(u) & numpy.isfinite(v)
+        validCells = valid[:-1,:-1] & valid[:-1,1:] & valid[1:,:-1] & valid[1:,1:]
+
+        # Each fully valid cell is drawn as two triangles, and no
+        # others are drawn at all.
+        counts = getCellCounts(mesh)
+        self.assertTrue((counts[validCells] == 2).all())
+        self.assertTrue((counts[~validCells] == 0).all())
+
+        # Only the vertices of those cells remain, and all of them
+        # are referenced.
+        self.assertTrue(numpy.isfinite(mesh.uvs).all())
+        used = numpy.zeros(valid.shape, dtype = 'bool')
+        for cellY, cellX in numpy.argwhere(validCells):
+            used[cellY:cellY + 2, cellX:cellX + 2] = True
+        self.assertEqual(mesh.numVertices, used.sum())
+
+        self.assertEqual(mesh.indices.dtype, numpy.uint16)
+        self.assertEqual(mesh.restartIndex, 0xffff)
+
+    def testStripIndexType(self):
+        # 300 x 300 vertices don't fit in 16-bit indices.
+        y, x = numpy.mgrid[0:300, 0:300] / 299.0
+        mesh = WarpMesh(makePfm(x, y), useStrips = True)
+        self.assertEqual(mesh.numVertices, 300 * 300)
+        self.assertEqual(mesh.indices.dtype, numpy.uint32)
+        self.assertEqual(mesh.restartIndex, 0xffffffff)
+        self.assertEqual(mesh.indices.max(), mesh.restartIndex)
+        self.assertLess(mesh.indices[mesh.indices != mesh.restartIndex].max(), mesh.numVertices)
+
+        # But once half of the grid is unused, the vertices that
+        # remain do.
+        u = x.copy()
+        u[:, 0:150] = numpy.nan
+        mesh = WarpMesh(makePfm(u, y), useStrips = True)
+        self.assertEqual(mesh.numVertices, 300 * 150)
+        self.assertEqual(mesh.indices.dtype, numpy.uint16)
+        self.assertEqual(mesh.restartIndex, 0xffff)
+
+if __name__ == '__main__':
+    unittest.main()